@@ -0,0 +1,50 @@
+"""add CANCELLED to MessageStatusEnum
+
+Revision ID: a2c6e9f4b7d1
+Revises: f1b8d3e6a2c4
+Create Date: 2023-10-05 11:08:52.640317
+
+"""
+from typing import Set
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a2c6e9f4b7d1"
+down_revision = "f1b8d3e6a2c4"
+branch_labels = None
+depends_on = None
+
+
+existing_message_status_enum_values = {"PENDING", "SUCCESS", "ERROR"}
+
+new_message_status_enum_values = {
+    *existing_message_status_enum_values,
+    "CANCELLED",
+}
+
+
+def replace_enum_values(enum_name: str, table: str, new_values: Set[str]):
+    """
+    Create a new type, add the value to it, update the column to use the new type and delete the old type
+    """
+    op.execute(f'ALTER TYPE public."{enum_name}" RENAME TO "{enum_name}Old"')
+    sa.Enum(*new_values, name=enum_name).create(op.get_bind())
+    op.execute(
+        f'ALTER TABLE {table} ALTER COLUMN status TYPE public."{enum_name}" USING status::text::public."{enum_name}"'
+    )
+    op.execute(f'DROP TYPE public."{enum_name}Old"')
+
+
+def upgrade() -> None:
+    # Alter MessageStatusEnum to add "CANCELLED" as a valid value
+    replace_enum_values("MessageStatusEnum", "message", new_message_status_enum_values)
+
+
+def downgrade() -> None:
+    # messages whose stream was cancelled are stored as failed ones before
+    op.execute("UPDATE message SET status = 'ERROR' WHERE status = 'CANCELLED'")
+    replace_enum_values(
+        "MessageStatusEnum", "message", existing_message_status_enum_values
+    )
@@ -0,0 +1,39 @@
+"""add vector store hnsw index
+
+Revision ID: a7d3c9e15f20
+Revises: 8e4f1a2b6c3d
+Create Date: 2023-09-25 09:48:03.116527
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a7d3c9e15f20"
+down_revision = "8e4f1a2b6c3d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    # the table used to be created at startup by CustomPGVectorStore.run_setup
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS data_pg_vector_store (
+            id BIGSERIAL PRIMARY KEY,
+            text VARCHAR NOT NULL,
+            metadata_ JSON,
+            node_id VARCHAR,
+            embedding vector(1536)
+        )
+        """
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_data_pg_vector_store_embedding_hnsw "
+        "ON data_pg_vector_store "
+        "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_data_pg_vector_store_embedding_hnsw")
@@ -0,0 +1,37 @@
+"""add vector store db_document_id column
+
+Revision ID: b41e6f0c8d72
+Revises: a7d3c9e15f20
+Create Date: 2023-09-26 14:22:51.640318
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b41e6f0c8d72"
+down_revision = "a7d3c9e15f20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        "ALTER TABLE data_pg_vector_store "
+        "ADD COLUMN IF NOT EXISTS db_document_id VARCHAR"
+    )
+    op.execute(
+        "UPDATE data_pg_vector_store "
+        "SET db_document_id = metadata_ ->> 'db_document_id' "
+        "WHERE db_document_id IS NULL"
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_data_pg_vector_store_db_document_id "
+        "ON data_pg_vector_store (db_document_id)"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_data_pg_vector_store_db_document_id")
+    op.execute(
+        "ALTER TABLE data_pg_vector_store DROP COLUMN IF EXISTS db_document_id"
+    )
@@ -0,0 +1,157 @@
+"""partition vector store table
+
+Opt-in: converts the vector store table into a table partitioned by
+db_document_id when run with
+
+    alembic -x vector_store_partitioning=hash upgrade head
+
+or with vector_store_partitioning=list, and optionally
+-x vector_store_hash_partitions=16. Without it, this revision doesn't change
+anything. The rows are copied into the new table in a single transaction that
+locks the vector store, so run it in a maintenance window. Rows without a
+db_document_id can't be placed in a partition and are not copied. Optional ANN
+indexes (e.g. hnsw_halfvec) have to be rebuilt with scripts/vector_index.py.
+
+Revision ID: b8e2d4f6a1c3
+Revises: a2c6e9f4b7d1
+Create Date: 2023-10-06 10:17:29.518604
+
+"""
+import hashlib
+from typing import Tuple
+
+from alembic import context, op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "b8e2d4f6a1c3"
+down_revision = "a2c6e9f4b7d1"
+branch_labels = None
+depends_on = None
+
+TABLE_NAME = "data_pg_vector_store"
+COLUMNS = "id, text, metadata_, node_id, embedding, db_document_id, content_hash"
+
+
+def get_layout() -> Tuple[str, int]:
+    x_arguments = context.get_x_argument(as_dictionary=True)
+    layout = x_arguments.get("vector_store_partitioning", "none").lower()
+    if layout not in ("none", "hash", "list"):
+        raise ValueError(f"Unknown vector_store_partitioning: {layout}")
+    return layout, int(x_arguments.get("vector_store_hash_partitions", 16))
+
+
+def is_partitioned(table_name: str) -> bool:
+    relkind = (
+        op.get_bind()
+        .execute(
+            sa.text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+            {"table": table_name},
+        )
+        .scalar()
+    )
+    return relkind == "p"
+
+
+def quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def replace_table(table_name: str, new_table_name: str, where: str = "") -> None:
+    """
+    Copy the rows into the new table, put it in place of the old one and create
+    the indexes that the vector store relies on.
+    """
+    op.execute(
+        f"INSERT INTO {new_table_name} ({COLUMNS}) "
+        f"SELECT {COLUMNS} FROM {table_name} {where}"
+    )
+    op.execute(f"DROP TABLE {table_name}")
+    op.execute(f"ALTER TABLE {new_table_name} RENAME TO {table_name}")
+    op.execute(
+        f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), "
+        f"coalesce((SELECT max(id) FROM {table_name}), 0) + 1, false)"
+    )
+    op.execute(
+        f"CREATE INDEX ix_{table_name}_db_document_id ON {table_name} (db_document_id)"
+    )
+    op.execute(
+        f"CREATE UNIQUE INDEX ux_{table_name}_db_document_id_content_hash "
+        f"ON {table_name} (db_document_id, content_hash)"
+    )
+    op.execute(
+        f"CREATE INDEX ix_{table_name}_embedding_hnsw ON {table_name} "
+        "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)"
+    )
+
+
+def upgrade() -> None:
+    layout, hash_partitions = get_layout()
+    table_name = TABLE_NAME
+    if layout == "none" or is_partitioned(table_name):
+        return
+    new_table_name = f"{table_name}_partitioned"
+    op.execute(
+        f"""
+        CREATE TABLE {new_table_name} (
+            id BIGSERIAL,
+            text VARCHAR NOT NULL,
+            metadata_ JSON,
+            node_id VARCHAR,
+            embedding vector(1536),
+            db_document_id VARCHAR,
+            content_hash VARCHAR,
+            PRIMARY KEY (id, db_document_id)
+        ) PARTITION BY {layout.upper()} (db_document_id)
+        """
+    )
+    if layout == "hash":
+        for remainder in range(hash_partitions):
+            op.execute(
+                f"CREATE TABLE {table_name}_p{remainder} PARTITION OF {new_table_name} "
+                f"FOR VALUES WITH (MODULUS {hash_partitions}, REMAINDER {remainder})"
+            )
+    else:
+        op.execute(
+            f"CREATE TABLE {table_name}_default PARTITION OF {new_table_name} DEFAULT"
+        )
+        doc_ids = (
+            op.get_bind()
+            .execute(
+                sa.text(
+                    f"SELECT DISTINCT db_document_id FROM {table_name} "
+                    "WHERE db_document_id IS NOT NULL"
+                )
+            )
+            .scalars()
+        )
+        for doc_id in doc_ids:
+            # same naming as vector_index.get_document_partition_name
+            partition_hash = hashlib.md5(doc_id.encode("utf-8")).hexdigest()[:16]
+            op.execute(
+                f"CREATE TABLE {table_name}_doc_{partition_hash} "
+                f"PARTITION OF {new_table_name} "
+                f"FOR VALUES IN ({quote_literal(doc_id)})"
+            )
+    replace_table(table_name, new_table_name, "WHERE db_document_id IS NOT NULL")
+
+
+def downgrade() -> None:
+    table_name = TABLE_NAME
+    if not is_partitioned(table_name):
+        return
+    new_table_name = f"{table_name}_unpartitioned"
+    op.execute(
+        f"""
+        CREATE TABLE {new_table_name} (
+            id BIGSERIAL PRIMARY KEY,
+            text VARCHAR NOT NULL,
+            metadata_ JSON,
+            node_id VARCHAR,
+            embedding vector(1536),
+            db_document_id VARCHAR,
+            content_hash VARCHAR
+        )
+        """
+    )
+    replace_table(table_name, new_table_name)
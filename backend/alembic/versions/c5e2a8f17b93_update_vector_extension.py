@@ -0,0 +1,25 @@
+"""update vector extension
+
+Revision ID: c5e2a8f17b93
+Revises: b41e6f0c8d72
+Create Date: 2023-09-28 11:05:37.284910
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c5e2a8f17b93"
+down_revision = "b41e6f0c8d72"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # halfvec (used by the hnsw_halfvec index) needs pgvector >= 0.7. This updates
+    # the extension to the newest version installed on the server, if any.
+    op.execute("ALTER EXTENSION vector UPDATE")
+
+
+def downgrade() -> None:
+    # pgvector extension versions can't be downgraded
+    pass
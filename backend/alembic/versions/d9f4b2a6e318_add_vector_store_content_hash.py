@@ -0,0 +1,85 @@
+"""add vector store content_hash
+
+The backfill and the deduplication run in batches of ids, each committed on its
+own, so they don't hold locks on the whole vector store table for the duration
+of the migration.
+
+Revision ID: d9f4b2a6e318
+Revises: c5e2a8f17b93
+Create Date: 2023-09-29 16:40:12.573018
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "d9f4b2a6e318"
+down_revision = "c5e2a8f17b93"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+
+def run_batches(statement: str, max_id: int) -> None:
+    for after_id in range(0, max_id, BATCH_SIZE):
+        op.execute(
+            sa.text(statement).bindparams(
+                after_id=after_id, until_id=after_id + BATCH_SIZE
+            )
+        )
+
+
+def upgrade() -> None:
+    op.execute(
+        "ALTER TABLE data_pg_vector_store ADD COLUMN IF NOT EXISTS content_hash VARCHAR"
+    )
+    with op.get_context().autocommit_block():
+        max_id = (
+            op.get_bind()
+            .execute(sa.text("SELECT coalesce(max(id), 0) FROM data_pg_vector_store"))
+            .scalar()
+        )
+        # same as vector_index.get_content_hash at the time of this migration
+        run_batches(
+            """
+            UPDATE data_pg_vector_store SET content_hash = encode(sha256(convert_to(
+                concat_ws(chr(31), coalesce(db_document_id, ''),
+                    coalesce(metadata_ ->> 'page_label', ''), text),
+                'UTF8')), 'hex')
+            WHERE id > :after_id AND id <= :until_id AND content_hash IS NULL
+            """,
+            max_id,
+        )
+        # lets every batch look up the copies of its chunks without a table scan
+        op.execute(
+            "CREATE INDEX IF NOT EXISTS ix_data_pg_vector_store_content_hash_dedupe "
+            "ON data_pg_vector_store (db_document_id, content_hash)"
+        )
+        # keep the most recently inserted copy of duplicated chunks, like
+        # scripts/dedupe_vector_store.py did
+        run_batches(
+            """
+            DELETE FROM data_pg_vector_store t
+            WHERE t.id > :after_id AND t.id <= :until_id AND EXISTS (
+                SELECT 1 FROM data_pg_vector_store newer
+                WHERE newer.db_document_id = t.db_document_id
+                    AND newer.content_hash = t.content_hash
+                    AND newer.id > t.id
+            )
+            """,
+            max_id,
+        )
+        op.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS "
+            "ux_data_pg_vector_store_db_document_id_content_hash "
+            "ON data_pg_vector_store (db_document_id, content_hash)"
+        )
+        op.execute("DROP INDEX IF EXISTS ix_data_pg_vector_store_content_hash_dedupe")
+
+
+def downgrade() -> None:
+    op.execute(
+        "DROP INDEX IF EXISTS ux_data_pg_vector_store_db_document_id_content_hash"
+    )
+    op.execute("ALTER TABLE data_pg_vector_store DROP COLUMN IF EXISTS content_hash")
@@ -2,17 +2,26 @@ import asyncio
 import datetime
 import logging
 from collections import OrderedDict
+from typing import Optional
 from uuid import UUID, uuid4
 
 import anyio
 from app import schema
 from app.api import crud
 from app.api.deps import get_db
+from app.chat.chat_history import count_tokens
+from app.chat.message_stream import (
+    MessageDeltaEncoder,
+    StreamFlushPolicy,
+    create_latest_state_stream,
+    get_stream_delivery_metrics,
+)
 from app.chat.messaging import (
     StreamedMessage,
     StreamedMessageSubProcess,
     handle_chat_message,
 )
+from app.core.config import MessageDeliveryMode, settings
 from app.models.db import (
     Message,
     MessageRoleEnum,
@@ -71,6 +80,7 @@ async def delete_conversation(
 async def message_conversation(
     conversation_id: UUID,
     user_message: str,
+    stream_mode: schema.MessageStreamModeEnum = schema.MessageStreamModeEnum.FULL,
     db: AsyncSession = Depends(get_db),
 ) -> EventSourceResponse:
     """
@@ -79,6 +89,11 @@ async def message_conversation(
     the message object's sub_processes list and content string is appended to. While the message is being
     generated, the status of the message will be PENDING. Once the message is generated, the status will
     be SUCCESS. If there was an error in processing the message, the final status will be ERROR.
+    If the client disconnects, generating the message is stopped and it's stored as CANCELLED.
+
+    With stream_mode=delta, "snapshot" events hold the full Message and "delta" events hold a
+    MessageDelta: the text appended to the content since the previous event and the sub_processes
+    that were added or changed, by their index. The first and last events are always snapshots.
     """
     conversation = await crud.fetch_conversation_with_messages(db, str(conversation_id))
     if conversation is None:
@@ -89,13 +104,21 @@ async def message_conversation(
         updated_at=datetime.datetime.utcnow(),
         conversation_id=conversation_id,
         content=user_message,
+        token_count=count_tokens(user_message),
         role=MessageRoleEnum.user,
         status=MessageStatusEnum.SUCCESS,
     )
 
-    send_chan, recv_chan = anyio.create_memory_object_stream(100)
+    if settings.SSE_DELIVERY_MODE == MessageDeliveryMode.LATEST:
+        # the content updates carry the whole content so far, only the newest matters
+        send_chan, recv_chan = create_latest_state_stream(
+            is_replaceable=lambda item: isinstance(item, StreamedMessage)
+        )
+    else:
+        send_chan, recv_chan = anyio.create_memory_object_stream(100)
 
     async def event_publisher():
+        delta_encoder = MessageDeltaEncoder(settings.SSE_DELTA_SNAPSHOT_INTERVAL)
         async with send_chan:
             task = asyncio.create_task(
                 handle_chat_message(conversation, user_message, send_chan)
@@ -110,21 +133,34 @@ async def message_conversation(
                 sub_processes=[],
             )
             final_status = MessageStatusEnum.ERROR
+            disconnect: Optional[BaseException] = None
             event_id_to_sub_process = OrderedDict()
+            flush_policy = StreamFlushPolicy(
+                interval_seconds=settings.SSE_FLUSH_INTERVAL_MS / 1000,
+                max_tokens=settings.SSE_FLUSH_MAX_TOKENS,
+            )
             try:
-                async for message_obj in recv_chan:
+                while True:
+                    message_obj = None
+                    # wait for more updates only as long as the pending ones can wait
+                    with anyio.move_on_after(flush_policy.seconds_until_flush()):
+                        try:
+                            message_obj = await recv_chan.receive()
+                        except anyio.EndOfStream:
+                            # the final message is sent below
+                            break
                     if isinstance(message_obj, StreamedMessage):
                         message.content = message_obj.content
+                        flush_policy.add(is_token=True)
                     elif isinstance(message_obj, StreamedMessageSubProcess):
                         status = (
                             MessageSubProcessStatusEnum.FINISHED
                             if message_obj.has_ended
                             else MessageSubProcessStatusEnum.PENDING
                         )
-                        if message_obj.event_id in event_id_to_sub_process:
-                            created_at = event_id_to_sub_process[
-                                message_obj.event_id
-                            ].created_at
+                        previous = event_id_to_sub_process.get(message_obj.event_id)
+                        if previous is not None:
+                            created_at = previous.created_at
                         else:
                             created_at = datetime.datetime.utcnow()
                         sub_process = MessageSubProcess(
@@ -140,27 +176,56 @@ async def message_conversation(
                         event_id_to_sub_process[message_obj.event_id] = sub_process
 
                         message.sub_processes = list(event_id_to_sub_process.values())
-                    else:
+                        # clients show sub-processes starting & finishing right away
+                        flush_policy.add(
+                            urgent=previous is None or previous.status != status
+                        )
+                    elif message_obj is not None:
                         logger.error(
                             f"Unknown message object type: {type(message_obj)}"
                         )
                         continue
-                    yield schema.Message.from_orm(message).json()
+                    if not flush_policy.should_flush():
+                        continue
+                    flush_policy.flushed()
+                    if stream_mode == schema.MessageStreamModeEnum.DELTA:
+                        yield delta_encoder.encode(message)
+                    else:
+                        yield schema.Message.from_orm(message).json()
                 await task
                 if task.exception():
                     raise ValueError(
                         "handle_chat_message task failed"
                     ) from task.exception()
                 final_status = MessageStatusEnum.SUCCESS
-            except:
+            except (asyncio.CancelledError, GeneratorExit) as e:
+                # The client disconnected: sse_starlette cancels the response while it
+                # waits for the next update, or closes this generator at a yield.
+                # Stop generating the rest of the message.
+                disconnect = e
+                final_status = MessageStatusEnum.CANCELLED
+                task.cancel()
+            except Exception:
                 logger.error("Error in message publisher", exc_info=True)
                 final_status = MessageStatusEnum.ERROR
+            if settings.SSE_DELIVERY_MODE == MessageDeliveryMode.LATEST:
+                logger.debug("Message stream stats: %s", recv_chan.stats)
+                get_stream_delivery_metrics().record(recv_chan.stats)
             message.status = final_status
-            db.add(user_message)
-            db.add(message)
-            await db.commit()
+            message.token_count = count_tokens(message.content)
+            # the partial message is stored even if the response was cancelled
+            with anyio.CancelScope(shield=True):
+                db.add(user_message)
+                db.add(message)
+                await db.commit()
+            if disconnect is not None:
+                logger.info("Client disconnected, cancelled message %s", message_id)
+                raise disconnect
             final_message = await crud.fetch_message_with_sub_processes(db, message_id)
-            yield final_message.json()
+            if stream_mode == schema.MessageStreamModeEnum.DELTA:
+                yield {"event": "snapshot", "data": final_message.json()}
+            else:
+                yield final_message.json()
 
     return EventSourceResponse(event_publisher())
 
@@ -175,7 +240,7 @@ async def test_message_conversation(
     Test version of /message endpoint that returns a single message object instead of a SSE stream.
     """
     response: EventSourceResponse = await message_conversation(
-        conversation_id, user_message, db
+        conversation_id, user_message, db=db
     )
     final_message = None
     async for message in response.body_iterator:
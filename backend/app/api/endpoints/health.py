@@ -4,6 +4,7 @@ from fastapi import APIRouter, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import text
 from app.api import deps
+from app.chat.message_stream import get_stream_delivery_metrics
 
 router = APIRouter()
 
@@ -15,3 +16,12 @@ async def health(db: AsyncSession = Depends(deps.get_db)) -> Dict[str, str]:
     """
     await db.execute(text("SELECT 1"))
     return {"status": "alive"}
+
+
+@router.get("/stream_delivery")
+async def stream_delivery() -> Dict[str, int]:
+    """
+    Totals of this worker's latest-state message streams (SSE_DELIVERY_MODE=latest),
+    including how many intermediate message updates were dropped for slow clients.
+    """
+    return get_stream_delivery_metrics().stats
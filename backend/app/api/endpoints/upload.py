@@ -1,7 +1,10 @@
 import os
 import shutil
 
-from fastapi import APIRouter, UploadFile
+from app.chat.answer_cache import get_answer_cache
+from app.chat.index_cache import get_document_index_cache
+from app.chat.ingestion import get_ingestion_worker
+from fastapi import APIRouter, HTTPException, UploadFile
 from fastapi.responses import JSONResponse
 
 router = APIRouter()
@@ -17,8 +20,27 @@ async def upload_file(file: UploadFile):
         file_path = os.path.join(UPLOAD_FOLDER, file.filename)
         with open(file_path, "wb") as pdf_file:
             shutil.copyfileobj(file.file, pdf_file)
+        # the document may have been re-uploaded with new content
+        get_document_index_cache().invalidate(file.filename)
+        get_answer_cache().invalidate(file.filename)
+        job = get_ingestion_worker().submit(file.filename, force=True)
         return JSONResponse(
-            content={"message": f"文件 {file.filename} 已上传成功."}, status_code=200
+            content={
+                "message": f"文件 {file.filename} 已上传成功.",
+                "ingestion_status": job.status.value,
+            },
+            status_code=200,
         )
     except Exception as e:
         return JSONResponse(content={"error": f"上传文件时出错: {str(e)}"}, status_code=500)
+
+
+@router.get("/{filename}/status")
+async def get_ingestion_status(filename: str):
+    """
+    Get the indexing status of an uploaded file.
+    """
+    job = get_ingestion_worker().get_job(filename)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No ingestion job for this file")
+    return {"document_id": filename, "status": job.status.value, "error": job.error}
@@ -0,0 +1,135 @@
+"""
+Cache of answers to sub-questions asked against a single document.
+"""
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+from app.chat.embedding_cache import normalize_text
+from app.core.config import settings
+from cachetools import TTLCache
+from llama_index.indices.query.base import BaseQueryEngine
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.response.schema import RESPONSE_TYPE, Response
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    return normalize_text(question).lower().rstrip("?.! ")
+
+
+class SubQuestionAnswerCache:
+    """
+    TTL cache of answers (text and source nodes) to questions about a document,
+    keyed by the document id and the normalized question.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self._cache: TTLCache = TTLCache(maxsize=max_size, ttl=ttl_seconds)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _get_key(doc_id: str, question: str) -> Tuple[str, str]:
+        return doc_id, normalize_question(question)
+
+    def get(self, doc_id: str, question: str) -> Optional[Response]:
+        with self._lock:
+            response = self._cache.get(self._get_key(doc_id, question))
+            if response is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # copy so callers can't modify the cached source nodes
+        return Response(
+            response=response.response,
+            source_nodes=list(response.source_nodes),
+            metadata=response.metadata,
+        )
+
+    def put(self, doc_id: str, question: str, response: Response) -> None:
+        with self._lock:
+            self._cache[self._get_key(doc_id, question)] = response
+
+    def invalidate(self, doc_id: str) -> int:
+        """
+        Drop all cached answers for a document, e.g. because it was re-ingested.
+        Returns the number of dropped answers.
+        """
+        with self._lock:
+            keys = [key for key in self._cache.keys() if key[0] == doc_id]
+            for key in keys:
+                self._cache.pop(key, None)
+        if keys:
+            logger.info(
+                "Invalidated %d cached answers for document %s", len(keys), doc_id
+            )
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._cache),
+            }
+
+
+class CachedQueryEngine(BaseQueryEngine):
+    """
+    Wraps the query engine of a single document and answers repeated questions from
+    the answer cache.
+
+    SubQuestionQueryEngine emits the SUB_QUESTION events around the call to this
+    engine, so cached answers show up to callback handlers just like live ones.
+    """
+
+    def __init__(
+        self,
+        doc_id: str,
+        query_engine: BaseQueryEngine,
+        answer_cache: SubQuestionAnswerCache,
+    ):
+        self._doc_id = doc_id
+        self._query_engine = query_engine
+        self._answer_cache = answer_cache
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _cache_response(self, question: str, response: RESPONSE_TYPE) -> None:
+        # streaming responses can only be consumed once
+        if isinstance(response, Response) and response.response:
+            self._answer_cache.put(self._doc_id, question, response)
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        response = self._answer_cache.get(self._doc_id, query_bundle.query_str)
+        if response is None:
+            response = self._query_engine.query(query_bundle)
+            self._cache_response(query_bundle.query_str, response)
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        response = self._answer_cache.get(self._doc_id, query_bundle.query_str)
+        if response is None:
+            response = await self._query_engine.aquery(query_bundle)
+            self._cache_response(query_bundle.query_str, response)
+        return response
+
+
+singleton_instance: Optional[SubQuestionAnswerCache] = None
+
+
+def get_answer_cache() -> SubQuestionAnswerCache:
+    global singleton_instance
+    if singleton_instance is None:
+        singleton_instance = SubQuestionAnswerCache(
+            max_size=settings.ANSWER_CACHE_MAX_SIZE,
+            ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS,
+        )
+    return singleton_instance
@@ -0,0 +1,232 @@
+"""
+Token-budgeted chat history.
+
+The most recent messages of a conversation are sent to the agent as they are, as
+long as they fit in the token budget. Older messages are folded into a rolling
+summary that is stored on the conversation. The summary is only extended with
+the messages that fell out of the window since it was last updated, and the
+window is trimmed to a fraction of the budget when it overflows, so summarizing
+happens every few turns rather than on every turn.
+"""
+import datetime
+import logging
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.db import Conversation, MessageRoleEnum, MessageStatusEnum
+from app.schema import Conversation as ConversationSchema
+from app.schema import Message as MessageSchema
+from cachetools import LRUCache
+from llama_index.llms import ChatMessage, OpenAI
+from llama_index.llms.base import LLM, MessageRole
+from llama_index.utils import globals_helper
+from sqlalchemy import update
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """\
+Below is a summary of the earlier part of a conversation between a user and an \
+assistant that answers questions about SEC filings, followed by the messages that \
+came after it. Write an updated summary of the whole conversation. Keep the \
+companies, filings, figures and conclusions that were discussed, and leave out \
+pleasantries. Use at most {max_words} words.
+
+Summary so far:
+{summary}
+
+New messages:
+{messages}
+
+Updated summary:"""
+
+
+def count_tokens(text: str) -> int:
+    return len(globals_helper.tokenizer(text))
+
+
+def get_successful_messages(
+    chat_messages: Sequence[MessageSchema],
+) -> List[MessageSchema]:
+    """
+    The messages to use as chat history: failed and empty messages are left out.
+    Messages are fetched ordered by created_at, so they aren't sorted here.
+    """
+    return [
+        m
+        for m in chat_messages
+        if m.content.strip() and m.status == MessageStatusEnum.SUCCESS
+    ]
+
+
+def to_chat_message(message: MessageSchema) -> ChatMessage:
+    role = (
+        MessageRole.ASSISTANT
+        if message.role == MessageRoleEnum.assistant
+        else MessageRole.USER
+    )
+    return ChatMessage(content=message.content, role=role)
+
+
+class MessageTokenCounter:
+    """
+    Counts the tokens of a message once. Messages that are part of the history
+    don't change anymore, so counts are cached by message id. Messages stored with
+    their token count don't need to be counted at all.
+    """
+
+    def __init__(self, max_size: int):
+        self._cache: LRUCache = LRUCache(maxsize=max_size)
+        self._lock = threading.Lock()
+
+    def count(self, message: MessageSchema) -> int:
+        if message.token_count is not None:
+            return message.token_count
+        if message.id is None:
+            return count_tokens(message.content)
+        with self._lock:
+            num_tokens = self._cache.get(message.id)
+        if num_tokens is None:
+            num_tokens = count_tokens(message.content)
+            with self._lock:
+                self._cache[message.id] = num_tokens
+        return num_tokens
+
+
+class ConversationSummaryStore:
+    """
+    The rolling history summary, stored on the conversation row.
+    """
+
+    async def aput(
+        self,
+        conversation_id: str,
+        summary: str,
+        summary_until: datetime.datetime,
+    ) -> None:
+        async with SessionLocal() as session:
+            async with session.begin():
+                await session.execute(
+                    update(Conversation)
+                    .where(Conversation.id == conversation_id)
+                    .values(
+                        history_summary=summary, history_summary_until=summary_until
+                    )
+                )
+
+
+class ChatHistoryBuilder:
+    """
+    Builds the chat history for the next turn of a conversation within a token
+    budget, updating the conversation's summary when messages fall out of it.
+
+    If summarizing fails, the messages that don't fit are dropped and the
+    previous summary is kept.
+    """
+
+    def __init__(
+        self,
+        token_budget: int,
+        retain_fraction: float,
+        summary_max_tokens: int,
+        token_counter: MessageTokenCounter,
+        summary_store: ConversationSummaryStore,
+        llm: Optional[LLM] = None,
+    ):
+        self._token_budget = token_budget
+        self._retain_fraction = retain_fraction
+        self._summary_max_tokens = summary_max_tokens
+        self._token_counter = token_counter
+        self._summary_store = summary_store
+        self._llm = llm
+
+    def _get_llm(self) -> LLM:
+        if self._llm is None:
+            self._llm = OpenAI(
+                temperature=0,
+                model="gpt-3.5-turbo-0613",
+                max_tokens=self._summary_max_tokens,
+                api_key=settings.OPENAI_API_KEY,
+                additional_kwargs={"api_key": settings.OPENAI_API_KEY},
+            )
+        return self._llm
+
+    def _split(
+        self, messages: List[MessageSchema]
+    ) -> Tuple[List[MessageSchema], List[MessageSchema]]:
+        """
+        Split the messages into those to fold into the summary and those to keep.
+        """
+        num_tokens = [self._token_counter.count(message) for message in messages]
+        total = sum(num_tokens)
+        if total <= self._token_budget:
+            return [], messages
+        target = self._token_budget * self._retain_fraction
+        num_folded = 0
+        while num_folded < len(messages) and total > target:
+            total -= num_tokens[num_folded]
+            num_folded += 1
+        return messages[:num_folded], messages[num_folded:]
+
+    async def _asummarize(
+        self, summary: Optional[str], messages: List[MessageSchema]
+    ) -> str:
+        prompt = SUMMARY_PROMPT.format(
+            # roughly 3 words per 4 tokens
+            max_words=self._summary_max_tokens * 3 // 4,
+            summary=summary or "(none)",
+            messages="\n".join(
+                f"{message.role.value}: {message.content}" for message in messages
+            ),
+        )
+        response = await self._get_llm().acomplete(prompt)
+        return response.text.strip()
+
+    async def abuild(self, conversation: ConversationSchema) -> List[ChatMessage]:
+        summary = conversation.history_summary
+        summary_until = conversation.history_summary_until
+        messages = [
+            message
+            for message in get_successful_messages(conversation.messages)
+            if summary_until is None or message.created_at > summary_until
+        ]
+        folded, messages = self._split(messages)
+        if folded:
+            try:
+                summary = await self._asummarize(summary, folded)
+                summary_until = folded[-1].created_at
+                await self._summary_store.aput(
+                    str(conversation.id), summary, summary_until
+                )
+                conversation.history_summary = summary
+                conversation.history_summary_until = summary_until
+            except Exception:
+                logger.warning("Failed to update the history summary", exc_info=True)
+
+        chat_history = []
+        if summary:
+            chat_history.append(
+                ChatMessage(
+                    content=f"Summary of the earlier conversation:\n{summary}",
+                    role=MessageRole.SYSTEM,
+                )
+            )
+        chat_history.extend(to_chat_message(message) for message in messages)
+        return chat_history
+
+
+singleton_instance: Optional[ChatHistoryBuilder] = None
+
+
+def get_chat_history_builder() -> ChatHistoryBuilder:
+    global singleton_instance
+    if singleton_instance is None:
+        singleton_instance = ChatHistoryBuilder(
+            token_budget=settings.CHAT_HISTORY_TOKEN_BUDGET,
+            retain_fraction=settings.CHAT_HISTORY_RETAIN_FRACTION,
+            summary_max_tokens=settings.CHAT_HISTORY_SUMMARY_MAX_TOKENS,
+            token_counter=MessageTokenCounter(max_size=10000),
+            summary_store=ConversationSummaryStore(),
+        )
+    return singleton_instance
@@ -0,0 +1,353 @@
+"""
+Persistent cache of text embeddings so that identical chunks are never embedded twice.
+"""
+import hashlib
+import logging
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.db import EmbeddingCache
+from cachetools import TTLCache
+from llama_index.embeddings.openai import OpenAIEmbedding
+from pydantic import PrivateAttr
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text so that chunks that only differ in unicode form or whitespace
+    share a cache entry.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCacheStore:
+    """
+    Embeddings stored in the embeddingcache table, keyed by (model name, text hash).
+    """
+
+    def __init__(self, connection_string: str):
+        self._connection_string = connection_string
+        self._engine: Optional[Engine] = None
+        self._session: Optional[sessionmaker] = None
+
+    def _get_session(self) -> sessionmaker:
+        # connect lazily, this is also used in ingestion worker processes
+        if self._session is None:
+            self._engine = create_engine(self._connection_string, pool_pre_ping=True)
+            self._session = sessionmaker(self._engine)
+        return self._session
+
+    @staticmethod
+    def _build_select(model_name: str, text_hashes: Sequence[str]):
+        return select(EmbeddingCache.text_hash, EmbeddingCache.embedding).where(
+            EmbeddingCache.model_name == model_name,
+            EmbeddingCache.text_hash.in_(set(text_hashes)),
+        )
+
+    @staticmethod
+    def _build_insert(model_name: str, hash_to_embedding: Dict[str, List[float]]):
+        stmt = insert(EmbeddingCache).values(
+            [
+                {
+                    "model_name": model_name,
+                    "text_hash": text_hash,
+                    "embedding": embedding,
+                }
+                for text_hash, embedding in hash_to_embedding.items()
+            ]
+        )
+        return stmt.on_conflict_do_nothing(
+            index_elements=[EmbeddingCache.model_name, EmbeddingCache.text_hash]
+        )
+
+    def get_many(
+        self, model_name: str, text_hashes: Sequence[str]
+    ) -> Dict[str, List[float]]:
+        if not text_hashes:
+            return {}
+        with self._get_session()() as session:
+            result = session.execute(self._build_select(model_name, text_hashes))
+            return {text_hash: list(embedding) for text_hash, embedding in result.all()}
+
+    def put_many(
+        self, model_name: str, hash_to_embedding: Dict[str, List[float]]
+    ) -> None:
+        if not hash_to_embedding:
+            return
+        with self._get_session()() as session:
+            with session.begin():
+                session.execute(self._build_insert(model_name, hash_to_embedding))
+
+    async def aget_many(
+        self, model_name: str, text_hashes: Sequence[str]
+    ) -> Dict[str, List[float]]:
+        if not text_hashes:
+            return {}
+        async with SessionLocal() as session:
+            result = await session.execute(self._build_select(model_name, text_hashes))
+            return {text_hash: list(embedding) for text_hash, embedding in result.all()}
+
+    async def aput_many(
+        self, model_name: str, hash_to_embedding: Dict[str, List[float]]
+    ) -> None:
+        if not hash_to_embedding:
+            return
+        async with SessionLocal() as session:
+            async with session.begin():
+                await session.execute(self._build_insert(model_name, hash_to_embedding))
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU cache of query embeddings with a TTL, keyed by (model name, text hash).
+
+    User questions and generated sub-questions repeat a lot across conversations and
+    are embedded once per document being queried, so this is shared by every retriever
+    in the process.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self._cache: TTLCache = TTLCache(maxsize=max_size, ttl=ttl_seconds)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model_name: str, text_hash: str) -> Optional[List[float]]:
+        with self._lock:
+            embedding = self._cache.get((model_name, text_hash))
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return embedding
+
+    def put(self, model_name: str, text_hash: str, embedding: List[float]) -> None:
+        with self._lock:
+            self._cache[(model_name, text_hash)] = embedding
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._cache),
+                "max_size": int(self._cache.maxsize),
+            }
+
+
+class CachedOpenAIEmbedding(OpenAIEmbedding):
+    """
+    OpenAIEmbedding that looks up all queued texts in the embedding cache in one batch
+    before calling the embedding API, and only embeds texts it hasn't seen before.
+
+    Query embeddings are looked up in the in-process `query_cache` first, and then in
+    `query_cache_store` if one is given.
+
+    Cache failures are logged and fall back to embedding everything.
+    """
+
+    _cache_store: Optional[EmbeddingCacheStore] = PrivateAttr()
+    _query_cache: Optional[QueryEmbeddingCache] = PrivateAttr()
+    _query_cache_store: Optional[EmbeddingCacheStore] = PrivateAttr()
+
+    def __init__(
+        self,
+        cache_store: Optional[EmbeddingCacheStore] = None,
+        query_cache: Optional[QueryEmbeddingCache] = None,
+        query_cache_store: Optional[EmbeddingCacheStore] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._cache_store = cache_store
+        self._query_cache = query_cache
+        self._query_cache_store = query_cache_store
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedOpenAIEmbedding"
+
+    def _lookup(self, text_hashes: List[str]) -> Dict[str, List[float]]:
+        try:
+            return self._cache_store.get_many(self.model_name, text_hashes)
+        except Exception:
+            logger.warning("Failed to read from embedding cache", exc_info=True)
+            return {}
+
+    def _store(self, hash_to_embedding: Dict[str, List[float]]) -> None:
+        try:
+            self._cache_store.put_many(self.model_name, hash_to_embedding)
+        except Exception:
+            logger.warning("Failed to write to embedding cache", exc_info=True)
+
+    async def _alookup(self, text_hashes: List[str]) -> Dict[str, List[float]]:
+        try:
+            return await self._cache_store.aget_many(self.model_name, text_hashes)
+        except Exception:
+            logger.warning("Failed to read from embedding cache", exc_info=True)
+            return {}
+
+    async def _astore(self, hash_to_embedding: Dict[str, List[float]]) -> None:
+        try:
+            await self._cache_store.aput_many(self.model_name, hash_to_embedding)
+        except Exception:
+            logger.warning("Failed to write to embedding cache", exc_info=True)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        if self._query_cache is None:
+            return super()._get_query_embedding(query)
+        text_hash = hash_text(query)
+        embedding = self._query_cache.get(self.model_name, text_hash)
+        if embedding is not None:
+            return embedding
+
+        if self._query_cache_store is not None:
+            try:
+                embedding = self._query_cache_store.get_many(
+                    self.model_name, [text_hash]
+                ).get(text_hash)
+            except Exception:
+                logger.warning("Failed to read from embedding cache", exc_info=True)
+        if embedding is None:
+            embedding = super()._get_query_embedding(query)
+            if self._query_cache_store is not None:
+                try:
+                    self._query_cache_store.put_many(
+                        self.model_name, {text_hash: embedding}
+                    )
+                except Exception:
+                    logger.warning("Failed to write to embedding cache", exc_info=True)
+        self._query_cache.put(self.model_name, text_hash, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        if self._query_cache is None:
+            return await super()._aget_query_embedding(query)
+        text_hash = hash_text(query)
+        embedding = self._query_cache.get(self.model_name, text_hash)
+        if embedding is not None:
+            return embedding
+
+        if self._query_cache_store is not None:
+            try:
+                embedding = (
+                    await self._query_cache_store.aget_many(
+                        self.model_name, [text_hash]
+                    )
+                ).get(text_hash)
+            except Exception:
+                logger.warning("Failed to read from embedding cache", exc_info=True)
+        if embedding is None:
+            embedding = await super()._aget_query_embedding(query)
+            if self._query_cache_store is not None:
+                try:
+                    await self._query_cache_store.aput_many(
+                        self.model_name, {text_hash: embedding}
+                    )
+                except Exception:
+                    logger.warning("Failed to write to embedding cache", exc_info=True)
+        self._query_cache.put(self.model_name, text_hash, embedding)
+        return embedding
+
+    @staticmethod
+    def _get_uncached_queue(
+        text_queue: List[Tuple[str, str]],
+        text_hashes: List[str],
+        known: Dict[str, List[float]],
+    ) -> List[Tuple[str, str]]:
+        """
+        Queue of (text_hash, text) with each distinct uncached text appearing once.
+        """
+        uncached_queue: Dict[str, str] = {}
+        for (_, text), text_hash in zip(text_queue, text_hashes):
+            if text_hash not in known and text_hash not in uncached_queue:
+                uncached_queue[text_hash] = text
+        return list(uncached_queue.items())
+
+    def get_queued_text_embeddings(
+        self, show_progress: bool = False
+    ) -> Tuple[List[str], List[List[float]]]:
+        if self._cache_store is None:
+            return super().get_queued_text_embeddings(show_progress)
+        text_queue = self._text_queue
+        text_hashes = [hash_text(text) for _, text in text_queue]
+        known = self._lookup(text_hashes)
+        self._text_queue = self._get_uncached_queue(text_queue, text_hashes, known)
+        logger.debug(
+            "Embedding cache hit for %d of %d texts",
+            len(text_queue) - len(self._text_queue),
+            len(text_queue),
+        )
+
+        new_hashes, new_embeddings = super().get_queued_text_embeddings(show_progress)
+        new_hash_to_embedding = dict(zip(new_hashes, new_embeddings))
+        self._store(new_hash_to_embedding)
+        known.update(new_hash_to_embedding)
+        return (
+            [text_id for text_id, _ in text_queue],
+            [known[text_hash] for text_hash in text_hashes],
+        )
+
+    async def aget_queued_text_embeddings(
+        self, text_queue: List[Tuple[str, str]], show_progress: bool = False
+    ) -> Tuple[List[str], List[List[float]]]:
+        if self._cache_store is None:
+            return await super().aget_queued_text_embeddings(text_queue, show_progress)
+        text_hashes = [hash_text(text) for _, text in text_queue]
+        known = await self._alookup(text_hashes)
+        uncached_queue = self._get_uncached_queue(text_queue, text_hashes, known)
+
+        new_hashes, new_embeddings = await super().aget_queued_text_embeddings(
+            uncached_queue, show_progress
+        )
+        new_hash_to_embedding = dict(zip(new_hashes, new_embeddings))
+        await self._astore(new_hash_to_embedding)
+        known.update(new_hash_to_embedding)
+        return (
+            [text_id for text_id, _ in text_queue],
+            [known[text_hash] for text_hash in text_hashes],
+        )
+
+
+singleton_instance: Optional[EmbeddingCacheStore] = None
+query_cache_singleton_instance: Optional[QueryEmbeddingCache] = None
+
+
+def get_embedding_cache_store() -> Optional[EmbeddingCacheStore]:
+    global singleton_instance
+    if singleton_instance is None:
+        singleton_instance = EmbeddingCacheStore(
+            settings.DATABASE_URL.replace(
+                "postgresql+asyncpg://", "postgresql+psycopg2://"
+            )
+        )
+    return singleton_instance
+
+
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    global query_cache_singleton_instance
+    if query_cache_singleton_instance is None:
+        query_cache_singleton_instance = QueryEmbeddingCache(
+            max_size=settings.QUERY_EMBEDDING_CACHE_MAX_SIZE,
+            ttl_seconds=settings.QUERY_EMBEDDING_CACHE_TTL_SECONDS,
+        )
+    return query_cache_singleton_instance
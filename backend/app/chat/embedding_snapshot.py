@@ -0,0 +1,203 @@
+"""
+Per-document embedding snapshot files.
+
+A snapshot is written when a document is indexed and holds everything needed to
+search its chunks without Postgres. Snapshots are opened with mmap, so loading
+one doesn't copy it: worker processes on a host share the page cache pages of
+the file, and only the pages that are touched get read from disk.
+
+File layout (little-endian):
+    header       magic, number of chunks, dimensions, table & payload offsets
+    embeddings   float32[num_chunks][dimensions], rows normalized, 64-byte aligned
+    table        (uint64 offset, uint32 length) into the payload per chunk
+    payload      JSON [node_id, text, metadata] per chunk
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from app.chat.hot_documents import (
+    SearchableDocument,
+    normalize_rows,
+    top_k_by_similarity,
+)
+from app.core.config import settings
+from llama_index.schema import BaseNode, MetadataMode
+from llama_index.vector_stores.postgres import DBEmbeddingRow
+from llama_index.vector_stores.utils import node_to_metadata_dict
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SECEMB01"
+HEADER = struct.Struct("<8sIIQQ")
+EMBEDDINGS_OFFSET = 64
+TABLE_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4")])
+
+
+class InvalidSnapshotError(Exception):
+    pass
+
+
+def get_snapshot_path(doc_id: str) -> str:
+    # document ids are file names, so they aren't used as is
+    file_name = hashlib.md5(doc_id.encode("utf-8")).hexdigest() + ".snap"
+    return os.path.join(settings.EMBEDDING_SNAPSHOT_DIR, file_name)
+
+
+def write_snapshot(
+    path: str,
+    node_ids: Sequence[str],
+    texts: Sequence[str],
+    metadatas: Sequence[Dict[str, Any]],
+    embeddings: np.ndarray,
+) -> None:
+    """
+    Write a snapshot atomically, so readers see either the old or the new file.
+    Processes that have the old file mapped keep reading it until they reopen.
+    """
+    if len(node_ids):
+        matrix = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    num_chunks, dimensions = matrix.shape
+    records = [
+        json.dumps([node_id, text, metadata]).encode("utf-8")
+        for node_id, text, metadata in zip(node_ids, texts, metadatas)
+    ]
+    table = np.zeros(num_chunks, dtype=TABLE_DTYPE)
+    offset = 0
+    for i, record in enumerate(records):
+        table[i] = (offset, len(record))
+        offset += len(record)
+    table_offset = EMBEDDINGS_OFFSET + matrix.astype("<f4").nbytes
+    payload_offset = table_offset + table.nbytes
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        header = HEADER.pack(
+            MAGIC, num_chunks, dimensions, table_offset, payload_offset
+        )
+        f.write(header.ljust(EMBEDDINGS_OFFSET, b"\0"))
+        f.write(matrix.astype("<f4").tobytes())
+        f.write(table.tobytes())
+        f.write(b"".join(records))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class EmbeddingSnapshot(SearchableDocument):
+    """
+    A searchable document backed by a memory-mapped snapshot file. Only the
+    embeddings are read up front, the text & metadata of a chunk are decoded when
+    it's returned.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < EMBEDDINGS_OFFSET:
+            raise InvalidSnapshotError(f"{path} is truncated")
+        magic, num_chunks, dimensions, table_offset, payload_offset = HEADER.unpack(
+            self._mmap[: HEADER.size]
+        )
+        if magic != MAGIC:
+            raise InvalidSnapshotError(f"{path} is not an embedding snapshot")
+        if (
+            payload_offset > len(self._mmap)
+            or table_offset + num_chunks * TABLE_DTYPE.itemsize > payload_offset
+        ):
+            raise InvalidSnapshotError(f"{path} is truncated")
+        self._payload_offset = payload_offset
+        self.matrix = np.frombuffer(
+            self._mmap,
+            dtype="<f4",
+            count=num_chunks * dimensions,
+            offset=EMBEDDINGS_OFFSET,
+        ).reshape(num_chunks, dimensions)
+        self._table = np.frombuffer(
+            self._mmap, dtype=TABLE_DTYPE, count=num_chunks, offset=table_offset
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._mmap)
+
+    @property
+    def num_chunks(self) -> int:
+        return len(self._table)
+
+    def get_chunk(self, i: int) -> Tuple[str, str, Dict[str, Any]]:
+        offset, length = self._table[i]
+        start = self._payload_offset + int(offset)
+        node_id, text, metadata = json.loads(self._mmap[start : start + int(length)])
+        return node_id, text, metadata
+
+    @property
+    def node_ids(self) -> List[str]:
+        return [self.get_chunk(i)[0] for i in range(self.num_chunks)]
+
+    def search(self, query_embedding: List[float], top_k: int) -> List[DBEmbeddingRow]:
+        indices, similarities = top_k_by_similarity(self.matrix, query_embedding, top_k)
+        rows = []
+        for i, similarity in zip(indices, similarities):
+            node_id, text, metadata = self.get_chunk(int(i))
+            rows.append(
+                DBEmbeddingRow(
+                    node_id=node_id,
+                    text=text,
+                    metadata=metadata,
+                    similarity=float(similarity),
+                )
+            )
+        return rows
+
+
+def has_document_snapshot(doc_id: str) -> bool:
+    return settings.EMBEDDING_SNAPSHOTS_ENABLED and os.path.exists(
+        get_snapshot_path(doc_id)
+    )
+
+
+def open_document_snapshot(doc_id: str) -> Optional[EmbeddingSnapshot]:
+    if not has_document_snapshot(doc_id):
+        return None
+    path = get_snapshot_path(doc_id)
+    try:
+        return EmbeddingSnapshot(path)
+    except (OSError, ValueError, InvalidSnapshotError):
+        logger.warning("Failed to open embedding snapshot %s", path, exc_info=True)
+        return None
+
+
+def write_document_snapshot(
+    doc_id: str, nodes: Sequence[BaseNode], flat_metadata: bool = False
+) -> None:
+    """
+    Write the snapshot of a document from the embedded nodes that the vector store
+    inserted for it, with the same text & metadata that it keeps for them.
+    """
+    if not settings.EMBEDDING_SNAPSHOTS_ENABLED:
+        return
+    write_snapshot(
+        get_snapshot_path(doc_id),
+        node_ids=[node.node_id for node in nodes],
+        texts=[node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes],
+        metadatas=[
+            node_to_metadata_dict(node, remove_text=True, flat_metadata=flat_metadata)
+            for node in nodes
+        ],
+        embeddings=np.array([node.get_embedding() for node in nodes]),
+    )
+
+
+def delete_document_snapshot(doc_id: str) -> None:
+    path = get_snapshot_path(doc_id)
+    if os.path.exists(path):
+        os.remove(path)
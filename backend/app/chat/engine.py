@@ -1,35 +1,60 @@
+import asyncio
 import json
 import logging
 import os
+import threading
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Sequence, cast
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, cast
 
 import nest_asyncio
+from app.chat.answer_cache import CachedQueryEngine, get_answer_cache
+from app.chat.chat_history import (
+    get_chat_history_builder,
+    get_successful_messages,
+    to_chat_message,
+)
 from app.chat.constants import (
     DB_DOC_ID_KEY,
     NODE_PARSER_CHUNK_OVERLAP,
     NODE_PARSER_CHUNK_SIZE,
     SYSTEM_MESSAGE,
 )
-from app.chat.pg_vector import get_vector_store_singleton
+from app.chat.embedding_cache import (
+    CachedOpenAIEmbedding,
+    get_embedding_cache_store,
+    get_query_embedding_cache,
+)
+from app.chat.embedding_snapshot import (
+    has_document_snapshot,
+    write_document_snapshot,
+)
+from app.chat.hot_documents import get_hot_document_cache
+from app.chat.index_cache import get_document_index_cache
+from app.chat.pg_kvstore import build_pg_storage_context
+from app.chat.pg_vector import CustomPGVectorStore, get_vector_store_singleton
+from app.chat.plan_cache import get_plan_cache, get_plan_key
 from app.chat.qa_response_synth import get_custom_response_synth
-from app.core.config import settings
-from app.models.db import MessageRoleEnum, MessageStatusEnum
+from app.chat.segment_kvstore import (
+    load_append_only_storage_context,
+    persist_incrementally,
+)
+from app.core.config import StorageContextBackend, settings
 from app.schema import Conversation as ConversationSchema
 from app.schema import Document as DocumentSchema
 from app.schema import Message as MessageSchema
-from cachetools import TTLCache, cached
+from cachetools import LRUCache, TTLCache, cached
 from llama_index import (
     ServiceContext,
     StorageContext,
     VectorStoreIndex,
-    load_indices_from_storage,
 )
 from llama_index.agent import OpenAIAgent
 from llama_index.callbacks.base import BaseCallbackHandler, CallbackManager
+from llama_index.chat_engine.types import StreamingAgentChatResponse
+from llama_index.data_structs.data_structs import IndexDict
 from llama_index.embeddings.openai import (
-    OpenAIEmbedding,
     OpenAIEmbeddingMode,
     OpenAIEmbeddingModelType,
 )
@@ -42,34 +67,47 @@ from llama_index.query_engine import SubQuestionQueryEngine
 from llama_index.question_gen.openai_generator import OpenAIQuestionGenerator
 from llama_index.question_gen.types import SubQuestion, SubQuestionList
 from llama_index.readers.file.docs_reader import PDFReader
+from llama_index.schema import BaseNode
 from llama_index.schema import Document as LlamaIndexDocument
 from llama_index.tools import QueryEngineTool, ToolMetadata
 from llama_index.vector_stores.types import (
     ExactMatchFilter,
     MetadataFilters,
+    NodeWithEmbedding,
     VectorStore,
 )
 
 logger = logging.getLogger(__name__)
 
+PERSIST_DIR = "persist"
+UPLOAD_FOLDER = "uploads"
+
 
 logger.info("Applying nested asyncio patch")
 nest_asyncio.apply()
 
 
+def get_document_path(document: DocumentSchema) -> Path:
+    return Path(UPLOAD_FOLDER) / document
+
+
 def fetch_and_read_document(
     document: DocumentSchema,
-) -> List[LlamaIndexDocument]:
+) -> Optional[List[LlamaIndexDocument]]:
+    """
+    Read an uploaded PDF into one LlamaIndexDocument per page.
+
+    Returns None if the document's file doesn't exist. The ingestion worker parses
+    pages across its process pool with app.chat.pdf_reader instead.
+    """
     # Super hacky approach to get this to feature complete on time.
     # TODO: Come up with better abstractions for this and the other methods in this module.
-    UPLOAD_FOLDER = "uploads"
-
-    file_path = Path(UPLOAD_FOLDER) / document
-    if os.path.isfile(file_path):  # 确保是文件而不是子目录
-        with open(file_path, "r") as file:
-            file.seek(0)
-            reader = PDFReader()
-            return reader.load_data(file_path, extra_info={DB_DOC_ID_KEY: document})
+    file_path = get_document_path(document)
+    if not os.path.isfile(file_path):  # 确保是文件而不是子目录
+        return None
+    extra_info = {DB_DOC_ID_KEY: document}
+    reader = PDFReader()
+    return reader.load_data(file_path, extra_info=extra_info)
 
 
 def build_description_for_document(document: DocumentSchema) -> str:
@@ -81,63 +119,212 @@ def index_to_query_engine(doc_id: str, index: VectorStoreIndex) -> BaseQueryEngi
     filters = MetadataFilters(
         filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value=doc_id)]
     )
-    kwargs = {"similarity_top_k": 3, "filters": filters}
+    kwargs = {
+        "similarity_top_k": 3,
+        "filters": filters,
+        "vector_store_kwargs": {
+            "hnsw_ef_search": settings.VECTOR_HNSW_EF_SEARCH,
+            "ivfflat_probes": settings.VECTOR_IVFFLAT_PROBES,
+        },
+    }
     return index.as_query_engine(**kwargs)
 
 
+def get_cached_query_engine(doc_id: str, index: VectorStoreIndex) -> BaseQueryEngine:
+    """
+    Return the query engine for a document, reusing the one cached alongside its index.
+    """
+    index_cache = get_document_index_cache()
+    query_engine = index_cache.get_query_engine(doc_id)
+    if query_engine is None:
+        query_engine = CachedQueryEngine(
+            doc_id, index_to_query_engine(doc_id, index), get_answer_cache()
+        )
+        index_cache.set_query_engine(doc_id, query_engine)
+    return query_engine
+
+
+class DocumentsNotIndexedError(Exception):
+    """
+    Raised when a conversation references documents whose indices have not been built yet.
+    """
+
+    def __init__(self, doc_ids: List[str]):
+        self.doc_ids = doc_ids
+        super().__init__(f"Documents have not been indexed yet: {doc_ids}")
+
+
 @cached(
     TTLCache(maxsize=10, ttl=timedelta(minutes=5).total_seconds()),
     key=lambda *args, **kwargs: "global_storage_context",
+    # storage contexts are loaded in worker threads
+    lock=threading.Lock(),
 )
 def get_storage_context(persist_dir: str, vector_store: VectorStore) -> StorageContext:
     logger.info("Creating new storage context.")
+    if settings.LOCAL_STORAGE_APPEND_ONLY:
+        return load_append_only_storage_context(persist_dir, vector_store)
     return StorageContext.from_defaults(
         persist_dir=persist_dir, vector_store=vector_store
     )
 
 
+@cached(
+    LRUCache(maxsize=1),
+    key=lambda *args, **kwargs: "pg_storage_context",
+    lock=threading.Lock(),
+)
+def get_pg_storage_context(vector_store: VectorStore) -> StorageContext:
+    logger.info("Creating new Postgres storage context.")
+    return build_pg_storage_context(vector_store)
+
+
+def get_or_create_storage_context(vector_store: VectorStore) -> StorageContext:
+    if settings.STORAGE_CONTEXT_BACKEND == StorageContextBackend.POSTGRES:
+        return get_pg_storage_context(vector_store)
+    try:
+        return get_storage_context(PERSIST_DIR, vector_store)
+    except FileNotFoundError:
+        logger.info("Could not find storage context. Creating new storage context.")
+        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        storage_context.persist(persist_dir=PERSIST_DIR)
+        return get_storage_context(PERSIST_DIR, vector_store)
+
+
+def persist_storage_context(storage_context: StorageContext) -> None:
+    if settings.STORAGE_CONTEXT_BACKEND != StorageContextBackend.LOCAL:
+        # the Postgres docstore & index store are written to directly
+        return
+    if settings.LOCAL_STORAGE_APPEND_ONLY:
+        persist_incrementally(
+            storage_context, PERSIST_DIR, settings.LOCAL_STORAGE_COMPACT_BYTES
+        )
+    else:
+        storage_context.persist(persist_dir=PERSIST_DIR)
+
+
 async def build_doc_id_to_index_map(
     service_context: ServiceContext,
     documents: List[DocumentSchema],
 ) -> Dict[str, VectorStoreIndex]:
-    persist_dir = "persist"
+    """
+    Build a map of document id to its index.
+
+    Indices are served from the process-wide document index cache when possible.
+    Cached indices stay bound to the service context they were loaded with, so
+    callers that share them across requests should pass the shared tool service context.
+
+    Raises DocumentsNotIndexedError for documents that have no index in storage yet.
+    Those are built ahead of time by the ingestion worker (see app.chat.ingestion).
+    """
+    index_cache = get_document_index_cache()
+    doc_id_to_index: Dict[str, VectorStoreIndex] = {}
+    uncached_documents = []
+    for doc in documents:
+        index = index_cache.get_index(str(doc))
+        if index is None:
+            uncached_documents.append(doc)
+        else:
+            doc_id_to_index[str(doc)] = index
+    logger.debug("Document index cache stats: %s", index_cache.stats)
+    if not uncached_documents:
+        return doc_id_to_index
 
     vector_store = await get_vector_store_singleton()
-    try:
-        try:
-            storage_context = get_storage_context(persist_dir, vector_store)
-        except FileNotFoundError:
-            logger.info("Could not find storage context. Creating new storage context.")
-            storage_context = StorageContext.from_defaults(vector_store=vector_store)
-            storage_context.persist(persist_dir=persist_dir)
-        index_ids = [doc for doc in documents]
-        indices = load_indices_from_storage(
-            storage_context,
-            index_ids=index_ids,
+    # reading the index structs is blocking I/O with either storage backend, and
+    # VectorStoreIndex writes them back to the index store when it's created
+    loaded_indices, unindexed_doc_ids = await asyncio.to_thread(
+        load_document_indices,
+        service_context,
+        vector_store,
+        [str(doc) for doc in uncached_documents],
+    )
+    for doc_id, index in loaded_indices.items():
+        index_cache.put_index(doc_id, index)
+        doc_id_to_index[doc_id] = index
+    if unindexed_doc_ids:
+        raise DocumentsNotIndexedError(unindexed_doc_ids)
+    logger.debug("Loaded indices from storage.")
+    return {str(doc): doc_id_to_index[str(doc)] for doc in documents}
+
+
+def load_document_indices(
+    service_context: ServiceContext,
+    vector_store: VectorStore,
+    doc_ids: List[str],
+) -> Tuple[Dict[str, VectorStoreIndex], List[str]]:
+    """
+    Load the indices of documents from storage.
+
+    Returns the loaded indices and the ids of the documents that have no index yet.
+    """
+    snapshot_doc_ids = {doc_id for doc_id in doc_ids if has_document_snapshot(doc_id)}
+    if len(snapshot_doc_ids) == len(doc_ids):
+        # the vector store keeps the text of the nodes, so their index structs are
+        # empty and the docstore isn't used, no need to load the storage context
+        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    else:
+        storage_context = get_or_create_storage_context(vector_store)
+    indices: Dict[str, VectorStoreIndex] = {}
+    unindexed_doc_ids = []
+    for doc_id in doc_ids:
+        if doc_id in snapshot_doc_ids:
+            index_struct = IndexDict(index_id=doc_id)
+        else:
+            index_struct = storage_context.index_store.get_index_struct(doc_id)
+        if index_struct is None:
+            unindexed_doc_ids.append(doc_id)
+            continue
+        indices[doc_id] = VectorStoreIndex(
+            index_struct=index_struct,
+            storage_context=storage_context,
             service_context=service_context,
         )
-        doc_id_to_index = dict(zip(index_ids, indices))
-        logger.debug("Loaded indices from storage.")
-    except ValueError:
-        logger.error(
-            "Failed to load indices from storage. Creating new indices.", exc_info=True
-        )
-        storage_context = StorageContext.from_defaults(
-            persist_dir=persist_dir, vector_store=vector_store
+    return indices, unindexed_doc_ids
+
+
+def add_document_index(
+    doc_id: str,
+    documents: List[LlamaIndexDocument],
+    nodes: Sequence[BaseNode],
+    vector_store: VectorStore,
+) -> VectorStoreIndex:
+    """
+    Store the index for a document whose nodes have already been embedded.
+
+    Any chunks stored for a previous version of the document are replaced.
+    """
+    storage_context = get_or_create_storage_context(vector_store)
+    service_context = get_tool_service_context([])
+    pg_vector_store = cast(CustomPGVectorStore, vector_store)
+    pg_vector_store.delete_document_chunks(doc_id)
+    storage_context.docstore.add_documents(documents)
+    for doc in documents:
+        storage_context.docstore.set_document_hash(doc.get_doc_id(), doc.hash)
+    # chunks repeating one of the document (same page & text) aren't inserted
+    inserted_ids = set(
+        pg_vector_store.add(
+            [
+                NodeWithEmbedding(node=node, embedding=node.get_embedding())
+                for node in nodes
+            ]
         )
-        doc_id_to_index = {}
-        for doc in documents:
-            llama_index_docs = fetch_and_read_document(doc)
-            storage_context.docstore.add_documents(llama_index_docs)
-            index = VectorStoreIndex.from_documents(
-                llama_index_docs,
-                storage_context=storage_context,
-                service_context=service_context,
-            )
-            index.set_index_id(str(doc))
-            index.storage_context.persist(persist_dir=persist_dir)
-            doc_id_to_index[str(doc)] = index
-    return doc_id_to_index
+    )
+    nodes = [node for node in nodes if node.node_id in inserted_ids]
+    # the vector store keeps the text of the nodes, so the index struct stays empty
+    index = VectorStoreIndex(
+        nodes=[],
+        storage_context=storage_context,
+        service_context=service_context,
+    )
+    index.set_index_id(doc_id)
+    persist_storage_context(storage_context)
+    write_document_snapshot(doc_id, nodes, pg_vector_store.flat_metadata)
+    get_document_index_cache().invalidate(doc_id)
+    get_answer_cache().invalidate(doc_id)
+    # it may have been reloaded while the new chunks were being inserted
+    get_hot_document_cache().invalidate(doc_id)
+    return index
 
 
 def get_chat_history(
@@ -146,33 +333,54 @@ def get_chat_history(
     """
     Given a list of chat messages, return a list of ChatMessage instances.
 
-    Failed chat messages are filtered out and then the remaining ones are
-    sorted by created_at.
+    Failed chat messages are filtered out, the remaining ones are expected to be
+    ordered by created_at.
     """
-    # pre-process chat messages
-    chat_messages = [
-        m
-        for m in chat_messages
-        if m.content.strip() and m.status == MessageStatusEnum.SUCCESS
-    ]
-    # TODO: could be a source of high CPU utilization
-    chat_messages = sorted(chat_messages, key=lambda m: m.created_at)
-
-    chat_history = []
-    for message in chat_messages:
-        role = (
-            MessageRole.ASSISTANT
-            if message.role == MessageRoleEnum.assistant
-            else MessageRole.USER
-        )
-        chat_history.append(ChatMessage(content=message.content, role=role))
+    return [to_chat_message(m) for m in get_successful_messages(chat_messages)]
 
-    return chat_history
 
+request_callback_handlers: ContextVar[Tuple[BaseCallbackHandler, ...]] = ContextVar(
+    "request_callback_handlers", default=()
+)
 
-def get_tool_service_context(
-    callback_handlers: List[BaseCallbackHandler],
-) -> ServiceContext:
+
+def bind_request_callback_handlers(handlers: List[BaseCallbackHandler]) -> None:
+    """
+    Bind callback handlers to the current request (asyncio task context).
+    Events raised by RequestCallbackManager within this context are sent to them.
+    """
+    request_callback_handlers.set(tuple(handlers))
+
+
+class RequestCallbackManager(CallbackManager):
+    """
+    CallbackManager that dispatches events to the handlers bound to the current request.
+
+    This lets objects built on a shared service context (cached indices, query engines)
+    be reused across conversations while still reporting events to the right
+    conversation's ChatCallbackHandler.
+    """
+
+    def __init__(self, handlers: Optional[List[BaseCallbackHandler]] = None):
+        self._base_handlers: List[BaseCallbackHandler] = []
+        super().__init__(handlers)
+
+    @property
+    def handlers(self) -> List[BaseCallbackHandler]:
+        return self._base_handlers + list(request_callback_handlers.get())
+
+    @handlers.setter
+    def handlers(self, handlers: List[BaseCallbackHandler]) -> None:
+        self._base_handlers = list(handlers)
+
+    def add_handler(self, handler: BaseCallbackHandler) -> None:
+        self._base_handlers.append(handler)
+
+    def remove_handler(self, handler: BaseCallbackHandler) -> None:
+        self._base_handlers.remove(handler)
+
+
+def build_tool_service_context(callback_manager: CallbackManager) -> ServiceContext:
     llm = OpenAI(
         temperature=0,
         model="gpt-3.5-turbo-0613",
@@ -180,8 +388,15 @@ def get_tool_service_context(
         api_key=settings.OPENAI_API_KEY,
         additional_kwargs={"api_key": settings.OPENAI_API_KEY},
     )
-    callback_manager = CallbackManager(callback_handlers)
-    embedding_model = OpenAIEmbedding(
+    embedding_cache_store = get_embedding_cache_store()
+    embedding_model = CachedOpenAIEmbedding(
+        cache_store=embedding_cache_store
+        if settings.EMBEDDING_CACHE_ENABLED
+        else None,
+        query_cache=get_query_embedding_cache(),
+        query_cache_store=embedding_cache_store
+        if settings.QUERY_EMBEDDING_CACHE_PERSISTENT
+        else None,
         mode=OpenAIEmbeddingMode.SIMILARITY_MODE,
         model_type=OpenAIEmbeddingModelType.TEXT_EMBED_ADA_002,
         api_key=settings.OPENAI_API_KEY,
@@ -201,6 +416,25 @@ def get_tool_service_context(
     return service_context
 
 
+def get_tool_service_context(
+    callback_handlers: List[BaseCallbackHandler],
+) -> ServiceContext:
+    return build_tool_service_context(CallbackManager(callback_handlers))
+
+
+@cached(
+    LRUCache(maxsize=1),
+    key=lambda *args, **kwargs: "shared_tool_service_context",
+)
+def get_shared_tool_service_context() -> ServiceContext:
+    """
+    Service context shared by every conversation in this process.
+    Callback events go to whatever handlers are bound via bind_request_callback_handlers.
+    """
+    logger.info("Creating shared tool service context.")
+    return build_tool_service_context(RequestCallbackManager())
+
+
 def build_tools_text(tools: Sequence[ToolMetadata]) -> str:
     tools_dict = {}
     for tool in tools:
@@ -241,13 +475,25 @@ Output the list of sub questions by calling the SubQuestionList function.
 
 
 class COpenAIQuestionGenerator(OpenAIQuestionGenerator):
+    """
+    Question generator that reuses previously generated sub-questions for the same
+    query & tools from the plan cache.
+    """
+
     def generate(
         self, tools: Sequence[ToolMetadata], query: QueryBundle
     ) -> List[SubQuestion]:
         tools_str = build_tools_text(tools)
         query_str = query.query_str
+        plan_cache = get_plan_cache()
+        plan_key = get_plan_key(query_str, tools_str)
+        sub_questions = plan_cache.get(plan_key)
+        if sub_questions is not None:
+            return sub_questions
         question_list = self._program(query_str=query_str, tools_str=tools_str)
         question_list = cast(SubQuestionList, question_list)
+        if question_list.items:
+            plan_cache.put(plan_key, question_list.items)
         return question_list.items
 
     async def agenerate(
@@ -255,25 +501,84 @@ class COpenAIQuestionGenerator(OpenAIQuestionGenerator):
     ) -> List[SubQuestion]:
         tools_str = build_tools_text(tools)
         query_str = query.query_str
+        plan_cache = get_plan_cache()
+        plan_key = get_plan_key(query_str, tools_str)
+        sub_questions = await plan_cache.aget(plan_key)
+        if sub_questions is not None:
+            return sub_questions
         question_list = await self._program.acall(
             query_str=query_str, tools_str=tools_str
         )
         question_list = cast(SubQuestionList, question_list)
+        if question_list.items:
+            await plan_cache.aput(plan_key, question_list.items)
         return question_list.items
 
 
-async def get_chat_engine(
-    callback_handler: BaseCallbackHandler,
+def build_system_message(conversation: ConversationSchema) -> ChatMessage:
+    if conversation.documents:
+        doc_titles = "\n".join(
+            "- " + (doc.split("."))[0] for doc in conversation.documents
+        )
+    else:
+        doc_titles = "No documents selected."
+
+    curr_date = datetime.utcnow().strftime("%Y-%m-%d")
+    return ChatMessage(
+        content=SYSTEM_MESSAGE.format(doc_titles=doc_titles, curr_date=curr_date),
+        role=MessageRole.SYSTEM,
+    )
+
+
+class CancellableOpenAIAgent(OpenAIAgent):
+    """
+    OpenAIAgent that keeps a handle on the tasks in which it streams its responses
+    from OpenAI, so that they can be stopped when the turn is cancelled. Cancelling
+    the task waiting for the agent doesn't stop them.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.response_tasks: Set[asyncio.Task] = set()
+
+    async def _get_async_stream_ai_response(
+        self, **llm_chat_kwargs: Any
+    ) -> StreamingAgentChatResponse:
+        chat_stream_response = StreamingAgentChatResponse(
+            achat_stream=await self._llm.astream_chat(**llm_chat_kwargs),
+            sources=self.sources,
+        )
+        task = asyncio.create_task(
+            chat_stream_response.awrite_response_to_history(self.memory)
+        )
+        self.response_tasks.add(task)
+        task.add_done_callback(self.response_tasks.discard)
+        # wait until openAI functions stop executing
+        await chat_stream_response._is_function_false_event.wait()
+        return chat_stream_response
+
+    def cancel_response_streams(self) -> None:
+        for task in list(self.response_tasks):
+            task.cancel()
+
+
+async def build_chat_engine(
     conversation: ConversationSchema,
-) -> OpenAIAgent:
-    service_context = get_tool_service_context([callback_handler])
+) -> CancellableOpenAIAgent:
+    """
+    Build the chat engine for a conversation.
+
+    Only the parts that depend on the conversation's documents are set up here.
+    Per-turn state (chat history, system prompt) is set by get_chat_engine.
+    """
+    service_context = get_shared_tool_service_context()
     doc_id_to_index = await build_doc_id_to_index_map(
         service_context, conversation.documents
     )
     id_to_doc = {str(doc): (doc.split("."))[0] for doc in conversation.documents}
     vector_query_engine_tools = [
         QueryEngineTool(
-            query_engine=index_to_query_engine(doc_id, index),
+            query_engine=get_cached_query_engine(doc_id, index),
             metadata=ToolMetadata(
                 name=id_to_doc[doc_id],
                 description=build_description_for_document(id_to_doc[doc_id]),
@@ -341,26 +646,80 @@ Any questions about company-related headwinds, tailwinds, risks, sentiments, or
         api_key=settings.OPENAI_API_KEY,
         additional_kwargs={"api_key": settings.OPENAI_API_KEY},
     )
-    chat_messages: List[MessageSchema] = conversation.messages
-    chat_history = get_chat_history(chat_messages)
-    logger.debug("Chat history: %s", chat_history)
-
-    if conversation.documents:
-        doc_titles = "\n".join(
-            "- " + (doc.split("."))[0] for doc in conversation.documents
-        )
-    else:
-        doc_titles = "No documents selected."
-
-    curr_date = datetime.utcnow().strftime("%Y-%m-%d")
-    chat_engine = OpenAIAgent.from_tools(
+    chat_engine = CancellableOpenAIAgent.from_tools(
         tools=top_level_sub_tools,
         llm=chat_llm,
-        chat_history=chat_history,
         verbose=settings.VERBOSE,
-        system_prompt=SYSTEM_MESSAGE.format(doc_titles=doc_titles, curr_date=curr_date),
         callback_manager=service_context.callback_manager,
         max_function_calls=3,
     )
 
     return chat_engine
+
+
+chat_engine_cache: TTLCache = TTLCache(
+    maxsize=settings.CHAT_ENGINE_CACHE_MAX_SIZE,
+    ttl=settings.CHAT_ENGINE_CACHE_TTL_SECONDS,
+)
+chat_engine_cache_lock = threading.Lock()
+
+
+def get_chat_engine_cache_key(
+    conversation: ConversationSchema,
+) -> Optional[Tuple[str, ...]]:
+    if conversation.id is None:
+        return None
+    return (str(conversation.id), *conversation.documents)
+
+
+async def get_chat_engine(
+    callback_handler: BaseCallbackHandler,
+    conversation: ConversationSchema,
+) -> CancellableOpenAIAgent:
+    """
+    Get a chat engine for the next turn of a conversation.
+
+    Chat engines are cached per conversation and checked out for the duration of a
+    turn, so a concurrent turn in the same conversation builds its own engine.
+    Hand the engine back with release_chat_engine once the turn has finished.
+    """
+    bind_request_callback_handlers([callback_handler])
+
+    cache_key = get_chat_engine_cache_key(conversation)
+    chat_engine: Optional[CancellableOpenAIAgent] = None
+    if cache_key is not None:
+        with chat_engine_cache_lock:
+            chat_engine = chat_engine_cache.pop(cache_key, None)
+    index_cache = get_document_index_cache()
+    if chat_engine is not None and not all(
+        str(doc) in index_cache for doc in conversation.documents
+    ):
+        # a document was re-ingested or evicted since this engine was built
+        logger.debug("Discarding cached chat engine with stale document indices.")
+        chat_engine = None
+    if chat_engine is None:
+        chat_engine = await build_chat_engine(conversation)
+    else:
+        logger.debug("Reusing cached chat engine for conversation %s", cache_key[0])
+
+    chat_history = await get_chat_history_builder().abuild(conversation)
+    logger.debug("Chat history: %s", chat_history)
+    chat_engine.memory.set(chat_history)
+    chat_engine.prefix_messages = [build_system_message(conversation)]
+    chat_engine.sources = []
+
+    return chat_engine
+
+
+def release_chat_engine(
+    conversation: ConversationSchema, chat_engine: CancellableOpenAIAgent
+) -> None:
+    """
+    Return a chat engine checked out by get_chat_engine to the cache.
+    Entries that are not checked out again within the TTL expire.
+    """
+    cache_key = get_chat_engine_cache_key(conversation)
+    if cache_key is None:
+        return
+    with chat_engine_cache_lock:
+        chat_engine_cache[cache_key] = chat_engine
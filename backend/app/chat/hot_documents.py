@@ -0,0 +1,262 @@
+"""
+In-process similarity search for frequently queried documents.
+
+The chunk embeddings of a hot document are kept in a contiguous float32 matrix
+whose rows are normalized once, so the cosine similarity to every chunk is one
+matrix-vector product and top-k is an argpartition over the result. Documents
+are only admitted once they've been queried a few times, and the cache is kept
+within a memory budget by evicting the least frequently queried documents.
+"""
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from app.core.config import settings
+from cachetools import LRUCache
+from llama_index.vector_stores.postgres import DBEmbeddingRow
+
+logger = logging.getLogger(__name__)
+
+# number of documents whose access frequency is tracked
+MAX_TRACKED_DOCUMENTS = 4096
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k_by_similarity(
+    matrix: np.ndarray, query_embedding: List[float], top_k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Indices and cosine similarities of the top_k rows of a row-normalized matrix
+    that are most similar to the query, most similar first.
+    """
+    if len(matrix) == 0 or top_k <= 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query_norm = np.linalg.norm(query)
+    if query_norm > 0:
+        query = query / query_norm
+    similarities = matrix @ query
+    top_k = min(top_k, len(similarities))
+    if top_k < len(similarities):
+        indices = np.argpartition(-similarities, top_k - 1)[:top_k]
+    else:
+        indices = np.arange(len(similarities))
+    indices = indices[np.argsort(-similarities[indices])]
+    return indices, similarities[indices]
+
+
+class SearchableDocument(ABC):
+    """
+    The chunks of a single document, searchable in process.
+    """
+
+    @property
+    @abstractmethod
+    def nbytes(self) -> int:
+        """
+        Memory used by the document, counted against the cache's budget.
+        """
+
+    @property
+    @abstractmethod
+    def num_chunks(self) -> int:
+        pass
+
+    @abstractmethod
+    def search(self, query_embedding: List[float], top_k: int) -> List[DBEmbeddingRow]:
+        """
+        The top_k chunks most similar to the query, most similar first.
+        """
+
+
+class HotDocument(SearchableDocument):
+    """
+    The chunks of a single document with their normalized embeddings.
+    """
+
+    def __init__(
+        self,
+        node_ids: List[str],
+        texts: List[str],
+        metadatas: List[Dict[str, Any]],
+        embeddings: np.ndarray,
+    ):
+        self.node_ids = node_ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.matrix = np.ascontiguousarray(
+            normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        )
+
+    @property
+    def nbytes(self) -> int:
+        # the texts make up most of the rest, metadata is left out
+        return self.matrix.nbytes + sum(len(text) for text in self.texts)
+
+    @property
+    def num_chunks(self) -> int:
+        return len(self.node_ids)
+
+    def search(self, query_embedding: List[float], top_k: int) -> List[DBEmbeddingRow]:
+        indices, similarities = top_k_by_similarity(self.matrix, query_embedding, top_k)
+        return [
+            DBEmbeddingRow(
+                node_id=self.node_ids[i],
+                text=self.texts[i],
+                metadata=self.metadatas[i],
+                similarity=float(similarity),
+            )
+            for i, similarity in zip(indices, similarities)
+        ]
+
+
+class HotDocumentCache:
+    """
+    Memory-budgeted cache of SearchableDocuments.
+
+    A document is worth loading once it has been queried `min_accesses` times. It
+    only replaces cached documents that have been queried less often than itself.
+    """
+
+    def __init__(self, memory_budget_bytes: int, min_accesses: int):
+        self._memory_budget_bytes = memory_budget_bytes
+        self._min_accesses = min_accesses
+        self._documents: Dict[str, SearchableDocument] = {}
+        self._frequencies: LRUCache = LRUCache(maxsize=MAX_TRACKED_DOCUMENTS)
+        # doc id -> its generation when loading started
+        self._loading: Dict[str, int] = {}
+        # bumped when a document is invalidated, so loads that started before are
+        # not admitted
+        self._generations: Dict[str, int] = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, doc_id: str) -> Optional[SearchableDocument]:
+        """
+        Get a cached document, counting this as an access to it.
+        """
+        with self._lock:
+            self._frequencies[doc_id] = self._frequencies.get(doc_id, 0) + 1
+            document = self._documents.get(doc_id)
+            if document is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return document
+
+    def start_loading(self, doc_id: str, min_accesses: Optional[int] = None) -> bool:
+        """
+        Whether a missed document should be loaded now. Callers that get True must
+        call admit or finish_loading afterwards. If the document is invalidated in
+        the meantime, the loaded copy won't be admitted.
+        """
+        if min_accesses is None:
+            min_accesses = self._min_accesses
+        with self._lock:
+            if (
+                doc_id in self._documents
+                or doc_id in self._loading
+                or self._frequencies.get(doc_id, 0) < min_accesses
+            ):
+                return False
+            self._loading[doc_id] = self._generations.get(doc_id, 0)
+            return True
+
+    def finish_loading(self, doc_id: str) -> None:
+        with self._lock:
+            self._loading.pop(doc_id, None)
+
+    def admit(self, doc_id: str, document: SearchableDocument) -> bool:
+        """
+        Add a document if it fits in the memory budget, possibly after evicting less
+        frequently queried documents. Returns whether it was added. A cached copy of
+        the document is only replaced if the new one is added.
+        """
+        with self._lock:
+            generation = self._loading.pop(doc_id, None)
+            if generation is not None and generation != self._generations.get(
+                doc_id, 0
+            ):
+                # loaded before the document was invalidated
+                return False
+            if document.nbytes > self._memory_budget_bytes:
+                return False
+            frequency = self._frequencies.get(doc_id, 0)
+            victims = sorted(
+                (key for key in self._documents if key != doc_id),
+                key=lambda key: self._frequencies.get(key, 0),
+            )
+            current = self._documents.get(doc_id)
+            freed = current.nbytes if current is not None else 0
+            evicted = []
+            for victim in victims:
+                if self._nbytes - freed + document.nbytes <= self._memory_budget_bytes:
+                    break
+                if self._frequencies.get(victim, 0) >= frequency:
+                    return False
+                freed += self._documents[victim].nbytes
+                evicted.append(victim)
+            self._remove(doc_id)
+            for victim in evicted:
+                self._remove(victim)
+            self._documents[doc_id] = document
+            self._nbytes += document.nbytes
+        logger.info(
+            "Loaded hot document %s (%d chunks, %d bytes), evicted %d",
+            doc_id,
+            document.num_chunks,
+            document.nbytes,
+            len(evicted),
+        )
+        return True
+
+    def _remove(self, doc_id: str) -> None:
+        document = self._documents.pop(doc_id, None)
+        if document is not None:
+            self._nbytes -= document.nbytes
+
+    def invalidate(self, doc_id: str) -> None:
+        """
+        Drop a document, e.g. because its chunks were replaced, along with any copy
+        of it that is still being loaded.
+        """
+        with self._lock:
+            self._generations[doc_id] = self._generations.get(doc_id, 0) + 1
+            self._remove(doc_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._documents.clear()
+            self._nbytes = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._documents),
+                "bytes": self._nbytes,
+            }
+
+
+singleton_instance: Optional[HotDocumentCache] = None
+
+
+def get_hot_document_cache() -> HotDocumentCache:
+    global singleton_instance
+    if singleton_instance is None:
+        singleton_instance = HotDocumentCache(
+            memory_budget_bytes=settings.HOT_DOCUMENT_CACHE_MAX_BYTES,
+            min_accesses=settings.HOT_DOCUMENT_CACHE_MIN_ACCESSES,
+        )
+    return singleton_instance
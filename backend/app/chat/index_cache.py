@@ -0,0 +1,133 @@
+"""
+Process-wide cache of per-document indices and the query engines built on top of them.
+"""
+import json
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+from app.core.config import settings
+from cachetools import LRUCache
+from llama_index import VectorStoreIndex
+from llama_index.indices.query.base import BaseQueryEngine
+
+logger = logging.getLogger(__name__)
+
+# Rough allowance for the python objects hanging off of a cached index
+# (retriever, response synthesizer, query engine) on top of its index struct.
+INDEX_ENTRY_OVERHEAD_BYTES = 16 * 1024
+
+
+def estimate_index_size(index: VectorStoreIndex) -> int:
+    """
+    Estimate how many bytes an index keeps in memory.
+
+    The embeddings and node text live in the vector store, so the in-process
+    footprint of an index is dominated by its index struct (the node id map).
+    """
+    return len(json.dumps(index.index_struct.to_dict())) + INDEX_ENTRY_OVERHEAD_BYTES
+
+
+@dataclass
+class CachedDocumentIndex:
+    index: VectorStoreIndex
+    size_bytes: int
+    query_engine: Optional[BaseQueryEngine] = None
+
+
+class DocumentIndexCache:
+    """
+    LRU cache of VectorStoreIndex objects (and their query engines) keyed by document id.
+
+    Entries are evicted least-recently-used first once the estimated size of all
+    cached entries exceeds `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        size_fn: Callable[[Any], int] = estimate_index_size,
+    ):
+        self._size_fn = size_fn
+        self._cache: LRUCache = LRUCache(
+            maxsize=max_bytes, getsizeof=lambda entry: entry.size_bytes
+        )
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_index(self, doc_id: str) -> Optional[VectorStoreIndex]:
+        with self._lock:
+            entry: Optional[CachedDocumentIndex] = self._cache.get(doc_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry.index
+
+    def put_index(self, doc_id: str, index: VectorStoreIndex) -> None:
+        entry = CachedDocumentIndex(index=index, size_bytes=self._size_fn(index))
+        with self._lock:
+            try:
+                self._cache[doc_id] = entry
+            except ValueError:
+                # entry alone is larger than the whole budget
+                logger.warning(
+                    "Index for document %s (%d bytes) exceeds the cache budget. Not caching.",
+                    doc_id,
+                    entry.size_bytes,
+                )
+
+    def get_query_engine(self, doc_id: str) -> Optional[BaseQueryEngine]:
+        with self._lock:
+            entry: Optional[CachedDocumentIndex] = self._cache.get(doc_id)
+            return entry.query_engine if entry is not None else None
+
+    def set_query_engine(self, doc_id: str, query_engine: BaseQueryEngine) -> None:
+        with self._lock:
+            entry: Optional[CachedDocumentIndex] = self._cache.get(doc_id)
+            if entry is not None:
+                entry.query_engine = query_engine
+
+    def invalidate(self, doc_id: str) -> bool:
+        """
+        Drop the cached index for a document, e.g. because it was re-ingested.
+        Returns True if there was an entry to drop.
+        """
+        with self._lock:
+            entry = self._cache.pop(doc_id, None)
+        if entry is not None:
+            logger.info("Invalidated cached index for document %s", doc_id)
+        return entry is not None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def __contains__(self, doc_id: str) -> bool:
+        with self._lock:
+            return doc_id in self._cache
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._cache),
+                "size_bytes": int(self._cache.currsize),
+                "max_bytes": int(self._cache.maxsize),
+            }
+
+
+singleton_instance: Optional[DocumentIndexCache] = None
+
+
+def get_document_index_cache() -> DocumentIndexCache:
+    global singleton_instance
+    if singleton_instance is None:
+        singleton_instance = DocumentIndexCache(
+            max_bytes=settings.DOCUMENT_INDEX_CACHE_MAX_BYTES
+        )
+    return singleton_instance
@@ -0,0 +1,270 @@
+"""
+Background ingestion of uploaded documents.
+
+Parsing a PDF and embedding its chunks is CPU and network heavy, so it is done in a
+process pool ahead of time instead of inside the chat request that first needs the
+document's index.
+"""
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, List, Optional, Sequence, Set
+
+from app.chat.constants import DB_DOC_ID_KEY
+from app.chat.engine import (
+    add_document_index,
+    get_document_path,
+    get_tool_service_context,
+)
+from app.chat.pdf_reader import aiter_pdf_pages
+from app.chat.pg_vector import get_vector_store_singleton
+from app.core.config import settings
+from cachetools import TTLCache
+from llama_index.schema import BaseNode
+from llama_index.schema import Document as LlamaIndexDocument
+from llama_index.schema import MetadataMode
+
+logger = logging.getLogger(__name__)
+
+# finished jobs are kept around this long for status queries
+FINISHED_JOB_TTL_SECONDS = 60 * 60
+MAX_FINISHED_JOBS = 1024
+
+
+class IngestionStatusEnum(str, Enum):
+    QUEUED = "QUEUED"
+    PARSING = "PARSING"
+    EMBEDDING = "EMBEDDING"
+    READY = "READY"
+    ERROR = "ERROR"
+
+
+@dataclass
+class IngestionJob:
+    doc_id: str
+    ready: asyncio.Future
+    status: IngestionStatusEnum = IngestionStatusEnum.QUEUED
+    error: Optional[str] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def is_done(self) -> bool:
+        return self.status in (IngestionStatusEnum.READY, IngestionStatusEnum.ERROR)
+
+
+def embed_documents(documents: List[LlamaIndexDocument]) -> List[BaseNode]:
+    """
+    Split documents into nodes and set the embedding on each node.
+    Mostly waits on the embedding API, so this runs in a thread rather than in the
+    process pool used for parsing.
+    """
+    service_context = get_tool_service_context([])
+    nodes = service_context.node_parser.get_nodes_from_documents(documents)
+    embed_model = service_context.embed_model
+    for node in nodes:
+        embed_model.queue_text_for_embedding(
+            node.node_id, node.get_content(metadata_mode=MetadataMode.EMBED)
+        )
+    node_ids, embeddings = embed_model.get_queued_text_embeddings()
+    node_id_to_embedding = dict(zip(node_ids, embeddings))
+    for node in nodes:
+        node.embedding = node_id_to_embedding[node.node_id]
+    return nodes
+
+
+class DocumentIngestionError(Exception):
+    """
+    Raised when documents that are waited on fail to be indexed.
+    """
+
+    def __init__(self, doc_id_to_error: Dict[str, Optional[str]]):
+        self.doc_id_to_error = doc_id_to_error
+        super().__init__(f"Documents could not be indexed: {doc_id_to_error}")
+
+
+class IngestionWorker:
+    """
+    Async job API in front of a process pool that indexes documents.
+
+    Jobs are tracked per document id, with at most one of them indexing a document
+    at a time. Pages are parsed in parallel across the worker
+    processes and handed off in batches to be chunked & embedded as soon as they are
+    parsed. The resulting nodes are written to the vector store and storage context
+    by this process, one document at a time.
+    """
+
+    def __init__(self, max_workers: int):
+        self._max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # queued & running jobs, the most recently submitted one per document
+        self._jobs: Dict[str, IngestionJob] = {}
+        self._finished_jobs: TTLCache = TTLCache(
+            maxsize=MAX_FINISHED_JOBS, ttl=FINISHED_JOB_TTL_SECONDS
+        )
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+
+    def start(self) -> None:
+        if self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            # don't fork the event loop & DB connection pool of the API process
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self._semaphore = asyncio.Semaphore(self._max_workers)
+        self._write_lock = asyncio.Lock()
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def get_job(self, doc_id: str) -> Optional[IngestionJob]:
+        job = self._jobs.get(doc_id)
+        if job is None:
+            job = self._finished_jobs.get(doc_id)
+        return job
+
+    def get_status(self, doc_id: str) -> Optional[IngestionStatusEnum]:
+        job = self.get_job(doc_id)
+        return job.status if job is not None else None
+
+    def submit(self, doc_id: str, force: bool = False) -> IngestionJob:
+        """
+        Queue a document for indexing.
+
+        Returns the existing job if the document is already queued, in progress or
+        ready, unless `force` is set (e.g. because the document was re-uploaded).
+        A forced job starts once the document's current job has finished, since
+        that one can't be interrupted while it's writing the index.
+        """
+        self.start()
+        job = self.get_job(doc_id)
+        if job is not None and not force and job.status != IngestionStatusEnum.ERROR:
+            return job
+
+        previous_job = self._jobs.get(doc_id)
+        loop = asyncio.get_running_loop()
+        job = IngestionJob(doc_id=doc_id, ready=loop.create_future())
+        self._jobs[doc_id] = job
+        job.task = asyncio.create_task(self._run(job, previous_job))
+        self._tasks.add(job.task)
+        job.task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _wait_for_document(self, doc_id: str) -> Optional[IngestionJob]:
+        """
+        Wait for the document's current job, following the jobs submitted after it.
+        Returns the last of them.
+        """
+        job = self.get_job(doc_id)
+        while job is not None:
+            await asyncio.shield(job.ready)
+            current_job = self.get_job(doc_id)
+            if current_job is None or current_job is job:
+                return job
+            job = current_job
+        return None
+
+    async def wait_until_ready(
+        self, doc_ids: Sequence[str], timeout: Optional[float] = None
+    ) -> bool:
+        """
+        Queue any of the given documents that aren't yet and wait for all of them.
+        Returns False if they aren't all done within the timeout.
+
+        Raises DocumentIngestionError if any of them failed to be indexed.
+        """
+        for doc_id in doc_ids:
+            self.submit(doc_id)
+        try:
+            jobs = await asyncio.wait_for(
+                asyncio.gather(
+                    *(self._wait_for_document(doc_id) for doc_id in doc_ids)
+                ),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            return False
+        doc_id_to_error = {
+            doc_id: job.error if job is not None else "Ingestion job was lost"
+            for doc_id, job in zip(doc_ids, jobs)
+            if job is None or job.status != IngestionStatusEnum.READY
+        }
+        if doc_id_to_error:
+            raise DocumentIngestionError(doc_id_to_error)
+        return True
+
+    async def _run(
+        self, job: IngestionJob, previous_job: Optional[IngestionJob] = None
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            if previous_job is not None:
+                await asyncio.shield(previous_job.ready)
+            file_path = get_document_path(job.doc_id)
+            if not file_path.is_file():
+                raise FileNotFoundError(f"Could not read document {job.doc_id}")
+            async with self._semaphore:
+                job.status = IngestionStatusEnum.PARSING
+                documents: List[LlamaIndexDocument] = []
+                embed_futures = []
+                batch: List[LlamaIndexDocument] = []
+                async for page in aiter_pdf_pages(
+                    file_path, self._executor, extra_info={DB_DOC_ID_KEY: job.doc_id}
+                ):
+                    documents.append(page)
+                    batch.append(page)
+                    if len(batch) >= settings.INGESTION_EMBED_BATCH_PAGES:
+                        embed_futures.append(
+                            loop.run_in_executor(None, embed_documents, batch)
+                        )
+                        batch = []
+                if batch:
+                    embed_futures.append(
+                        loop.run_in_executor(None, embed_documents, batch)
+                    )
+                job.status = IngestionStatusEnum.EMBEDDING
+                nodes = [
+                    node
+                    for batch_nodes in await asyncio.gather(*embed_futures)
+                    for node in batch_nodes
+                ]
+            vector_store = await get_vector_store_singleton()
+            async with self._write_lock:
+                await loop.run_in_executor(
+                    None, add_document_index, job.doc_id, documents, nodes, vector_store
+                )
+            job.status = IngestionStatusEnum.READY
+            logger.info("Indexed document %s", job.doc_id)
+        except asyncio.CancelledError:
+            job.status = IngestionStatusEnum.ERROR
+            job.error = "Ingestion was cancelled"
+            raise
+        except Exception as e:
+            logger.error("Failed to index document %s", job.doc_id, exc_info=True)
+            job.status = IngestionStatusEnum.ERROR
+            job.error = str(e)
+        finally:
+            if self._jobs.get(job.doc_id) is job:
+                del self._jobs[job.doc_id]
+                self._finished_jobs[job.doc_id] = job
+            if not job.ready.done():
+                job.ready.set_result(job.status)
+
+
+singleton_instance: Optional[IngestionWorker] = None
+
+
+def get_ingestion_worker() -> IngestionWorker:
+    global singleton_instance
+    if singleton_instance is None:
+        singleton_instance = IngestionWorker(max_workers=settings.INGESTION_MAX_WORKERS)
+    return singleton_instance
@@ -0,0 +1,296 @@
+"""
+Encoding of the assistant message as it is streamed to the client.
+
+Updates from the chat engine are coalesced: a new event is sent at most every
+flush interval or every few tokens, and right away when a sub-process starts or
+finishes. In delta mode, only the text appended to the message and the
+sub-processes that changed are sent, instead of re-serializing the whole message.
+
+With latest-state delivery, the chat engine never waits for a slow client: only
+the newest content of the message is kept until the client is ready for it,
+while every sub-process update is still delivered.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+import anyio
+from anyio.streams.memory import MemoryObjectSendStream
+
+from app import schema
+from app.models.db import Message
+
+logger = logging.getLogger(__name__)
+
+
+class StreamFlushPolicy:
+    """
+    Decides when the pending updates to a streamed message are sent as one event:
+    when `interval_seconds` have passed since the previous event, once `max_tokens`
+    content updates are pending, or right away for urgent updates.
+    """
+
+    def __init__(
+        self,
+        interval_seconds: float,
+        max_tokens: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._interval_seconds = interval_seconds
+        self._max_tokens = max_tokens
+        self._clock = clock
+        self._last_flush: Optional[float] = None
+        self._pending_tokens = 0
+        self._pending = False
+        self._urgent = False
+
+    def add(self, is_token: bool = False, urgent: bool = False) -> None:
+        self._pending = True
+        self._urgent = self._urgent or urgent
+        if is_token:
+            self._pending_tokens += 1
+
+    def seconds_until_flush(self) -> Optional[float]:
+        """
+        How long the pending updates can wait for more to merge with them, None if
+        there are none.
+        """
+        if not self._pending:
+            return None
+        if self._urgent or self._last_flush is None:
+            return 0
+        return max(0, self._last_flush + self._interval_seconds - self._clock())
+
+    def should_flush(self) -> bool:
+        return self._pending and (
+            self._pending_tokens >= self._max_tokens or self.seconds_until_flush() == 0
+        )
+
+    def flushed(self) -> None:
+        self._last_flush = self._clock()
+        self._pending_tokens = 0
+        self._pending = False
+        self._urgent = False
+
+
+class MessageDeltaEncoder:
+    """
+    Turns successive states of a message into SSE events: a "snapshot" with the
+    full message at the start and every `snapshot_interval` events, and "delta"
+    events in between.
+
+    Expects the content to only be appended to and sub-processes to only be added or
+    replaced in place. A full snapshot is sent whenever that isn't the case.
+    """
+
+    def __init__(self, snapshot_interval: int):
+        self._snapshot_interval = snapshot_interval
+        self._events_since_snapshot: Optional[int] = None
+        self._sent_content = ""
+        # the sub-process objects as of the last event, to detect replaced ones
+        self._sent_sub_processes: List[object] = []
+
+    def _mark_sent(self, message: Message) -> None:
+        self._sent_content = message.content
+        self._sent_sub_processes = list(message.sub_processes)
+
+    def snapshot(self, message: Message) -> Dict[str, str]:
+        self._events_since_snapshot = 0
+        self._mark_sent(message)
+        return {"event": "snapshot", "data": schema.Message.from_orm(message).json()}
+
+    def encode(self, message: Message) -> Dict[str, str]:
+        if (
+            self._events_since_snapshot is None
+            or self._events_since_snapshot >= self._snapshot_interval
+            or not message.content.startswith(self._sent_content)
+            or len(message.sub_processes) < len(self._sent_sub_processes)
+        ):
+            return self.snapshot(message)
+
+        sub_process_deltas = [
+            schema.MessageSubProcessDelta(
+                index=index, sub_process=schema.MessageSubProcess.from_orm(sub_process)
+            )
+            for index, sub_process in enumerate(message.sub_processes)
+            if index >= len(self._sent_sub_processes)
+            or sub_process is not self._sent_sub_processes[index]
+        ]
+        delta = schema.MessageDelta(
+            id=message.id,
+            content_offset=len(self._sent_content),
+            content_append=message.content[len(self._sent_content) :],
+            sub_processes=sub_process_deltas,
+        )
+        self._events_since_snapshot += 1
+        self._mark_sent(message)
+        return {"event": "delta", "data": delta.json()}
+
+
+class _LatestStateBuffer:
+    def __init__(self, is_replaceable: Callable[[Any], bool]):
+        self._is_replaceable = is_replaceable
+        # items that are all delivered, in order
+        self._queue: Deque[Any] = deque()
+        # the newest replaceable item that hasn't been delivered yet
+        self._latest: Any = None
+        self._has_latest = False
+        self._ready = asyncio.Event()
+        self.send_closed = False
+        self.receive_closed = False
+        self.sent = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def put(self, item: Any) -> None:
+        if self.send_closed:
+            raise anyio.ClosedResourceError
+        if self.receive_closed:
+            raise anyio.BrokenResourceError
+        self.sent += 1
+        if self._is_replaceable(item):
+            if self._has_latest:
+                self.dropped += 1
+            self._latest = item
+            self._has_latest = True
+        else:
+            self._queue.append(item)
+        self._ready.set()
+
+    async def get(self) -> Any:
+        while True:
+            if self._queue:
+                item = self._queue.popleft()
+            elif self._has_latest:
+                item = self._latest
+                self._latest = None
+                self._has_latest = False
+            elif self.send_closed:
+                raise anyio.EndOfStream
+            else:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            self.delivered += 1
+            return item
+
+    def close_send(self) -> None:
+        self.send_closed = True
+        self._ready.set()
+
+
+class LatestStateSendStream:
+    """
+    Send side of a latest-state stream. Has the parts of the MemoryObjectSendStream
+    interface that the chat engine uses, but sending never waits.
+    """
+
+    def __init__(self, buffer: _LatestStateBuffer):
+        self._buffer = buffer
+
+    @property
+    def _closed(self) -> bool:
+        return self._buffer.send_closed
+
+    def send_nowait(self, item: Any) -> None:
+        self._buffer.put(item)
+
+    async def send(self, item: Any) -> None:
+        self._buffer.put(item)
+
+    def close(self) -> None:
+        self._buffer.close_send()
+
+    async def aclose(self) -> None:
+        self.close()
+
+    async def __aenter__(self) -> "LatestStateSendStream":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.close()
+
+
+class LatestStateReceiveStream:
+    """
+    Receive side of a latest-state stream. Replaceable items that were superseded
+    before they were received are dropped and counted in `stats`.
+    """
+
+    def __init__(self, buffer: _LatestStateBuffer):
+        self._buffer = buffer
+
+    async def receive(self) -> Any:
+        return await self._buffer.get()
+
+    def close(self) -> None:
+        self._buffer.receive_closed = True
+
+    async def aclose(self) -> None:
+        self.close()
+
+    def __aiter__(self) -> "LatestStateReceiveStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return await self.receive()
+        except anyio.EndOfStream:
+            raise StopAsyncIteration
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sent": self._buffer.sent,
+            "delivered": self._buffer.delivered,
+            "dropped": self._buffer.dropped,
+        }
+
+
+MessageSendStream = Union[MemoryObjectSendStream, LatestStateSendStream]
+
+
+def create_latest_state_stream(
+    is_replaceable: Callable[[Any], bool]
+) -> Tuple[LatestStateSendStream, LatestStateReceiveStream]:
+    """
+    Create a stream that keeps every item except for those that `is_replaceable`,
+    of which only the newest one is kept until it's received.
+    """
+    buffer = _LatestStateBuffer(is_replaceable)
+    return LatestStateSendStream(buffer), LatestStateReceiveStream(buffer)
+
+
+class StreamDeliveryMetrics:
+    """
+    Process-wide totals of the latest-state streams, to see how many intermediate
+    message updates slow clients skip.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {"streams": 0, "sent": 0, "delivered": 0, "dropped": 0}
+
+    def record(self, stream_stats: Dict[str, int]) -> None:
+        with self._lock:
+            self._totals["streams"] += 1
+            for key in ("sent", "delivered", "dropped"):
+                self._totals[key] += stream_stats[key]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._totals)
+
+
+singleton_instance: Optional[StreamDeliveryMetrics] = None
+
+
+def get_stream_delivery_metrics() -> StreamDeliveryMetrics:
+    global singleton_instance
+    if singleton_instance is None:
+        singleton_instance = StreamDeliveryMetrics()
+    return singleton_instance
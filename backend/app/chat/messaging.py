@@ -3,7 +3,6 @@ import asyncio
 import queue
 import logging
 from uuid import uuid4
-from anyio.streams.memory import MemoryObjectSendStream
 
 from llama_index.callbacks.base import BaseCallbackHandler
 from llama_index.callbacks.schema import CBEventType, EventPayload
@@ -14,7 +13,15 @@ from pydantic import BaseModel
 from app import schema
 from app.schema import SubProcessMetadataKeysEnum, SubProcessMetadataMap
 from app.models.db import MessageSubProcessSourceEnum
-from app.chat.engine import get_chat_engine
+from app.chat.engine import (
+    CancellableOpenAIAgent,
+    DocumentsNotIndexedError,
+    get_chat_engine,
+    release_chat_engine,
+)
+from app.chat.ingestion import DocumentIngestionError, get_ingestion_worker
+from app.chat.message_stream import MessageSendStream
+from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +40,7 @@ class StreamedMessageSubProcess(BaseModel):
 class ChatCallbackHandler(BaseCallbackHandler):
     def __init__(
         self,
-        send_chan: MemoryObjectSendStream,
+        send_chan: MessageSendStream,
     ):
         """Initialize the base callback handler."""
         ignored_events = [CBEventType.CHUNKING, CBEventType.NODE_PARSING]
@@ -125,41 +132,78 @@ class ChatCallbackHandler(BaseCallbackHandler):
 async def handle_chat_message(
     conversation: schema.Conversation,
     user_message: schema.UserMessageCreate,
-    send_chan: MemoryObjectSendStream,
+    send_chan: MessageSendStream,
 ) -> None:
     async with send_chan:
-        chat_engine = await get_chat_engine(
-            ChatCallbackHandler(send_chan), conversation
-        )
-        await send_chan.send(
-            StreamedMessageSubProcess(
-                event_id=str(uuid4()),
-                has_ended=True,
-                source=MessageSubProcessSourceEnum.CONSTRUCTED_QUERY_ENGINE,
+        callback_handler = ChatCallbackHandler(send_chan)
+        chat_engine: Optional[CancellableOpenAIAgent] = None
+        try:
+            try:
+                chat_engine = await get_chat_engine(callback_handler, conversation)
+            except DocumentsNotIndexedError as e:
+                logger.info("Waiting for documents to be indexed: %s", e.doc_ids)
+                try:
+                    is_ready = await get_ingestion_worker().wait_until_ready(
+                        e.doc_ids, timeout=settings.INGESTION_WAIT_TIMEOUT_SECONDS
+                    )
+                except DocumentIngestionError as ingestion_error:
+                    # stored with the failed message, retried on the next message
+                    failures = "; ".join(
+                        f"{doc_id}: {error}"
+                        for doc_id, error in ingestion_error.doc_id_to_error.items()
+                    )
+                    await send_chan.send(
+                        StreamedMessage(
+                            content=f"The selected documents could not be indexed. {failures}"
+                        )
+                    )
+                    raise
+                if not is_ready:
+                    # answered like any other message, so the notice is shown
+                    await send_chan.send(
+                        StreamedMessage(
+                            content="The selected documents are still being indexed. Please try again in a minute."
+                        )
+                    )
+                    return
+                chat_engine = await get_chat_engine(callback_handler, conversation)
+            await send_chan.send(
+                StreamedMessageSubProcess(
+                    event_id=str(uuid4()),
+                    has_ended=True,
+                    source=MessageSubProcessSourceEnum.CONSTRUCTED_QUERY_ENGINE,
+                )
             )
-        )
-        logger.debug("Engine received")
-        templated_message = f"""
+            logger.debug("Engine received")
+            templated_message = f"""
 Remember - if I have asked a relevant financial question, use your tools.
 
 {user_message.content}
-        """.strip()
-        streaming_chat_response: StreamingAgentChatResponse = (
-            await chat_engine.astream_chat(templated_message)
-        )
-        response_str = ""
-        async for text in streaming_chat_response.async_response_gen():
-            response_str += text
-            if send_chan._closed:
-                logger.debug(
-                    "Received streamed token after send channel closed. Ignoring."
-                )
-                return
-            await send_chan.send(StreamedMessage(content=response_str))
-
-        if response_str.strip() == "":
-            await send_chan.send(
-                StreamedMessage(
-                    content="Sorry, I either wasn't able to understand your question or I don't have an answer for it."
-                )
+            """.strip()
+            streaming_chat_response: StreamingAgentChatResponse = (
+                await chat_engine.astream_chat(templated_message)
             )
+            response_str = ""
+            async for text in streaming_chat_response.async_response_gen():
+                response_str += text
+                if send_chan._closed:
+                    logger.debug(
+                        "Received streamed token after send channel closed. Ignoring."
+                    )
+                    return
+                await send_chan.send(StreamedMessage(content=response_str))
+
+            if response_str.strip() == "":
+                await send_chan.send(
+                    StreamedMessage(
+                        content="Sorry, I either wasn't able to understand your question or I don't have an answer for it."
+                    )
+                )
+            release_chat_engine(conversation, chat_engine)
+        except asyncio.CancelledError:
+            # The client disconnected. Cancelling this task cancels the tool call the
+            # agent is waiting on, along with its sub-questions & their OpenAI requests,
+            # but not the response stream the agent reads in a task of its own.
+            if chat_engine is not None:
+                chat_engine.cancel_response_streams()
+            raise
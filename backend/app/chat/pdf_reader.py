@@ -0,0 +1,109 @@
+"""
+Page-level PDF parsing that can be spread across a process pool.
+
+Produces the same documents as llama_index's PDFReader: one document per page with
+the page_label, file_name and any extra_info in its metadata, in page order.
+"""
+import asyncio
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import pypdf
+from llama_index.schema import Document as LlamaIndexDocument
+
+DEFAULT_PAGES_PER_TASK = 16
+
+# (page_label, page_text)
+PageText = Tuple[str, str]
+
+
+def count_pages(file_path: Path) -> int:
+    with open(file_path, "rb") as fp:
+        return len(pypdf.PdfReader(fp).pages)
+
+
+def extract_page_range(file_path: Path, start: int, end: int) -> List[PageText]:
+    """
+    Extract the text of pages [start, end). Runs in a worker process.
+    """
+    with open(file_path, "rb") as fp:
+        pdf = pypdf.PdfReader(fp)
+        page_labels = pdf.page_labels
+        return [
+            (page_labels[page], pdf.pages[page].extract_text())
+            for page in range(start, end)
+        ]
+
+
+def build_page_ranges(num_pages: int, pages_per_task: int) -> List[Tuple[int, int]]:
+    return [
+        (start, min(start + pages_per_task, num_pages))
+        for start in range(0, num_pages, pages_per_task)
+    ]
+
+
+def build_page_document(
+    file_path: Path, page: PageText, extra_info: Optional[Dict] = None
+) -> LlamaIndexDocument:
+    page_label, page_text = page
+    metadata = {"page_label": page_label, "file_name": file_path.name}
+    if extra_info is not None:
+        metadata.update(extra_info)
+    return LlamaIndexDocument(text=page_text, metadata=metadata)
+
+
+def iter_pdf_pages(
+    file_path: Path,
+    executor: Executor,
+    extra_info: Optional[Dict] = None,
+    pages_per_task: int = DEFAULT_PAGES_PER_TASK,
+) -> Iterator[LlamaIndexDocument]:
+    """
+    Yield the pages of a PDF in order while later pages are still being parsed.
+    """
+    page_ranges = build_page_ranges(count_pages(file_path), pages_per_task)
+    futures = [
+        executor.submit(extract_page_range, file_path, start, end)
+        for start, end in page_ranges
+    ]
+    try:
+        for future in futures:
+            for page in future.result():
+                yield build_page_document(file_path, page, extra_info)
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+async def aiter_pdf_pages(
+    file_path: Path,
+    executor: Executor,
+    extra_info: Optional[Dict] = None,
+    pages_per_task: int = DEFAULT_PAGES_PER_TASK,
+) -> AsyncIterator[LlamaIndexDocument]:
+    """
+    Async version of iter_pdf_pages that doesn't block the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    num_pages = await loop.run_in_executor(executor, count_pages, file_path)
+    futures = [
+        loop.run_in_executor(executor, extract_page_range, file_path, start, end)
+        for start, end in build_page_ranges(num_pages, pages_per_task)
+    ]
+    try:
+        for future in futures:
+            for page in await future:
+                yield build_page_document(file_path, page, extra_info)
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def read_pdf_pages(
+    file_path: Path,
+    executor: Executor,
+    extra_info: Optional[Dict] = None,
+    pages_per_task: int = DEFAULT_PAGES_PER_TASK,
+) -> List[LlamaIndexDocument]:
+    return list(iter_pdf_pages(file_path, executor, extra_info, pages_per_task))
@@ -0,0 +1,100 @@
+"""
+Postgres-backed docstore & index store.
+
+Unlike the JSON files in the local persist directory, these are shared by every
+worker and read one row at a time, so loading a single document's index struct
+doesn't require loading the whole store.
+"""
+from typing import Dict, Optional
+
+from app.models.db import StorageKeyValue
+from llama_index.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.storage.index_store.keyval_index_store import KVIndexStore
+from llama_index.storage.kvstore.types import DEFAULT_COLLECTION, BaseKVStore
+from llama_index.storage.storage_context import StorageContext
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+
+
+class PGKVStore(BaseKVStore):
+    """
+    Key-value store on top of the storagekeyvalue table.
+    Rows are unique per (collection, key).
+    """
+
+    def __init__(self, session: sessionmaker):
+        self._session = session
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        stmt = insert(StorageKeyValue).values(collection=collection, key=key, value=val)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[StorageKeyValue.collection, StorageKeyValue.key],
+            set_={"value": stmt.excluded.value, "updated_at": func.now()},
+        )
+        with self._session() as session:
+            with session.begin():
+                session.execute(stmt)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        with self._session() as session:
+            return session.execute(
+                select(StorageKeyValue.value).where(
+                    StorageKeyValue.collection == collection,
+                    StorageKeyValue.key == key,
+                )
+            ).scalar_one_or_none()
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        with self._session() as session:
+            result = session.execute(
+                select(StorageKeyValue.key, StorageKeyValue.value).where(
+                    StorageKeyValue.collection == collection
+                )
+            )
+            return {key: value for key, value in result.all()}
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        with self._session() as session:
+            with session.begin():
+                result = session.execute(
+                    delete(StorageKeyValue).where(
+                        StorageKeyValue.collection == collection,
+                        StorageKeyValue.key == key,
+                    )
+                )
+        return result.rowcount > 0
+
+
+class PGDocumentStore(KVDocumentStore):
+    def __init__(self, kvstore: PGKVStore, namespace: Optional[str] = None):
+        super().__init__(kvstore, namespace)
+        # avoid conflicts with the index store, which shares the table
+        self._node_collection = f"{self._namespace}/doc"
+
+
+class PGIndexStore(KVIndexStore):
+    def __init__(self, kvstore: PGKVStore, namespace: Optional[str] = None):
+        super().__init__(kvstore, namespace=namespace)
+        # avoid conflicts with the docstore, which shares the table
+        self._collection = f"{self._namespace}/index"
+
+
+def build_pg_kvstore(vector_store) -> PGKVStore:
+    """
+    Uses the sync session of the given CustomPGVectorStore, so it shares its
+    connection pool.
+    """
+    return PGKVStore(vector_store._session)
+
+
+def build_pg_storage_context(vector_store) -> StorageContext:
+    """
+    Build a storage context whose docstore & index store live in Postgres.
+    """
+    kvstore = build_pg_kvstore(vector_store)
+    return StorageContext.from_defaults(
+        docstore=PGDocumentStore(kvstore),
+        index_store=PGIndexStore(kvstore),
+        vector_store=vector_store,
+    )
@@ -1,21 +1,196 @@
-from llama_index.vector_stores.types import VectorStore
-from llama_index.vector_stores.postgres import PGVectorStore
+import asyncio
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+)
+from llama_index.vector_stores.types import (
+    MetadataFilters,
+    NodeWithEmbedding,
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.vector_stores.postgres import DBEmbeddingRow, PGVectorStore
+from pgvector.sqlalchemy import Vector
 from sqlalchemy.engine import make_url
 from app.db.session import SessionLocal as AppSessionLocal, engine as app_engine
 import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from app.core.config import settings
+from sqlalchemy import Column, create_engine, delete, select
+from sqlalchemy.dialects.postgresql import BIGINT, JSON, VARCHAR, insert
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import VectorStorePartitioning, settings
+from app.chat.constants import DB_DOC_ID_KEY
+from app.chat.embedding_snapshot import (
+    delete_document_snapshot,
+    open_document_snapshot,
+)
+from app.chat.hot_documents import (
+    HotDocument,
+    SearchableDocument,
+    get_hot_document_cache,
+)
+from app.chat.vector_index import (
+    EMBEDDING_DIMENSIONS,
+    build_create_content_hash_index_sql,
+    build_create_document_partition_sql,
+    build_create_vector_table_sql,
+    get_compact_embedding_sql,
+    get_content_hash,
+    get_document_partition_name,
+)
+import logging
+
+logger = logging.getLogger(__name__)
 
 singleton_instance = None
 did_run_setup = False
 
+# rows per INSERT statement when adding chunks
+INSERT_BATCH_SIZE = 256
+
+
+# (query embedding, document id)
+QueryPair = Tuple[List[float], str]
+
+
+def to_vector_literal(embedding: List[float]) -> str:
+    return "[" + ",".join(str(float(value)) for value in embedding) + "]"
+
+
+class VectorQueryBatcher:
+    """
+    Collects per-document searches that are issued concurrently (e.g. the sub-questions
+    of SubQuestionQueryEngine against different documents) and runs them together as
+    one batched query.
+
+    When no batch with the same parameters is running, a search is only held back
+    until the current event loop iteration ends, so a lone search isn't delayed.
+    Otherwise searches wait up to `max_wait_seconds`, or until `max_batch_size`
+    searches are waiting, to be batched together.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[..., Awaitable[List[List[DBEmbeddingRow]]]],
+        max_batch_size: int,
+        max_wait_seconds: float,
+    ):
+        self._run_batch = run_batch
+        self._max_batch_size = max_batch_size
+        self._max_wait_seconds = max_wait_seconds
+        self._pending: Dict[Tuple, List[Tuple[QueryPair, asyncio.Future]]] = {}
+        # number of batches being run per batch key
+        self._running: Dict[Tuple, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(
+        self, embedding: List[float], doc_id: str, top_k: int, **search_kwargs: Any
+    ) -> List[DBEmbeddingRow]:
+        loop = asyncio.get_running_loop()
+        # only searches with the same parameters can share a statement
+        batch_key = (loop, top_k, tuple(sorted(search_kwargs.items())))
+        future = loop.create_future()
+        pending = self._pending.setdefault(batch_key, [])
+        pending.append(((embedding, doc_id), future))
+        if len(pending) >= self._max_batch_size:
+            self._flush(batch_key)
+        elif len(pending) == 1:
+            if self._running.get(batch_key):
+                loop.call_later(self._max_wait_seconds, self._flush, batch_key)
+            else:
+                # searches started in the same loop iteration (e.g. by
+                # asyncio.gather) still join this batch
+                loop.call_soon(self._flush, batch_key)
+        return await future
+
+    def _flush(self, batch_key: Tuple) -> None:
+        pending = self._pending.pop(batch_key, None)
+        if pending:
+            self._running[batch_key] = self._running.get(batch_key, 0) + 1
+            task = asyncio.ensure_future(self._run(batch_key, pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(
+        self, batch_key: Tuple, pending: List[Tuple[QueryPair, asyncio.Future]]
+    ) -> None:
+        _, top_k, search_kwargs = batch_key
+        try:
+            results = await self._run_batch(
+                [pair for pair, _ in pending], top_k, **dict(search_kwargs)
+            )
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except BaseException:
+            # e.g. the batch was cancelled, so are the searches waiting on it
+            for _, future in pending:
+                future.cancel()
+            raise
+        finally:
+            self._running[batch_key] -= 1
+            if not self._running[batch_key]:
+                del self._running[batch_key]
+        for (_, future), rows in zip(pending, results):
+            if not future.done():
+                future.set_result(rows)
+
+
+def get_data_model(base: Type, index_name: str) -> Any:
+    """
+    Same table as llama_index's PGVectorStore, plus an indexed db_document_id column
+    holding the DB_DOC_ID_KEY metadata value, so per-document filters don't need to
+    go through the metadata_ JSON, and a content_hash column that is unique per
+    document (see vector_index.get_content_hash).
+    """
+
+    class AbstractData(base):  # type: ignore
+        __abstract__ = True
+        id = Column(BIGINT, primary_key=True, autoincrement=True)
+        text = Column(VARCHAR, nullable=False)
+        metadata_ = Column(JSON)
+        node_id = Column(VARCHAR)
+        embedding = Column(Vector(EMBEDDING_DIMENSIONS))  # type: ignore
+        db_document_id = Column(VARCHAR, index=True)
+        content_hash = Column(VARCHAR)
+
+    tablename = "data_%s" % index_name
+    class_name = "Data%s" % index_name
+    return type(class_name, (AbstractData,), {"__tablename__": tablename})
+
 
 class CustomPGVectorStore(PGVectorStore):
     """
     Custom PGVectorStore that uses the same connection pool as the FastAPI app.
     """
 
+    def __init__(
+        self, connection_string: str, async_connection_string: str, table_name: str
+    ) -> None:
+        self.connection_string = connection_string
+        self.async_connection_string = async_connection_string
+        self.table_name: str = table_name.lower()
+        self._base = declarative_base()
+        self.table_class = get_data_model(self._base, self.table_name)
+        self._partitioning: Optional[VectorStorePartitioning] = None
+        self._batcher: Optional[VectorQueryBatcher] = None
+        # background loads of hot documents
+        self._load_tasks: Set[asyncio.Task] = set()
+        self._connect()
+        self._create_extension()
+        self._create_tables_if_not_exists()
+
     def _connect(self) -> None:
         self._engine = create_engine(self.connection_string)
         self._session = sessionmaker(self._engine)
@@ -36,6 +211,479 @@ class CustomPGVectorStore(PGVectorStore):
     def _create_extension(self) -> None:
         pass
 
+    def _node_to_table_row(self, node: NodeWithEmbedding) -> Any:
+        row = super()._node_to_table_row(node)
+        row.db_document_id = node.node.metadata.get(DB_DOC_ID_KEY)
+        page_label = node.node.metadata.get("page_label")
+        row.content_hash = get_content_hash(
+            row.db_document_id,
+            str(page_label) if page_label is not None else None,
+            row.text,
+        )
+        return row
+
+    def add(self, embedding_results: List[NodeWithEmbedding]) -> List[str]:
+        """
+        Insert the chunks, skipping those that their document already has (same page
+        and text), so re-running ingestion or seeding doesn't create duplicates.
+
+        Returns the ids of the inserted chunks only.
+        """
+        columns = [
+            "node_id",
+            "text",
+            "metadata_",
+            "embedding",
+            "db_document_id",
+            "content_hash",
+        ]
+        rows = [self._node_to_table_row(result) for result in embedding_results]
+        inserted_ids: List[str] = []
+        with self._session() as session:
+            with session.begin():
+                for start in range(0, len(rows), INSERT_BATCH_SIZE):
+                    values = [
+                        {column: getattr(row, column) for column in columns}
+                        for row in rows[start : start + INSERT_BATCH_SIZE]
+                    ]
+                    result = session.execute(
+                        insert(self.table_class)
+                        .values(values)
+                        .on_conflict_do_nothing(
+                            index_elements=["db_document_id", "content_hash"]
+                        )
+                        .returning(self.table_class.node_id)
+                    )
+                    inserted_ids.extend(result.scalars())
+        return inserted_ids
+
+    def _apply_filters(
+        self, stmt: Any, metadata_filters: Optional[MetadataFilters]
+    ) -> Any:
+        if metadata_filters:
+            for filter_ in metadata_filters.filters:
+                if filter_.key == DB_DOC_ID_KEY:
+                    stmt = stmt.where(
+                        self.table_class.db_document_id == str(filter_.value)
+                    )
+                    continue
+                bind_parameter = f"value_{filter_.key}"
+                stmt = stmt.where(
+                    sqlalchemy.text(f"metadata_->>'{filter_.key}' = :{bind_parameter}")
+                )
+                stmt = stmt.params(**{bind_parameter: str(filter_.value)})
+        return stmt
+
+    def _build_query(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+    ) -> Any:
+        """
+        Same as PGVectorStore._build_query, except that DB_DOC_ID_KEY filters use the
+        indexed db_document_id column.
+
+        With compact search, candidates are found by their half precision embedding
+        and then re-ranked by their full precision embedding.
+        """
+        distance = self.table_class.embedding.cosine_distance(embedding)
+        if not settings.VECTOR_COMPACT_SEARCH_ENABLED:
+            stmt = select(self.table_class, distance).order_by(distance)
+            return self._apply_filters(stmt, metadata_filters).limit(limit)
+
+        compact_distance = sqlalchemy.text(
+            f"{get_compact_embedding_sql()} <=> "
+            f"CAST(:compact_embedding AS halfvec({EMBEDDING_DIMENSIONS}))"
+        ).bindparams(compact_embedding=to_vector_literal(embedding))
+        candidates = self._apply_filters(
+            select(self.table_class.id), metadata_filters
+        ).order_by(compact_distance)
+        candidates = candidates.limit(
+            limit * settings.VECTOR_COMPACT_SEARCH_RERANK_FACTOR
+        )
+        return (
+            select(self.table_class, distance)
+            .where(self.table_class.id.in_(candidates.scalar_subquery()))
+            .order_by(distance)
+            .limit(limit)
+        )
+
+    def _get_partitioning(self) -> VectorStorePartitioning:
+        """
+        The partitioning of the existing table, see the b8e2d4f6a1c3 migration. The
+        configured one if the table hasn't been created yet.
+        """
+        if self._partitioning is not None:
+            return self._partitioning
+        with self._session() as session:
+            partstrat = session.execute(
+                sqlalchemy.text(
+                    "SELECT p.partstrat FROM pg_class c "
+                    "LEFT JOIN pg_partitioned_table p ON p.partrelid = c.oid "
+                    "WHERE c.oid = to_regclass(:table)"
+                ),
+                {"table": self.table_class.__tablename__},
+            ).first()
+        if partstrat is None:
+            return settings.VECTOR_STORE_PARTITIONING
+        self._partitioning = {
+            "h": VectorStorePartitioning.HASH,
+            "l": VectorStorePartitioning.LIST,
+        }.get(partstrat[0], VectorStorePartitioning.NONE)
+        if self._partitioning != settings.VECTOR_STORE_PARTITIONING:
+            logger.info(
+                "%s is partitioned as %s, not as configured.",
+                self.table_class.__tablename__,
+                self._partitioning.value,
+            )
+        return self._partitioning
+
+    def delete_document_chunks(self, doc_id: str) -> None:
+        """
+        Delete all chunks that were stored for the given document.
+
+        With LIST partitioning this makes sure the document has its own partition
+        and truncates it, so that its new chunks can be inserted right after.
+        """
+        table_name = self.table_class.__tablename__
+        get_hot_document_cache().invalidate(doc_id)
+        delete_document_snapshot(doc_id)
+        with self._session() as session:
+            with session.begin():
+                if self._get_partitioning() == VectorStorePartitioning.LIST:
+                    for statement in build_create_document_partition_sql(
+                        table_name, doc_id
+                    ):
+                        session.execute(sqlalchemy.text(statement))
+                    partition_name = get_document_partition_name(table_name, doc_id)
+                    session.execute(sqlalchemy.text(f"TRUNCATE {partition_name}"))
+                else:
+                    # with HASH partitioning this only touches one partition
+                    session.execute(
+                        delete(self.table_class).where(
+                            self.table_class.db_document_id == doc_id
+                        )
+                    )
+
+    def drop_document(self, doc_id: str) -> None:
+        """
+        Remove a document from the vector store entirely.
+        With LIST partitioning its partition is dropped instead of deleting its rows.
+        """
+        table_name = self.table_class.__tablename__
+        if self._get_partitioning() != VectorStorePartitioning.LIST:
+            self.delete_document_chunks(doc_id)
+            return
+        get_hot_document_cache().invalidate(doc_id)
+        delete_document_snapshot(doc_id)
+        with self._session() as session:
+            with session.begin():
+                partition_name = get_document_partition_name(table_name, doc_id)
+                session.execute(
+                    sqlalchemy.text(f"DROP TABLE IF EXISTS {partition_name}")
+                )
+                session.execute(
+                    delete(self.table_class).where(
+                        self.table_class.db_document_id == doc_id
+                    )
+                )
+
+    @staticmethod
+    def _build_search_settings(
+        hnsw_ef_search: Optional[int] = None,
+        ivfflat_probes: Optional[int] = None,
+    ) -> List[sqlalchemy.TextClause]:
+        """
+        Per-query ANN search parameters. SET LOCAL only lasts until the end of the
+        transaction, so pooled connections aren't affected.
+        """
+        search_settings = []
+        if hnsw_ef_search is not None:
+            search_settings.append(
+                sqlalchemy.text(f"SET LOCAL hnsw.ef_search = {int(hnsw_ef_search)}")
+            )
+        if ivfflat_probes is not None:
+            search_settings.append(
+                sqlalchemy.text(f"SET LOCAL ivfflat.probes = {int(ivfflat_probes)}")
+            )
+        return search_settings
+
+    @staticmethod
+    def _to_db_embedding_rows(res) -> List[DBEmbeddingRow]:
+        return [
+            DBEmbeddingRow(
+                node_id=item.node_id,
+                text=item.text,
+                metadata=item.metadata_,
+                similarity=(1 - distance),
+            )
+            for item, distance in res.all()
+        ]
+
+    def _query_with_score(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+        **search_kwargs: Any,
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_query(embedding, limit, metadata_filters)
+        with self._session() as session:
+            with session.begin():
+                for search_setting in self._build_search_settings(**search_kwargs):
+                    session.execute(search_setting)
+                return self._to_db_embedding_rows(session.execute(stmt))
+
+    async def _aquery_with_score(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+        **search_kwargs: Any,
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_query(embedding, limit, metadata_filters)
+        async with self._async_session() as async_session:
+            async with async_session.begin():
+                for search_setting in self._build_search_settings(**search_kwargs):
+                    await async_session.execute(search_setting)
+                return self._to_db_embedding_rows(await async_session.execute(stmt))
+
+    def _build_batch_query(self, pairs: Sequence[QueryPair], top_k: int) -> Any:
+        """
+        Top-k search for several (query embedding, document id) pairs in one statement.
+        Each pair is a LATERAL subquery that is planned like a single-document search.
+        """
+        table_name = self.table_class.__tablename__
+        if settings.VECTOR_COMPACT_SEARCH_ENABLED:
+            # the nearest candidates by half precision embedding, to be re-ranked
+            candidates = f"""(
+                SELECT c.node_id, c.text, c.metadata_, c.embedding
+                FROM {table_name} c
+                WHERE c.db_document_id = q.doc_id
+                ORDER BY {get_compact_embedding_sql("c.embedding")}
+                    <=> CAST(q.embedding AS halfvec({EMBEDDING_DIMENSIONS}))
+                LIMIT :num_candidates
+            )"""
+        else:
+            candidates = f"(SELECT * FROM {table_name} WHERE db_document_id = q.doc_id)"
+        stmt = sqlalchemy.text(
+            f"""
+            SELECT q.ord, d.node_id, d.text, d.metadata_, d.distance
+            FROM unnest(
+                CAST(:ords AS int[]),
+                CAST(:doc_ids AS varchar[]),
+                CAST(:embeddings AS text[])
+            ) AS q(ord, doc_id, embedding)
+            CROSS JOIN LATERAL (
+                SELECT
+                    t.node_id,
+                    t.text,
+                    t.metadata_,
+                    t.embedding <=> CAST(q.embedding AS vector) AS distance
+                FROM {candidates} t
+                ORDER BY t.embedding <=> CAST(q.embedding AS vector)
+                LIMIT :top_k
+            ) d
+            ORDER BY q.ord, d.distance
+            """
+        )
+        params = dict(
+            ords=list(range(len(pairs))),
+            doc_ids=[doc_id for _, doc_id in pairs],
+            embeddings=[to_vector_literal(embedding) for embedding, _ in pairs],
+            top_k=top_k,
+        )
+        if settings.VECTOR_COMPACT_SEARCH_ENABLED:
+            params["num_candidates"] = (
+                top_k * settings.VECTOR_COMPACT_SEARCH_RERANK_FACTOR
+            )
+        return stmt.bindparams(**params)
+
+    @staticmethod
+    def _to_batch_db_embedding_rows(
+        res, num_pairs: int
+    ) -> List[List[DBEmbeddingRow]]:
+        rows: List[List[DBEmbeddingRow]] = [[] for _ in range(num_pairs)]
+        for ord, node_id, text, metadata, distance in res.all():
+            rows[ord].append(
+                DBEmbeddingRow(
+                    node_id=node_id,
+                    text=text,
+                    metadata=metadata,
+                    similarity=(1 - distance),
+                )
+            )
+        return rows
+
+    async def _aquery_pairs_with_score(
+        self, pairs: Sequence[QueryPair], top_k: int, **search_kwargs: Any
+    ) -> List[List[DBEmbeddingRow]]:
+        if not pairs:
+            return []
+        stmt = self._build_batch_query(pairs, top_k)
+        async with self._async_session() as async_session:
+            async with async_session.begin():
+                for search_setting in self._build_search_settings(**search_kwargs):
+                    await async_session.execute(search_setting)
+                res = await async_session.execute(stmt)
+                return self._to_batch_db_embedding_rows(res, len(pairs))
+
+    def query_pairs(
+        self, pairs: Sequence[QueryPair], top_k: int, **search_kwargs: Any
+    ) -> List[VectorStoreQueryResult]:
+        """
+        Top-k results for each (query embedding, document id) pair, in one round trip.
+        """
+        if not pairs:
+            return []
+        stmt = self._build_batch_query(pairs, top_k)
+        with self._session() as session:
+            with session.begin():
+                for search_setting in self._build_search_settings(**search_kwargs):
+                    session.execute(search_setting)
+                rows = self._to_batch_db_embedding_rows(
+                    session.execute(stmt), len(pairs)
+                )
+        return [self._db_rows_to_query_result(pair_rows) for pair_rows in rows]
+
+    async def aquery_pairs(
+        self, pairs: Sequence[QueryPair], top_k: int, **search_kwargs: Any
+    ) -> List[VectorStoreQueryResult]:
+        rows = await self._aquery_pairs_with_score(pairs, top_k, **search_kwargs)
+        return [self._db_rows_to_query_result(pair_rows) for pair_rows in rows]
+
+    async def aquery_documents(
+        self,
+        embedding: List[float],
+        doc_ids: Sequence[str],
+        top_k: int,
+        **search_kwargs: Any,
+    ) -> Dict[str, VectorStoreQueryResult]:
+        """
+        Top-k results within each of the given documents for one query embedding.
+        """
+        results = await self.aquery_pairs(
+            [(embedding, doc_id) for doc_id in doc_ids], top_k, **search_kwargs
+        )
+        return dict(zip(doc_ids, results))
+
+    @staticmethod
+    def _get_document_filter(query: VectorStoreQuery) -> Optional[str]:
+        """
+        The document id if the query is only filtered by document, else None.
+        """
+        filters = query.filters.filters if query.filters is not None else []
+        if len(filters) == 1 and filters[0].key == DB_DOC_ID_KEY:
+            return str(filters[0].value)
+        return None
+
+    def _get_batcher(self) -> VectorQueryBatcher:
+        if self._batcher is None:
+            self._batcher = VectorQueryBatcher(
+                self._aquery_pairs_with_score,
+                max_batch_size=settings.VECTOR_QUERY_MAX_BATCH_SIZE,
+                max_wait_seconds=settings.VECTOR_QUERY_BATCH_WAIT_MS / 1000,
+            )
+        return self._batcher
+
+    def _get_hot_document(
+        self, doc_id: Optional[str]
+    ) -> Optional[SearchableDocument]:
+        """
+        Get a cached hot document, or open its snapshot if it has one. Snapshots are
+        cheap to open, so they don't need to be queried often before being loaded.
+        """
+        if not settings.HOT_DOCUMENT_CACHE_ENABLED or doc_id is None:
+            return None
+        hot_document_cache = get_hot_document_cache()
+        hot_document = hot_document_cache.get(doc_id)
+        if hot_document is not None or not hot_document_cache.start_loading(
+            doc_id, min_accesses=1
+        ):
+            return hot_document
+        snapshot = open_document_snapshot(doc_id)
+        if snapshot is not None and hot_document_cache.admit(doc_id, snapshot):
+            return snapshot
+        hot_document_cache.finish_loading(doc_id)
+        return None
+
+    async def _aload_hot_document(self, doc_id: str) -> None:
+        hot_document_cache = get_hot_document_cache()
+        try:
+            async with self._async_session() as async_session:
+                res = await async_session.execute(
+                    select(
+                        self.table_class.node_id,
+                        self.table_class.text,
+                        self.table_class.metadata_,
+                        self.table_class.embedding,
+                    ).where(self.table_class.db_document_id == doc_id)
+                )
+                rows = res.all()
+        except asyncio.CancelledError:
+            hot_document_cache.finish_loading(doc_id)
+            raise
+        except Exception:
+            hot_document_cache.finish_loading(doc_id)
+            logger.warning("Failed to load hot document %s", doc_id, exc_info=True)
+            return
+        if not rows:
+            hot_document_cache.finish_loading(doc_id)
+            return
+        node_ids, texts, metadatas, embeddings = zip(*rows)
+        hot_document_cache.admit(
+            doc_id,
+            HotDocument(list(node_ids), list(texts), list(metadatas), embeddings),
+        )
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """
+        Accepts `hnsw_ef_search` and `ivfflat_probes` kwargs (e.g. passed as
+        vector_store_kwargs to a retriever) to trade recall for latency.
+        """
+        hot_document = self._get_hot_document(self._get_document_filter(query))
+        if hot_document is not None:
+            return self._db_rows_to_query_result(
+                hot_document.search(query.query_embedding, query.similarity_top_k)
+            )
+        results = self._query_with_score(
+            query.query_embedding, query.similarity_top_k, query.filters, **kwargs
+        )
+        return self._db_rows_to_query_result(results)
+
+    async def aquery(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> VectorStoreQueryResult:
+        """
+        Searches within a hot document are done in process, with the document being
+        loaded in the background once it becomes hot. Other concurrent searches
+        within a single document are batched into one statement.
+        """
+        doc_id = self._get_document_filter(query)
+        hot_document = self._get_hot_document(doc_id)
+        if hot_document is not None:
+            return self._db_rows_to_query_result(
+                hot_document.search(query.query_embedding, query.similarity_top_k)
+            )
+        if (
+            settings.HOT_DOCUMENT_CACHE_ENABLED
+            and doc_id is not None
+            and get_hot_document_cache().start_loading(doc_id)
+        ):
+            task = asyncio.ensure_future(self._aload_hot_document(doc_id))
+            self._load_tasks.add(task)
+            task.add_done_callback(self._load_tasks.discard)
+        if settings.VECTOR_QUERY_BATCHING_ENABLED and doc_id is not None:
+            results = await self._get_batcher().submit(
+                query.query_embedding, doc_id, query.similarity_top_k, **kwargs
+            )
+            return self._db_rows_to_query_result(results)
+        results = await self._aquery_with_score(
+            query.query_embedding, query.similarity_top_k, query.filters, **kwargs
+        )
+        return self._db_rows_to_query_result(results)
+
     async def run_setup(self) -> None:
         global did_run_setup
         if did_run_setup:
@@ -49,9 +697,44 @@ class CustomPGVectorStore(PGVectorStore):
         async with self._async_session() as session:
             async with session.begin():
                 conn = await session.connection()
-                await conn.run_sync(self._base.metadata.create_all)
+                if settings.VECTOR_STORE_PARTITIONING == VectorStorePartitioning.NONE:
+                    await conn.run_sync(self._base.metadata.create_all)
+                else:
+                    await self._create_partitioned_table(session)
+                # add() relies on it to skip chunks the document already has
+                await session.execute(
+                    sqlalchemy.text(
+                        build_create_content_hash_index_sql(
+                            self.table_class.__tablename__
+                        )
+                    )
+                )
         did_run_setup = True
 
+    async def _create_partitioned_table(self, session: AsyncSession) -> None:
+        table_name = self.table_class.__tablename__
+        exists = (
+            await session.execute(
+                sqlalchemy.text("SELECT to_regclass(:table) IS NOT NULL"),
+                {"table": table_name},
+            )
+        ).scalar()
+        if exists:
+            return
+        for statement in build_create_vector_table_sql(
+            table_name,
+            settings.VECTOR_STORE_PARTITIONING,
+            settings.VECTOR_STORE_HASH_PARTITIONS,
+        ):
+            await session.execute(sqlalchemy.text(statement))
+        # created on every partition
+        await session.execute(
+            sqlalchemy.text(
+                f"CREATE INDEX IF NOT EXISTS ix_{table_name}_db_document_id "
+                f"ON {table_name} (db_document_id)"
+            )
+        )
+
 
 async def get_vector_store_singleton() -> VectorStore:
     global singleton_instance
@@ -0,0 +1,152 @@
+"""
+Cache of the sub-questions generated for a user query.
+
+The generated sub-questions only depend on the query and on the tools (documents)
+that are available, so repeated queries against the same documents can skip the
+question generation LLM call.
+"""
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from app.chat.answer_cache import normalize_question
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.db import SubQuestionPlan
+from cachetools import LRUCache
+from llama_index.question_gen.types import SubQuestion
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+logger = logging.getLogger(__name__)
+
+# (query hash, tools hash)
+PlanKey = Tuple[str, str]
+
+
+def get_plan_key(query_str: str, tools_str: str) -> PlanKey:
+    return (
+        hashlib.sha256(normalize_question(query_str).encode("utf-8")).hexdigest(),
+        hashlib.sha256(tools_str.encode("utf-8")).hexdigest(),
+    )
+
+
+def to_sub_questions(sub_question_dicts: List[Dict]) -> List[SubQuestion]:
+    return [SubQuestion.parse_obj(sub_question) for sub_question in sub_question_dicts]
+
+
+class SubQuestionPlanStore:
+    """
+    Generated sub-questions stored in the subquestionplan table.
+    """
+
+    async def aget(self, key: PlanKey) -> Optional[List[Dict]]:
+        query_hash, tools_hash = key
+        async with SessionLocal() as session:
+            result = await session.execute(
+                select(SubQuestionPlan.sub_questions).where(
+                    SubQuestionPlan.query_hash == query_hash,
+                    SubQuestionPlan.tools_hash == tools_hash,
+                )
+            )
+            return result.scalar_one_or_none()
+
+    async def aput(self, key: PlanKey, sub_question_dicts: List[Dict]) -> None:
+        query_hash, tools_hash = key
+        stmt = insert(SubQuestionPlan).values(
+            query_hash=query_hash,
+            tools_hash=tools_hash,
+            sub_questions=sub_question_dicts,
+        )
+        async with SessionLocal() as session:
+            async with session.begin():
+                await session.execute(
+                    stmt.on_conflict_do_nothing(
+                        index_elements=[
+                            SubQuestionPlan.query_hash,
+                            SubQuestionPlan.tools_hash,
+                        ]
+                    )
+                )
+
+
+class SubQuestionPlanCache:
+    """
+    Bounded LRU cache of generated sub-questions, optionally backed by a
+    SubQuestionPlanStore that is shared across workers.
+
+    Store failures are logged and treated as cache misses.
+    """
+
+    def __init__(self, max_size: int, store: Optional[SubQuestionPlanStore] = None):
+        self._cache: LRUCache = LRUCache(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._store = store
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: PlanKey) -> Optional[List[SubQuestion]]:
+        with self._lock:
+            sub_question_dicts = self._cache.get(key)
+            if sub_question_dicts is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return to_sub_questions(sub_question_dicts)
+
+    def put(self, key: PlanKey, sub_questions: List[SubQuestion]) -> None:
+        with self._lock:
+            self._cache[key] = [sub_question.dict() for sub_question in sub_questions]
+
+    async def aget(self, key: PlanKey) -> Optional[List[SubQuestion]]:
+        sub_questions = self.get(key)
+        if sub_questions is not None or self._store is None:
+            return sub_questions
+        try:
+            sub_question_dicts = await self._store.aget(key)
+        except Exception:
+            logger.warning("Failed to read from sub-question plan store", exc_info=True)
+            return None
+        if sub_question_dicts is None:
+            return None
+        with self._lock:
+            self._cache[key] = sub_question_dicts
+        return to_sub_questions(sub_question_dicts)
+
+    async def aput(self, key: PlanKey, sub_questions: List[SubQuestion]) -> None:
+        self.put(key, sub_questions)
+        if self._store is None:
+            return
+        try:
+            await self._store.aput(
+                key, [sub_question.dict() for sub_question in sub_questions]
+            )
+        except Exception:
+            logger.warning("Failed to write to sub-question plan store", exc_info=True)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._cache),
+            }
+
+
+singleton_instance: Optional[SubQuestionPlanCache] = None
+
+
+def get_plan_cache() -> SubQuestionPlanCache:
+    global singleton_instance
+    if singleton_instance is None:
+        singleton_instance = SubQuestionPlanCache(
+            max_size=settings.PLAN_CACHE_MAX_SIZE,
+            store=SubQuestionPlanStore() if settings.PLAN_CACHE_PERSISTENT else None,
+        )
+    return singleton_instance
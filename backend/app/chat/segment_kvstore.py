@@ -0,0 +1,175 @@
+"""
+Append-only persistence for the docstore & index store in the local persist dir.
+
+SimpleKVStore.persist rewrites the whole JSON file on every call, which makes
+indexing the Nth document cost O(N) I/O. AppendOnlyKVStore instead appends the
+changes made since the last flush to a segment file next to the JSON snapshot,
+and only rewrites the snapshot (compaction) once the segment grows too large.
+Loading replays the segment on top of the snapshot, giving the same data as if
+the snapshot had been rewritten every time.
+"""
+import json
+import logging
+import os
+import threading
+from typing import List, Optional
+
+import fsspec
+from llama_index.storage.docstore.simple_docstore import SimpleDocumentStore
+from llama_index.storage.docstore.types import (
+    DEFAULT_PERSIST_FNAME as DOCSTORE_FNAME,
+)
+from llama_index.storage.index_store.simple_index_store import SimpleIndexStore
+from llama_index.storage.index_store.types import (
+    DEFAULT_PERSIST_FNAME as INDEX_STORE_FNAME,
+)
+from llama_index.storage.kvstore.simple_kvstore import DATA_TYPE, SimpleKVStore
+from llama_index.storage.kvstore.types import DEFAULT_COLLECTION
+from llama_index.storage.storage_context import StorageContext
+from llama_index.vector_stores.types import VectorStore
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".segment"
+
+
+def get_segment_path(persist_path: str) -> str:
+    return persist_path + SEGMENT_SUFFIX
+
+
+class AppendOnlyKVStore(SimpleKVStore):
+    """
+    SimpleKVStore that keeps a log of the changes made since the last flush.
+    """
+
+    def __init__(self, data: Optional[DATA_TYPE] = None) -> None:
+        super().__init__(data)
+        # serialized when made, so later changes to the values aren't picked up
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        with self._lock:
+            super().put(key, val, collection=collection)
+            self._pending.append(
+                json.dumps({"op": "put", "c": collection, "k": key, "v": val})
+            )
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        with self._lock:
+            deleted = super().delete(key, collection=collection)
+            if deleted:
+                self._pending.append(
+                    json.dumps({"op": "delete", "c": collection, "k": key})
+                )
+            return deleted
+
+    def _apply(self, record: dict) -> None:
+        if record["op"] == "put":
+            SimpleKVStore.put(self, record["k"], record["v"], collection=record["c"])
+        elif record["op"] == "delete":
+            SimpleKVStore.delete(self, record["k"], collection=record["c"])
+
+    def flush(self, persist_path: str) -> int:
+        """
+        Append the pending changes to the segment file.
+        Returns the size of the segment file in bytes.
+        """
+        segment_path = get_segment_path(persist_path)
+        with self._lock:
+            pending, self._pending = self._pending, []
+            os.makedirs(os.path.dirname(persist_path) or ".", exist_ok=True)
+            if pending:
+                with open(segment_path, "a") as f:
+                    f.write("".join(line + "\n" for line in pending))
+                    f.flush()
+                    os.fsync(f.fileno())
+        return os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+
+    def compact(self, persist_path: str) -> None:
+        """
+        Rewrite the snapshot with the full contents of the store and drop the segment.
+        """
+        with self._lock:
+            self._pending = []
+            tmp_path = persist_path + ".tmp"
+            super().persist(tmp_path)
+            # replaying the old segment on top of the new snapshot is harmless,
+            # so a crash between these two steps doesn't lose or corrupt data
+            os.replace(tmp_path, persist_path)
+            segment_path = get_segment_path(persist_path)
+            if os.path.exists(segment_path):
+                os.remove(segment_path)
+        logger.info("Compacted %s", persist_path)
+
+    def persist(
+        self, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> None:
+        self.compact(persist_path)
+
+    @classmethod
+    def from_persist_path(
+        cls, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> "AppendOnlyKVStore":
+        segment_path = get_segment_path(persist_path)
+        if os.path.exists(persist_path):
+            kvstore = cls(SimpleKVStore.from_persist_path(persist_path).to_dict())
+        elif os.path.exists(segment_path):
+            kvstore = cls()
+        else:
+            raise FileNotFoundError(persist_path)
+
+        if os.path.exists(segment_path):
+            with open(segment_path) as f:
+                lines = f.read().splitlines()
+            for i, line in enumerate(lines):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    if i == len(lines) - 1:
+                        # a write that was cut off by a crash
+                        logger.warning("Ignoring truncated record in %s", segment_path)
+                        break
+                    raise
+                kvstore._apply(record)
+        return kvstore
+
+
+def load_append_only_storage_context(
+    persist_dir: str, vector_store: VectorStore
+) -> StorageContext:
+    docstore_kvstore = AppendOnlyKVStore.from_persist_path(
+        os.path.join(persist_dir, DOCSTORE_FNAME)
+    )
+    index_store_kvstore = AppendOnlyKVStore.from_persist_path(
+        os.path.join(persist_dir, INDEX_STORE_FNAME)
+    )
+    return StorageContext.from_defaults(
+        docstore=SimpleDocumentStore(docstore_kvstore),
+        index_store=SimpleIndexStore(index_store_kvstore),
+        vector_store=vector_store,
+        persist_dir=persist_dir,
+    )
+
+
+def persist_incrementally(
+    storage_context: StorageContext, persist_dir: str, compact_bytes: int
+) -> None:
+    """
+    Append the changes to the docstore & index store to their segment files,
+    compacting a store once its segment is larger than `compact_bytes`.
+
+    Stores that weren't loaded with load_append_only_storage_context are
+    persisted in full.
+    """
+    for store, fname in [
+        (storage_context.docstore, DOCSTORE_FNAME),
+        (storage_context.index_store, INDEX_STORE_FNAME),
+    ]:
+        persist_path = os.path.join(persist_dir, fname)
+        kvstore = getattr(store, "_kvstore", None)
+        if not isinstance(kvstore, AppendOnlyKVStore):
+            store.persist(persist_path=persist_path)
+            continue
+        if kvstore.flush(persist_path) > compact_bytes:
+            kvstore.compact(persist_path)
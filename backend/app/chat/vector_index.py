@@ -0,0 +1,253 @@
+"""
+DDL for the vector store table: its optional partitioning by document id, and the
+approximate nearest neighbor (ANN) indexes on its embedding column.
+
+Retrieval orders by cosine distance, so the indexes are built with vector_cosine_ops.
+The HNSW_HALFVEC index is built on the embeddings cast to half precision, which
+halves its size; it's used for the first stage of compact searches (see
+CustomPGVectorStore._build_query), whose candidates are re-ranked with the full
+precision embeddings. Requires pgvector >= 0.7.
+"""
+import hashlib
+from enum import Enum
+from typing import Dict, List, Optional
+
+from app.core.config import VectorStorePartitioning, settings
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+EMBEDDING_DIMENSIONS = 1536
+DEFAULT_HNSW_M = 16
+DEFAULT_HNSW_EF_CONSTRUCTION = 64
+DEFAULT_IVFFLAT_LISTS = 100
+
+
+class VectorIndexMethod(str, Enum):
+    HNSW = "hnsw"
+    IVFFLAT = "ivfflat"
+    HNSW_HALFVEC = "hnsw_halfvec"
+
+
+def get_compact_embedding_sql(column: str = "embedding") -> str:
+    # must match the HNSW_HALFVEC index expression for the index to be used
+    return f"({column}::halfvec({EMBEDDING_DIMENSIONS}))"
+
+
+def get_vector_table_name() -> str:
+    return f"data_{settings.VECTOR_STORE_TABLE_NAME}".lower()
+
+
+def quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def build_create_vector_table_sql(
+    table_name: str,
+    partitioning: VectorStorePartitioning = VectorStorePartitioning.NONE,
+    hash_partitions: int = 16,
+) -> List[str]:
+    """
+    Statements that create the vector store table if it doesn't exist yet.
+
+    Partitioned tables need the partition key in their primary key, so
+    db_document_id is part of it (and NOT NULL) when partitioning. The unique
+    content hash index is created separately (build_create_content_hash_index_sql).
+    """
+    partitioning = VectorStorePartitioning(partitioning)
+    columns = f"""
+        id BIGSERIAL,
+        text VARCHAR NOT NULL,
+        metadata_ JSON,
+        node_id VARCHAR,
+        embedding vector({EMBEDDING_DIMENSIONS}),
+        db_document_id VARCHAR,
+        content_hash VARCHAR"""
+    if partitioning == VectorStorePartitioning.NONE:
+        return [
+            f"CREATE TABLE IF NOT EXISTS {table_name} ({columns}, PRIMARY KEY (id))"
+        ]
+
+    statements = [
+        f"CREATE TABLE IF NOT EXISTS {table_name} ({columns}, "
+        f"PRIMARY KEY (id, db_document_id)) "
+        f"PARTITION BY {partitioning.value.upper()} (db_document_id)"
+    ]
+    if partitioning == VectorStorePartitioning.HASH:
+        statements += [
+            f"CREATE TABLE IF NOT EXISTS {table_name}_p{remainder} "
+            f"PARTITION OF {table_name} "
+            f"FOR VALUES WITH (MODULUS {int(hash_partitions)}, REMAINDER {remainder})"
+            for remainder in range(int(hash_partitions))
+        ]
+    else:
+        # rows of documents that don't have their own partition (yet)
+        statements.append(
+            f"CREATE TABLE IF NOT EXISTS {table_name}_default "
+            f"PARTITION OF {table_name} DEFAULT"
+        )
+    return statements
+
+
+def get_content_hash(
+    doc_id: Optional[str], page_label: Optional[str], text: str
+) -> str:
+    """
+    Identifies a chunk within its document. Must match build_content_hash_sql.
+    """
+    content = "\x1f".join([doc_id or "", page_label or "", text])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def build_content_hash_sql(alias: Optional[str] = None) -> str:
+    """
+    SQL expression computing get_content_hash for a row of the vector store table.
+    """
+    prefix = f"{alias}." if alias else ""
+    return (
+        "encode(sha256(convert_to(concat_ws(chr(31), "
+        f"coalesce({prefix}db_document_id, ''), "
+        f"coalesce({prefix}metadata_ ->> 'page_label', ''), "
+        f"{prefix}text), 'UTF8')), 'hex')"
+    )
+
+
+def get_content_hash_index_name(table_name: str) -> str:
+    return f"ux_{table_name}_db_document_id_content_hash"
+
+
+def build_create_content_hash_index_sql(table_name: str) -> str:
+    # includes the partition key, so it can be created on partitioned tables too
+    return (
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {get_content_hash_index_name(table_name)} "
+        f"ON {table_name} (db_document_id, content_hash)"
+    )
+
+
+def get_document_partition_name(table_name: str, doc_id: str) -> str:
+    # document ids are file names, so they can't be used in identifiers as is
+    return f"{table_name}_doc_{hashlib.md5(doc_id.encode('utf-8')).hexdigest()[:16]}"
+
+
+def build_create_document_partition_sql(table_name: str, doc_id: str) -> List[str]:
+    """
+    Statements that create the LIST partition of a document.
+
+    Creating a partition checks that the DEFAULT partition has no rows belonging to
+    it, so any such rows are deleted first.
+    """
+    return [
+        f"DELETE FROM {table_name}_default "
+        f"WHERE db_document_id = {quote_literal(doc_id)}",
+        f"CREATE TABLE IF NOT EXISTS {get_document_partition_name(table_name, doc_id)} "
+        f"PARTITION OF {table_name} FOR VALUES IN ({quote_literal(doc_id)})",
+    ]
+
+
+def get_vector_index_name(table_name: str, method: VectorIndexMethod) -> str:
+    return f"ix_{table_name}_embedding_{VectorIndexMethod(method).value}"
+
+
+def build_create_vector_index_sql(
+    table_name: str,
+    method: VectorIndexMethod,
+    m: int = DEFAULT_HNSW_M,
+    ef_construction: int = DEFAULT_HNSW_EF_CONSTRUCTION,
+    lists: int = DEFAULT_IVFFLAT_LISTS,
+    concurrently: bool = False,
+) -> str:
+    method = VectorIndexMethod(method)
+    if method == VectorIndexMethod.IVFFLAT:
+        using = "ivfflat (embedding vector_cosine_ops)"
+        params = f"lists = {int(lists)}"
+    else:
+        if method == VectorIndexMethod.HNSW:
+            using = "hnsw (embedding vector_cosine_ops)"
+        else:
+            using = f"hnsw ({get_compact_embedding_sql()} halfvec_cosine_ops)"
+        params = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS "
+        f"{get_vector_index_name(table_name, method)} ON {table_name} "
+        f"USING {using} WITH ({params})"
+    )
+
+
+def is_vector_table_partitioned(connection: Connection) -> bool:
+    return (
+        connection.execute(
+            text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table_name)"),
+            {"table_name": get_vector_table_name()},
+        ).scalar()
+        == "p"
+    )
+
+
+def create_vector_index(
+    connection: Connection,
+    method: VectorIndexMethod,
+    concurrently: bool = False,
+    **params: int,
+) -> str:
+    """
+    Create an ANN index on the vector store table if it doesn't exist yet.
+    CONCURRENTLY requires a connection in autocommit mode.
+    """
+    table_name = get_vector_table_name()
+    connection.execute(
+        text(
+            build_create_vector_index_sql(
+                table_name, method, concurrently=concurrently, **params
+            )
+        )
+    )
+    return get_vector_index_name(table_name, method)
+
+
+def drop_vector_index(
+    connection: Connection, method: VectorIndexMethod, concurrently: bool = False
+) -> str:
+    index_name = get_vector_index_name(get_vector_table_name(), method)
+    connection.execute(
+        text(
+            f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}"
+            f"IF EXISTS {index_name}"
+        )
+    )
+    return index_name
+
+
+def reindex_vector_index(
+    connection: Connection, method: VectorIndexMethod, concurrently: bool = False
+) -> str:
+    """
+    Rebuild an existing ANN index, e.g. after a bulk load or to rebalance IVFFlat lists.
+    """
+    index_name = get_vector_index_name(get_vector_table_name(), method)
+    connection.execute(
+        text(f"REINDEX INDEX {'CONCURRENTLY ' if concurrently else ''}{index_name}")
+    )
+    return index_name
+
+
+def get_vector_table_indexes(connection: Connection) -> List[Dict]:
+    """
+    Describe the indexes on the vector store table, with their size and usage.
+    """
+    result = connection.execute(
+        text(
+            """
+            SELECT
+                i.indexname AS name,
+                i.indexdef AS definition,
+                pg_relation_size(s.indexrelid) AS size_bytes,
+                s.idx_scan AS scans
+            FROM pg_indexes i
+            JOIN pg_stat_user_indexes s
+                ON s.indexrelname = i.indexname AND s.schemaname = i.schemaname
+            WHERE i.tablename = :table_name
+            ORDER BY i.indexname
+            """
+        ),
+        {"table_name": get_vector_table_name()},
+    )
+    return [dict(row._mapping) for row in result]
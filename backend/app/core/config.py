@@ -35,6 +35,36 @@ class AppEnvironment(str, Enum):
     PRODUCTION = "production"
 
 
+class StorageContextBackend(str, Enum):
+    """
+    Where the docstore & index store of the storage context are kept.
+    """
+
+    LOCAL = "local"
+    POSTGRES = "postgres"
+
+
+class VectorStorePartitioning(str, Enum):
+    """
+    How the vector store table is partitioned by document id.
+    """
+
+    NONE = "none"
+    HASH = "hash"
+    LIST = "list"
+
+
+class MessageDeliveryMode(str, Enum):
+    """
+    How updates to a streamed message are passed from the chat engine to the client.
+    """
+
+    # every update is buffered, the chat engine waits when the buffer is full
+    BUFFERED = "buffered"
+    # only the newest content is kept for slow clients, the chat engine never waits
+    LATEST = "latest"
+
+
 is_pull_request: bool = os.environ.get("IS_PULL_REQUEST") == "true"
 is_preview_env: bool = os.environ.get("IS_PREVIEW_ENV") == "true"
 
@@ -79,6 +109,92 @@ class Settings(PreviewPrefixedSettings):
     SENTRY_DSN: Optional[str]
     RENDER_GIT_COMMIT: Optional[str]
     LOADER_IO_VERIFICATION_STR: str = "loaderio-e51043c635e0f4656473d3570ae5d9ec"
+    # Memory budget for the process-wide cache of per-document indices
+    DOCUMENT_INDEX_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    # Per-conversation chat engines expire after this many idle seconds
+    CHAT_ENGINE_CACHE_TTL_SECONDS: int = 15 * 60
+    CHAT_ENGINE_CACHE_MAX_SIZE: int = 256
+    # Number of worker processes used to parse & embed documents ahead of time
+    INGESTION_MAX_WORKERS: int = 2
+    # Parsed pages are chunked & embedded in batches of this many pages
+    INGESTION_EMBED_BATCH_PAGES: int = 8
+    # How long a chat message waits for its documents to be indexed before giving up
+    INGESTION_WAIT_TIMEOUT_SECONDS: float = 20.0
+    # Reuse embeddings of previously seen chunks from the embeddingcache table
+    EMBEDDING_CACHE_ENABLED: bool = True
+    # In-process cache of question & sub-question embeddings
+    QUERY_EMBEDDING_CACHE_MAX_SIZE: int = 4096
+    QUERY_EMBEDDING_CACHE_TTL_SECONDS: int = 24 * 60 * 60
+    # Also share query embeddings across workers through the embeddingcache table
+    QUERY_EMBEDDING_CACHE_PERSISTENT: bool = False
+    # Answers to sub-questions about a single document
+    ANSWER_CACHE_MAX_SIZE: int = 4096
+    ANSWER_CACHE_TTL_SECONDS: int = 6 * 60 * 60
+    # Sub-questions generated for a query against a set of documents
+    PLAN_CACHE_MAX_SIZE: int = 1024
+    # Also share generated sub-questions across workers through the database
+    PLAN_CACHE_PERSISTENT: bool = False
+    # Keep the docstore & index store in the local persist dir or in Postgres
+    STORAGE_CONTEXT_BACKEND: StorageContextBackend = StorageContextBackend.LOCAL
+    # Append changes to the local storage context to segment files instead of
+    # rewriting it, and compact a segment once it is larger than this many bytes.
+    # Other worker processes don't pick up appended segments until their cached
+    # storage context expires, so only enable this with a single worker.
+    LOCAL_STORAGE_APPEND_ONLY: bool = False
+    LOCAL_STORAGE_COMPACT_BYTES: int = 32 * 1024 * 1024
+    # ANN search parameters for retrieval, None uses the Postgres default.
+    # Higher values improve recall (especially with per-document filters) at the
+    # cost of latency.
+    VECTOR_HNSW_EF_SEARCH: Optional[int] = 100
+    VECTOR_IVFFLAT_PROBES: Optional[int] = None
+    # Layout used when the vector store table is created at startup. With LIST
+    # partitioning every document gets its own partition, with HASH documents are
+    # spread over a fixed number of partitions. Tables created by the migrations are
+    # partitioned with `alembic -x vector_store_partitioning=...` (see b8e2d4f6a1c3).
+    VECTOR_STORE_PARTITIONING: VectorStorePartitioning = VectorStorePartitioning.NONE
+    VECTOR_STORE_HASH_PARTITIONS: int = 16
+    # Concurrent per-document searches are sent to the database as one statement.
+    # A search only waits up to VECTOR_QUERY_BATCH_WAIT_MS for others to join it
+    # while a batch with the same parameters is already running.
+    VECTOR_QUERY_BATCHING_ENABLED: bool = True
+    VECTOR_QUERY_BATCH_WAIT_MS: float = 5.0
+    VECTOR_QUERY_MAX_BATCH_SIZE: int = 32
+    # Search a half precision copy of the embeddings first (using the hnsw_halfvec
+    # index, see scripts/vector_index.py) and re-rank top_k * RERANK_FACTOR
+    # candidates with the full precision embeddings
+    VECTOR_COMPACT_SEARCH_ENABLED: bool = False
+    VECTOR_COMPACT_SEARCH_RERANK_FACTOR: int = 4
+    # Search the chunks of documents that were queried at least MIN_ACCESSES times
+    # in process instead of in Postgres, keeping up to MAX_BYTES of them per worker.
+    # A document that is re-ingested by another worker process stays cached with its
+    # old chunks here, so only enable this with a single worker.
+    HOT_DOCUMENT_CACHE_ENABLED: bool = False
+    HOT_DOCUMENT_CACHE_MAX_BYTES: int = 128 * 1024 * 1024
+    HOT_DOCUMENT_CACHE_MIN_ACCESSES: int = 3
+    # Write a memory-mappable snapshot of each document's chunks when it's indexed,
+    # which hot documents are loaded from without querying Postgres. Workers that
+    # already opened a snapshot keep using it after another worker rewrites it, so
+    # like the hot document cache this is only meant for a single worker.
+    EMBEDDING_SNAPSHOTS_ENABLED: bool = False
+    EMBEDDING_SNAPSHOT_DIR: str = "persist/embedding_snapshots"
+    # Chat history sent to the agent is limited to this many tokens. Older messages
+    # are folded into a rolling summary, trimming the history to RETAIN_FRACTION of
+    # the budget when it overflows.
+    CHAT_HISTORY_TOKEN_BUDGET: int = 3000
+    CHAT_HISTORY_RETAIN_FRACTION: float = 0.6
+    CHAT_HISTORY_SUMMARY_MAX_TOKENS: int = 400
+    # In the delta stream mode of the message endpoint, a full snapshot of the
+    # message is sent every this many events so clients can resync
+    SSE_DELTA_SNAPSHOT_INTERVAL: int = 50
+    # Updates to a streamed message are merged into one SSE event for up to this
+    # many ms or this many tokens. Sub-processes starting or finishing are sent
+    # right away.
+    SSE_FLUSH_INTERVAL_MS: float = 50.0
+    SSE_FLUSH_MAX_TOKENS: int = 20
+    # Opt into LATEST so that updates to the message content that a slow client
+    # hasn't read yet are replaced by newer ones. Sub-process updates are all
+    # delivered either way.
+    SSE_DELIVERY_MODE: MessageDeliveryMode = MessageDeliveryMode.BUFFERED
 
     # BACKEND_CORS_ORIGINS is a JSON-formatted list of origins
     # e.g: '["http://localhost", "http://localhost:4200", "http://localhost:3000", \
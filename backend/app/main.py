@@ -10,6 +10,7 @@ from alembic import script
 from alembic.config import Config
 from alembic.runtime import migration
 from app.api.api import api_router
+from app.chat.ingestion import get_ingestion_worker
 from app.chat.pg_vector import CustomPGVectorStore, get_vector_store_singleton
 from app.core.config import AppEnvironment, settings
 from app.db.wait_for_db import check_database_connection
@@ -82,10 +83,14 @@ async def lifespan(app: FastAPI):
     vector_store = cast(CustomPGVectorStore, vector_store)
     await vector_store.run_setup()
 
+    ingestion_worker = get_ingestion_worker()
+    ingestion_worker.start()
+
     # Some setup is required to initialize the llama-index sentence splitter
     split_by_sentence_tokenizer()
     yield
     # This section is run on app shutdown
+    await ingestion_worker.close()
     await vector_store.close()
 
 
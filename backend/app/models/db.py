@@ -2,7 +2,16 @@ from enum import Enum
 
 from app.models.base import Base
 from llama_index.callbacks.schema import CBEventType
-from sqlalchemy import Column, ForeignKey, String
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    UniqueConstraint,
+)
 from sqlalchemy.dialects.postgresql import ENUM, JSONB, UUID
 from sqlalchemy.orm import relationship
 
@@ -16,6 +25,8 @@ class MessageStatusEnum(str, Enum):
     PENDING = "PENDING"
     SUCCESS = "SUCCESS"
     ERROR = "ERROR"
+    # the client disconnected before the message was complete
+    CANCELLED = "CANCELLED"
 
 
 class MessageSubProcessStatusEnum(str, Enum):
@@ -44,10 +55,15 @@ class Conversation(Base):
     A conversation with messages and linked documents
     """
 
-    messages = relationship("Message", back_populates="conversation")
+    messages = relationship(
+        "Message", back_populates="conversation", order_by="Message.created_at"
+    )
     conversation_documents = relationship(
         "ConversationDocument", back_populates="conversation"
     )
+    # rolling summary of the messages up to & including history_summary_until
+    history_summary = Column(String, nullable=True)
+    history_summary_until = Column(DateTime, nullable=True)
 
 
 class ConversationDocument(Base):
@@ -71,11 +87,18 @@ class Message(Base):
         UUID(as_uuid=True), ForeignKey("conversation.id"), index=True
     )
     content = Column(String)
+    # tokens in content, counted when the message is stored
+    token_count = Column(Integer, nullable=True)
     role = Column(to_pg_enum(MessageRoleEnum))
     status = Column(to_pg_enum(MessageStatusEnum), default=MessageStatusEnum.PENDING)
     conversation = relationship("Conversation", back_populates="messages")
     sub_processes = relationship("MessageSubProcess", back_populates="message")
 
+    __table_args__ = (
+        # conversation history is read in order
+        Index("ix_message_conversation_id_created_at", "conversation_id", "created_at"),
+    )
+
 
 class MessageSubProcess(Base):
     """
@@ -91,3 +114,39 @@ class MessageSubProcess(Base):
         nullable=False,
     )
     metadata_map = Column(JSONB, nullable=True)
+
+
+class EmbeddingCache(Base):
+    """
+    A previously computed embedding, keyed by the embedding model and a hash of the normalized text
+    """
+
+    model_name = Column(String, nullable=False)
+    text_hash = Column(String, nullable=False)
+    embedding = Column(Vector(1536), nullable=False)
+
+    __table_args__ = (UniqueConstraint("model_name", "text_hash"),)
+
+
+class SubQuestionPlan(Base):
+    """
+    Sub-questions previously generated for a user query against a given set of tools
+    """
+
+    query_hash = Column(String, nullable=False)
+    tools_hash = Column(String, nullable=False)
+    sub_questions = Column(JSONB, nullable=False)
+
+    __table_args__ = (UniqueConstraint("query_hash", "tools_hash"),)
+
+
+class StorageKeyValue(Base):
+    """
+    A value in a collection of the Postgres-backed docstore & index store
+    """
+
+    collection = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    value = Column(JSONB, nullable=False)
+
+    __table_args__ = (UniqueConstraint("collection", "key"),)
@@ -111,11 +111,34 @@ class MessageSubProcess(Base):
 class Message(Base):
     conversation_id: UUID
     content: str
+    token_count: Optional[int] = None
     role: MessageRoleEnum
     status: MessageStatusEnum
     sub_processes: List[MessageSubProcess]
 
 
+class MessageStreamModeEnum(str, Enum):
+    # every event is the full Message
+    FULL = "full"
+    # "delta" events with the changes since the previous event, and periodic
+    # "snapshot" events with the full Message
+    DELTA = "delta"
+
+
+class MessageSubProcessDelta(BaseModel):
+    # position of the sub-process in Message.sub_processes
+    index: int
+    sub_process: MessageSubProcess
+
+
+class MessageDelta(BaseModel):
+    id: UUID
+    # length of the content before content_append is appended to it
+    content_offset: int
+    content_append: str
+    sub_processes: List[MessageSubProcessDelta]
+
+
 class UserMessageCreate(BaseModel):
     content: str
 
@@ -165,6 +188,8 @@ class Document(Base):
 class Conversation(Base):
     messages: List[Message]
     documents: List[str]
+    history_summary: Optional[str] = None
+    history_summary_until: Optional[datetime] = None
 
 
 class ConversationCreate(BaseModel):
@@ -1,76 +1,321 @@
+"""
+Maintenance jobs for the vector store table.
+
+Row deletions run in small keyset batches (by id), each in its own short
+transaction with a lock timeout, and pause between batches, so they don't hold
+locks on the table or starve live retrieval. Progress is checkpointed after
+every batch, so an interrupted job resumes where it stopped.
+
+Usage:
+    python scripts/dedupe_vector_store.py dedupe [--dry_run] [--yes]
+    python scripts/dedupe_vector_store.py orphans [--dry_run] [--yes]
+    python scripts/dedupe_vector_store.py vacuum
+    python scripts/dedupe_vector_store.py reindex
+
+Pass --yes to skip the confirmation prompt, e.g. when running from cron.
+"""
 import asyncio
+import json
+import os
+import sys
+from typing import Optional, Set
+
 from fire import Fire
 from sqlalchemy import text
-from app.db.session import SessionLocal
+from sqlalchemy.exc import DBAPIError
+from tqdm import tqdm
+from app.chat.embedding_snapshot import delete_document_snapshot
+from app.chat.pg_vector import get_vector_store_singleton
+from app.chat.vector_index import get_vector_table_name
+from app.core.config import VectorStorePartitioning
+from app.db.session import SessionLocal, engine
 
+UPLOAD_FOLDER = "uploads"
+CHECKPOINT_DIR = "persist/maintenance"
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PAUSE_SECONDS = 0.1
+# give up on a batch instead of waiting behind (or blocking) live queries
+LOCK_TIMEOUT = "2s"
+MAX_LOCK_RETRIES = 5
 
-async def _async_dedupe_vectore_store(dry_run: bool = False):
-    async with SessionLocal() as db:
+
+def _get_checkpoint_path(job: str) -> str:
+    return os.path.join(CHECKPOINT_DIR, f"{get_vector_table_name()}.{job}.json")
+
+
+def _load_checkpoint(job: str) -> Optional[dict]:
+    path = _get_checkpoint_path(job)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_checkpoint(job: str, checkpoint: dict) -> None:
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    tmp_path = _get_checkpoint_path(job) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, _get_checkpoint_path(job))
+
+
+def _clear_checkpoint(job: str) -> None:
+    path = _get_checkpoint_path(job)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _confirm(prompt: str, yes: bool) -> bool:
+    if yes:
+        return True
+    if not sys.stdin.isatty():
+        print("Not running interactively, pass --yes to confirm. Aborted.")
+        return False
+    if input(f"{prompt} (y/n) ").lower() != "y":
+        print("Aborted.")
+        return False
+    return True
+
+
+async def _execute_batch(stmt, params: dict) -> int:
+    """
+    Run a statement in its own short transaction, retrying when it times out waiting
+    for a lock. Returns the number of affected rows.
+    """
+    for attempt in range(MAX_LOCK_RETRIES):
         try:
-            common_table_expression = """
-                WITH cte AS (
-                    SELECT 
-                        max(id) as max_id,
-                        text, 
-                        (metadata_ ->> 'page_label'):: text as page_label, 
-                        (metadata_ ->> 'db_document_id'):: text as db_document_id
-                    FROM 
-                        data_pg_vector_store 
-                    GROUP BY 
-                        text, 
-                        page_label, 
-                        db_document_id
-                )
-            """
-            # Count rows that would be deleted
-            stmt = text(
-                f"""
-                {common_table_expression}
-                SELECT COUNT(id) FROM data_pg_vector_store WHERE id NOT IN (SELECT max_id FROM cte);
-                """
-            )
-            result = await db.execute(stmt)
-            num_duplicate_rows = result.scalar()
+            async with SessionLocal() as db:
+                async with db.begin():
+                    await db.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+                    result = await db.execute(stmt, params)
+                    return result.rowcount
+        except DBAPIError as e:
+            if "lock timeout" not in str(e) or attempt == MAX_LOCK_RETRIES - 1:
+                raise
+            await asyncio.sleep(2**attempt)
+    return 0
 
-            num_rows = (
-                await db.execute(text("SELECT COUNT(*) FROM data_pg_vector_store"))
-            ).scalar()
 
-            print(f"{num_duplicate_rows} duplicate rows found out of {num_rows} total.")
-            print(
-                f"{num_rows - num_duplicate_rows} rows would be remaining if deleted."
-            )
-            if dry_run or num_duplicate_rows == 0:
-                return
-
-            # Ask for confirmation before deleting rows
-            confirmation = input("Do you want to delete these rows? (y/n) ")
-            if confirmation.lower() != "y":
-                print("Aborted.")
-                return
-
-            # Delete the rows
-            delete_stmt = text(
-                f"""
-                {common_table_expression}
-                DELETE FROM data_pg_vector_store WHERE id NOT IN (SELECT max_id FROM cte);
-                """
+async def _get_max_id() -> int:
+    async with SessionLocal() as db:
+        result = await db.execute(
+            text(f"SELECT coalesce(max(id), 0) FROM {get_vector_table_name()}")
+        )
+        return result.scalar()
+
+
+async def _async_dedupe_vectore_store(
+    dry_run: bool = False,
+    yes: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pause_seconds: float = DEFAULT_PAUSE_SECONDS,
+    restart: bool = False,
+):
+    """
+    Delete chunks that have a newer copy (same document, page and text) in the
+    vector store, keeping the newest one.
+
+    The lookup uses the unique (db_document_id, content_hash) index, the migration
+    that added it backfilled content_hash for existing rows.
+    """
+    table_name = get_vector_table_name()
+    duplicates = f"""
+        SELECT t.id FROM {table_name} t
+        WHERE t.id > :after_id AND t.id <= :until_id AND EXISTS (
+            SELECT 1 FROM {table_name} newer
+            WHERE newer.db_document_id = t.db_document_id
+                AND newer.content_hash = t.content_hash
+                AND newer.id > t.id
+        )
+    """
+    count_stmt = text(f"SELECT count(*) FROM ({duplicates}) duplicates")
+    delete_stmt = text(f"DELETE FROM {table_name} WHERE id IN ({duplicates})")
+
+    checkpoint = None if restart else _load_checkpoint("dedupe")
+    if checkpoint is not None:
+        print(f"Resuming after id {checkpoint['after_id']}.")
+    else:
+        checkpoint = {"after_id": 0, "max_id": await _get_max_id(), "deleted": 0}
+    if dry_run:
+        print("Dry run, counting duplicates without deleting them.")
+    elif not _confirm(f"Delete duplicate rows from {table_name}?", yes):
+        return
+
+    found = 0
+    with tqdm(
+        total=checkpoint["max_id"], initial=checkpoint["after_id"], unit="id"
+    ) as progress:
+        while checkpoint["after_id"] < checkpoint["max_id"]:
+            params = {
+                "after_id": checkpoint["after_id"],
+                "until_id": min(
+                    checkpoint["after_id"] + batch_size, checkpoint["max_id"]
+                ),
+            }
+            if dry_run:
+                async with SessionLocal() as db:
+                    found += (await db.execute(count_stmt, params)).scalar()
+            else:
+                checkpoint["deleted"] += await _execute_batch(delete_stmt, params)
+            progress.update(params["until_id"] - checkpoint["after_id"])
+            checkpoint["after_id"] = params["until_id"]
+            if not dry_run:
+                _save_checkpoint("dedupe", checkpoint)
+            progress.set_postfix(deleted=checkpoint["deleted"], found=found)
+            await asyncio.sleep(pause_seconds)
+
+    if dry_run:
+        print(f"{found} duplicate rows found.")
+    else:
+        _clear_checkpoint("dedupe")
+        print(f"{checkpoint['deleted']} duplicate rows have been deleted.")
+
+
+async def _get_stored_doc_ids() -> Set[str]:
+    async with SessionLocal() as db:
+        result = await db.execute(
+            text(
+                f"SELECT DISTINCT db_document_id FROM {get_vector_table_name()} "
+                "WHERE db_document_id IS NOT NULL"
             )
-            await db.execute(delete_stmt)
-            await db.commit()  # Explicitly commit the transaction
-            print(f"{num_duplicate_rows} rows have been deleted.")
-        except Exception as e:
-            print(f"An error occurred: {e}")
+        )
+        return {doc_id for doc_id, in result.all()}
 
 
-def dedupe_vectore_store(dry_run: bool = False):
+async def _async_cleanup_orphans(
+    dry_run: bool = False,
+    yes: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pause_seconds: float = DEFAULT_PAUSE_SECONDS,
+):
+    """
+    Delete the chunks of documents that are no longer uploaded. Rerunning an
+    interrupted cleanup picks up the documents that still have chunks.
+    """
+    table_name = get_vector_table_name()
+    uploaded_doc_ids = set(os.listdir(UPLOAD_FOLDER))
+    if not uploaded_doc_ids:
+        # most likely run from the wrong directory or host
+        print(f"{UPLOAD_FOLDER} is empty, not treating every document as an orphan.")
+        return
+    orphan_doc_ids = sorted(await _get_stored_doc_ids() - uploaded_doc_ids)
+    print(f"{len(orphan_doc_ids)} documents have chunks but aren't uploaded.")
+    for doc_id in orphan_doc_ids:
+        print(f"    {doc_id}")
+    if dry_run or not orphan_doc_ids:
+        return
+    if not _confirm(f"Delete the chunks of these documents from {table_name}?", yes):
+        return
+
+    vector_store = await get_vector_store_singleton()
+    delete_stmt = text(
+        f"""
+        DELETE FROM {table_name} WHERE id IN (
+            SELECT id FROM {table_name} WHERE db_document_id = :doc_id LIMIT :batch_size
+        )
+        """
+    )
+    for doc_id in tqdm(orphan_doc_ids, unit="document"):
+        if vector_store._get_partitioning() == VectorStorePartitioning.LIST:
+            # dropping the document's partition is cheaper than deleting its rows
+            vector_store.drop_document(doc_id)
+            continue
+        params = {"doc_id": doc_id, "batch_size": batch_size}
+        while await _execute_batch(delete_stmt, params) > 0:
+            await asyncio.sleep(pause_seconds)
+        delete_document_snapshot(doc_id)
+
+
+async def _run_autocommit(statement: str) -> None:
+    # VACUUM and REINDEX CONCURRENTLY can't run inside a transaction
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        print(statement)
+        await connection.execute(text(statement))
+
+
+def dedupe(
+    dry_run: bool = False,
+    yes: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pause_seconds: float = DEFAULT_PAUSE_SECONDS,
+    restart: bool = False,
+):
     """
     Deduplicate the vector store.
 
-    :param dry_run: If True, do not commit changes to the database.
+    Chunks are deduplicated when they're inserted since the content_hash column
+    was added, so this is only needed for data that was written before that.
+
+    :param dry_run: If True, only count the duplicates.
+    :param yes: Don't ask for confirmation.
+    :param batch_size: Number of ids to scan per transaction.
+    :param pause_seconds: Time to wait between batches.
+    :param restart: Ignore the checkpoint of a previous, interrupted run.
+    """
+    asyncio.run(
+        _async_dedupe_vectore_store(
+            dry_run=dry_run,
+            yes=yes,
+            batch_size=batch_size,
+            pause_seconds=pause_seconds,
+            restart=restart,
+        )
+    )
+
+
+def orphans(
+    dry_run: bool = False,
+    yes: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pause_seconds: float = DEFAULT_PAUSE_SECONDS,
+):
+    """
+    Delete the chunks of documents that are no longer in the uploads folder.
+
+    :param dry_run: If True, only list the documents.
+    :param yes: Don't ask for confirmation.
+    :param batch_size: Number of rows to delete per transaction.
+    :param pause_seconds: Time to wait between batches.
+    """
+    asyncio.run(
+        _async_cleanup_orphans(
+            dry_run=dry_run, yes=yes, batch_size=batch_size, pause_seconds=pause_seconds
+        )
+    )
+
+
+def vacuum(analyze: bool = True):
+    """
+    Reclaim the space of deleted rows and refresh the planner statistics.
+    """
+    options = " (ANALYZE)" if analyze else ""
+    asyncio.run(_run_autocommit(f"VACUUM{options} {get_vector_table_name()}"))
+
+
+def analyze():
+    """
+    Refresh the planner statistics of the vector store table.
+    """
+    asyncio.run(_run_autocommit(f"ANALYZE {get_vector_table_name()}"))
+
+
+def reindex():
+    """
+    Rebuild all indexes of the vector store table without blocking reads & writes.
     """
-    asyncio.run(_async_dedupe_vectore_store(dry_run=dry_run))
+    asyncio.run(
+        _run_autocommit(f"REINDEX TABLE CONCURRENTLY {get_vector_table_name()}")
+    )
 
 
 if __name__ == "__main__":
-    Fire(dedupe_vectore_store)
+    Fire(
+        {
+            "dedupe": dedupe,
+            "orphans": orphans,
+            "vacuum": vacuum,
+            "analyze": analyze,
+            "reindex": reindex,
+        }
+    )
@@ -0,0 +1,68 @@
+from fire import Fire
+import asyncio
+import os
+from tqdm import tqdm
+from llama_index.storage.docstore.keyval_docstore import (
+    DEFAULT_NAMESPACE as DOCSTORE_NAMESPACE,
+)
+from llama_index.storage.docstore.types import (
+    DEFAULT_PERSIST_FNAME as DOCSTORE_FNAME,
+)
+from llama_index.storage.index_store.keyval_index_store import (
+    DEFAULT_NAMESPACE as INDEX_STORE_NAMESPACE,
+)
+from llama_index.storage.index_store.types import (
+    DEFAULT_PERSIST_FNAME as INDEX_STORE_FNAME,
+)
+from app.chat.engine import PERSIST_DIR
+from app.chat.pg_kvstore import build_pg_kvstore
+from app.chat.pg_vector import get_vector_store_singleton
+from app.chat.segment_kvstore import AppendOnlyKVStore
+
+# (persist file, local collection, Postgres collection). The Postgres docstore &
+# index store share a table, so their node & index collections are renamed (see
+# PGDocumentStore & PGIndexStore).
+COLLECTIONS = [
+    (DOCSTORE_FNAME, f"{DOCSTORE_NAMESPACE}/data", f"{DOCSTORE_NAMESPACE}/doc"),
+    (
+        DOCSTORE_FNAME,
+        f"{DOCSTORE_NAMESPACE}/ref_doc_info",
+        f"{DOCSTORE_NAMESPACE}/ref_doc_info",
+    ),
+    (
+        DOCSTORE_FNAME,
+        f"{DOCSTORE_NAMESPACE}/metadata",
+        f"{DOCSTORE_NAMESPACE}/metadata",
+    ),
+    (
+        INDEX_STORE_FNAME,
+        f"{INDEX_STORE_NAMESPACE}/data",
+        f"{INDEX_STORE_NAMESPACE}/index",
+    ),
+]
+
+
+async def async_main_migrate_storage_context(persist_dir: str = PERSIST_DIR):
+    """
+    Copy the docstore & index store from the local persist dir to Postgres.
+    """
+    vector_store = await get_vector_store_singleton()
+    target = build_pg_kvstore(vector_store)
+    # also reads the segment files of an append-only storage context
+    sources = {
+        fname: AppendOnlyKVStore.from_persist_path(os.path.join(persist_dir, fname))
+        for fname in [DOCSTORE_FNAME, INDEX_STORE_FNAME]
+    }
+    for fname, source_collection, target_collection in COLLECTIONS:
+        values = sources[fname].get_all(collection=source_collection)
+        for key, value in tqdm(values.items(), desc=f"Copying {source_collection}"):
+            target.put(key, value, collection=target_collection)
+    print("Done. Set STORAGE_CONTEXT_BACKEND=postgres to use it.")
+
+
+def main_migrate_storage_context(persist_dir: str = PERSIST_DIR):
+    asyncio.run(async_main_migrate_storage_context(persist_dir))
+
+
+if __name__ == "__main__":
+    Fire(main_migrate_storage_context)
@@ -1,22 +1,39 @@
 from tqdm import tqdm
 from fire import Fire
 import asyncio
-from app.db.session import SessionLocal
-from app.api import crud
+import os
 from app.chat.engine import (
-    get_tool_service_context,
-    build_doc_id_to_index_map,
-    get_s3_fs,
+    PERSIST_DIR,
+    get_or_create_storage_context,
 )
+from app.chat.ingestion import get_ingestion_worker, IngestionStatusEnum
+from app.chat.pg_vector import get_vector_store_singleton
+from app.core.config import StorageContextBackend, settings
+
+UPLOAD_FOLDER = "uploads"
 
 
 async def async_main_seed_storage_context():
-    fs = get_s3_fs()
-    async with SessionLocal() as db:
-        docs = await crud.fetch_documents(db)
-    service_context = get_tool_service_context([])
-    for doc in tqdm(docs, desc="Seeding storage with DB documents"):
-        await build_doc_id_to_index_map(service_context, [doc], fs=fs)
+    doc_ids = sorted(
+        file_name
+        for file_name in os.listdir(UPLOAD_FOLDER)
+        if os.path.isfile(os.path.join(UPLOAD_FOLDER, file_name))
+    )
+    ingestion_worker = get_ingestion_worker()
+    jobs = [ingestion_worker.submit(doc_id) for doc_id in doc_ids]
+    try:
+        for job in tqdm(jobs, desc="Seeding storage with uploaded documents"):
+            status = await job.ready
+            if status != IngestionStatusEnum.READY:
+                print(f"Failed to index {job.doc_id}: {job.error}")
+        if settings.STORAGE_CONTEXT_BACKEND == StorageContextBackend.LOCAL:
+            # compact the segments appended to while seeding
+            storage_context = get_or_create_storage_context(
+                await get_vector_store_singleton()
+            )
+            storage_context.persist(persist_dir=PERSIST_DIR)
+    finally:
+        await ingestion_worker.close()
 
 
 def main_seed_storage_context():
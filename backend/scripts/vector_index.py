@@ -0,0 +1,102 @@
+from fire import Fire
+from sqlalchemy import create_engine, text
+from app.chat.vector_index import (
+    DEFAULT_HNSW_EF_CONSTRUCTION,
+    DEFAULT_HNSW_M,
+    DEFAULT_IVFFLAT_LISTS,
+    VectorIndexMethod,
+    create_vector_index,
+    drop_vector_index,
+    get_vector_table_indexes,
+    is_vector_table_partitioned,
+    reindex_vector_index,
+)
+from app.core.config import settings
+
+
+def _connect(maintenance_work_mem: str = None):
+    engine = create_engine(
+        settings.DATABASE_URL.replace("postgresql+asyncpg://", "postgresql+psycopg2://")
+    )
+    # CONCURRENTLY can't run inside a transaction
+    connection = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    if maintenance_work_mem:
+        connection.execute(
+            text("SELECT set_config('maintenance_work_mem', :value, false)"),
+            {"value": maintenance_work_mem},
+        )
+    return connection
+
+
+def build(
+    method: str = VectorIndexMethod.HNSW.value,
+    m: int = DEFAULT_HNSW_M,
+    ef_construction: int = DEFAULT_HNSW_EF_CONSTRUCTION,
+    lists: int = DEFAULT_IVFFLAT_LISTS,
+    maintenance_work_mem: str = "512MB",
+):
+    """
+    Build an HNSW or IVFFlat index on the vector store table. This doesn't block
+    writes unless the table is partitioned.
+
+    :param method: hnsw, ivfflat or hnsw_halfvec (for VECTOR_COMPACT_SEARCH_ENABLED)
+    :param m: HNSW max connections per layer
+    :param ef_construction: HNSW candidate list size while building
+    :param lists: IVFFlat number of lists, roughly rows / 1000
+    """
+    with _connect(maintenance_work_mem) as connection:
+        # indexes on partitioned tables can't be built concurrently
+        concurrently = not is_vector_table_partitioned(connection)
+        index_name = create_vector_index(
+            connection,
+            VectorIndexMethod(method),
+            concurrently=concurrently,
+            m=m,
+            ef_construction=ef_construction,
+            lists=lists,
+        )
+    print(f"Built index {index_name}")
+
+
+def rebuild(
+    method: str = VectorIndexMethod.HNSW.value, maintenance_work_mem: str = "512MB"
+):
+    """
+    Rebuild an existing index, e.g. after bulk loading documents.
+    """
+    with _connect(maintenance_work_mem) as connection:
+        index_name = reindex_vector_index(
+            connection, VectorIndexMethod(method), concurrently=True
+        )
+    print(f"Rebuilt index {index_name}")
+
+
+def drop(method: str = VectorIndexMethod.HNSW.value):
+    """
+    Drop an index. This doesn't block reads & writes unless the table is
+    partitioned.
+    """
+    with _connect() as connection:
+        # indexes on partitioned tables can't be dropped concurrently
+        concurrently = not is_vector_table_partitioned(connection)
+        index_name = drop_vector_index(
+            connection, VectorIndexMethod(method), concurrently=concurrently
+        )
+    print(f"Dropped index {index_name}")
+
+
+def inspect():
+    """
+    Print the indexes on the vector store table with their size and number of scans.
+    """
+    with _connect() as connection:
+        for index in get_vector_table_indexes(connection):
+            print(
+                f"{index['name']}: {index['size_bytes'] / 1024 / 1024:.1f} MB, "
+                f"{index['scans']} scans"
+            )
+            print(f"    {index['definition']}")
+
+
+if __name__ == "__main__":
+    Fire({"build": build, "rebuild": rebuild, "drop": drop, "inspect": inspect})
@@ -0,0 +1,45 @@
+import asyncio
+
+from app.chat.answer_cache import CachedQueryEngine, SubQuestionAnswerCache
+from llama_index.indices.query.base import BaseQueryEngine
+from llama_index.response.schema import Response
+from llama_index.schema import NodeWithScore, TextNode
+
+
+class CountingQueryEngine(BaseQueryEngine):
+    def __init__(self):
+        super().__init__(callback_manager=None)
+        self.questions = []
+
+    def _query(self, query_bundle):
+        self.questions.append(query_bundle.query_str)
+        return Response(
+            response=f"answer {len(self.questions)}",
+            source_nodes=[NodeWithScore(node=TextNode(text="source"), score=1.0)],
+        )
+
+    async def _aquery(self, query_bundle):
+        return self._query(query_bundle)
+
+
+class TestCachedQueryEngine:
+    def test_repeated_questions_are_answered_from_cache(self):
+        answer_cache = SubQuestionAnswerCache(max_size=10, ttl_seconds=60)
+        inner_engine = CountingQueryEngine()
+        query_engine = CachedQueryEngine("doc.pdf", inner_engine, answer_cache)
+
+        first = asyncio.run(query_engine.aquery("What are the risk factors?"))
+        second = asyncio.run(query_engine.aquery("what are the  risk factors"))
+
+        assert inner_engine.questions == ["What are the risk factors?"]
+        assert str(second) == str(first) == "answer 1"
+        assert second.source_nodes[0].node.text == "source"
+
+    def test_invalidate_drops_answers_for_document(self):
+        answer_cache = SubQuestionAnswerCache(max_size=10, ttl_seconds=60)
+        inner_engine = CountingQueryEngine()
+        query_engine = CachedQueryEngine("doc.pdf", inner_engine, answer_cache)
+
+        query_engine.query("What is the revenue?")
+        assert answer_cache.invalidate("doc.pdf") == 1
+        assert str(query_engine.query("What is the revenue?")) == "answer 2"
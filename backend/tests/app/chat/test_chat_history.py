@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+from app.chat.chat_history import ChatHistoryBuilder, MessageTokenCounter
+from app.models.db import MessageRoleEnum, MessageStatusEnum
+from app.schema import Conversation, Message
+from llama_index.llms.base import CompletionResponse, MessageRole
+
+
+class FakeLLM:
+    def __init__(self):
+        self.prompts = []
+
+    async def acomplete(self, prompt: str) -> CompletionResponse:
+        self.prompts.append(prompt)
+        return CompletionResponse(text=f"summary {len(self.prompts)}")
+
+
+class FakeSummaryStore:
+    def __init__(self):
+        self.summaries = []
+
+    async def aput(self, conversation_id, summary, summary_until):
+        self.summaries.append((conversation_id, summary, summary_until))
+
+
+def make_conversation(num_messages: int) -> Conversation:
+    conversation_id = uuid4()
+    return Conversation(
+        id=conversation_id,
+        documents=[],
+        messages=[
+            Message(
+                id=uuid4(),
+                conversation_id=conversation_id,
+                # 10 tokens each
+                content=" ".join(["word"] * 10),
+                role=MessageRoleEnum.user if i % 2 == 0 else MessageRoleEnum.assistant,
+                status=MessageStatusEnum.SUCCESS,
+                created_at=datetime(2023, 1, 1, 12, i),
+                sub_processes=[],
+            )
+            for i in range(num_messages)
+        ],
+    )
+
+
+class TestChatHistoryBuilder:
+    def test_history_within_budget_is_not_summarized(self):
+        llm = FakeLLM()
+        builder = ChatHistoryBuilder(
+            token_budget=100,
+            retain_fraction=0.5,
+            summary_max_tokens=100,
+            token_counter=MessageTokenCounter(max_size=100),
+            summary_store=FakeSummaryStore(),
+            llm=llm,
+        )
+
+        chat_history = asyncio.run(builder.abuild(make_conversation(4)))
+
+        assert len(chat_history) == 4
+        assert llm.prompts == []
+
+    def test_older_messages_are_folded_into_summary_incrementally(self):
+        llm = FakeLLM()
+        summary_store = FakeSummaryStore()
+        builder = ChatHistoryBuilder(
+            token_budget=50,
+            retain_fraction=0.6,
+            summary_max_tokens=100,
+            token_counter=MessageTokenCounter(max_size=100),
+            summary_store=summary_store,
+            llm=llm,
+        )
+        conversation = make_conversation(6)
+
+        chat_history = asyncio.run(builder.abuild(conversation))
+
+        # 60 tokens > 50, trimmed to the 3 most recent messages (30 tokens)
+        assert chat_history[0].role == MessageRole.SYSTEM
+        assert chat_history[0].content.endswith("summary 1")
+        assert len(chat_history) == 4
+        assert summary_store.summaries == [
+            (str(conversation.id), "summary 1", datetime(2023, 1, 1, 12, 2))
+        ]
+
+        # the next turn only needs the stored summary, until the budget overflows
+        conversation.messages += make_conversation(2).messages
+        for i, message in enumerate(conversation.messages[6:]):
+            message.created_at = datetime(2023, 1, 1, 12, 6 + i)
+        chat_history = asyncio.run(builder.abuild(conversation))
+        assert len(llm.prompts) == 1
+        assert len(chat_history) == 6
+
+        conversation.messages += make_conversation(1).messages
+        conversation.messages[-1].created_at = datetime(2023, 1, 1, 12, 8)
+        asyncio.run(builder.abuild(conversation))
+        assert len(llm.prompts) == 2
+        assert "summary 1" in llm.prompts[1]
+        assert summary_store.summaries[-1][2] == datetime(2023, 1, 1, 12, 5)
+
+    def test_stored_token_counts_are_used(self):
+        message = make_conversation(1).messages[0]
+        message.token_count = 1234
+
+        assert MessageTokenCounter(max_size=10).count(message) == 1234
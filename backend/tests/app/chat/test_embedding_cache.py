@@ -0,0 +1,70 @@
+from typing import Dict, List, Sequence
+
+import llama_index.embeddings.openai
+from app.chat.embedding_cache import (
+    CachedOpenAIEmbedding,
+    QueryEmbeddingCache,
+    hash_text,
+)
+
+FAKE_API_KEY = "sk-" + "a" * 48
+
+
+class FakeEmbeddingCacheStore:
+    def __init__(self):
+        self.embeddings: Dict[str, List[float]] = {}
+
+    def get_many(self, model_name: str, text_hashes: Sequence[str]):
+        return {h: self.embeddings[h] for h in text_hashes if h in self.embeddings}
+
+    def put_many(self, model_name: str, hash_to_embedding: Dict[str, List[float]]):
+        self.embeddings.update(hash_to_embedding)
+
+
+class TestCachedOpenAIEmbedding:
+    def test_only_embeds_new_texts(self, monkeypatch):
+        embedded_texts = []
+
+        def fake_get_embeddings(texts, **kwargs):
+            embedded_texts.extend(texts)
+            return [[float(len(text))] for text in texts]
+
+        monkeypatch.setattr(
+            llama_index.embeddings.openai, "get_embeddings", fake_get_embeddings
+        )
+        store = FakeEmbeddingCacheStore()
+        store.embeddings[hash_text("cached")] = [42.0]
+        embed_model = CachedOpenAIEmbedding(cache_store=store, api_key=FAKE_API_KEY)
+
+        for text_id, text in [("a", "cached"), ("b", "new  text"), ("c", "new text")]:
+            embed_model.queue_text_for_embedding(text_id, text)
+        text_ids, embeddings = embed_model.get_queued_text_embeddings()
+
+        assert text_ids == ["a", "b", "c"]
+        assert embeddings == [[42.0], [9.0], [9.0]]
+        # whitespace variants share one embedding call
+        assert embedded_texts == ["new  text"]
+        assert store.embeddings[hash_text("new text")] == [9.0]
+
+    def test_query_embeddings_shared_across_models(self, monkeypatch):
+        embedded_queries = []
+
+        def fake_get_embedding(text, **kwargs):
+            embedded_queries.append(text)
+            return [float(len(text))]
+
+        monkeypatch.setattr(
+            llama_index.embeddings.openai, "get_embedding", fake_get_embedding
+        )
+        query_cache = QueryEmbeddingCache(max_size=10, ttl_seconds=60)
+        embed_models = [
+            CachedOpenAIEmbedding(query_cache=query_cache, api_key=FAKE_API_KEY)
+            for _ in range(2)
+        ]
+
+        for embed_model in embed_models:
+            assert embed_model.get_query_embedding("What are the risks?") == [19.0]
+
+        assert embedded_queries == ["What are the risks?"]
+        assert query_cache.stats["hits"] == 1
+        assert query_cache.stats["hit_rate"] == 0.5
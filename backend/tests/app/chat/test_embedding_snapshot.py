@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from app.chat.embedding_snapshot import (
+    EmbeddingSnapshot,
+    InvalidSnapshotError,
+    write_snapshot,
+)
+from app.chat.hot_documents import HotDocument
+
+
+class TestEmbeddingSnapshot:
+    def test_snapshot_search_matches_in_memory_search(self, tmp_path):
+        embeddings = np.random.default_rng(0).normal(size=(20, 8))
+        node_ids = [f"node-{i}" for i in range(20)]
+        texts = [f"chunk {i} – ünïcode" for i in range(20)]
+        metadatas = [
+            {"page_label": str(i), "db_document_id": "a.pdf"} for i in range(20)
+        ]
+        path = str(tmp_path / "a.snap")
+        write_snapshot(path, node_ids, texts, metadatas, embeddings)
+
+        snapshot = EmbeddingSnapshot(path)
+        query = np.random.default_rng(1).normal(size=8).tolist()
+
+        assert snapshot.num_chunks == 20
+        assert snapshot.node_ids == node_ids
+        expected = HotDocument(node_ids, texts, metadatas, embeddings).search(query, 4)
+        actual = snapshot.search(query, 4)
+        assert [row.node_id for row in actual] == [row.node_id for row in expected]
+        assert [row.text for row in actual] == [row.text for row in expected]
+        assert [row.metadata for row in actual] == [row.metadata for row in expected]
+        assert np.allclose(
+            [row.similarity for row in actual], [row.similarity for row in expected]
+        )
+
+    def test_truncated_snapshot_is_rejected(self, tmp_path):
+        path = str(tmp_path / "a.snap")
+        write_snapshot(path, ["node-0"], ["text"], [{}], np.ones((1, 8)))
+        with open(path, "r+b") as f:
+            f.truncate(80)
+
+        with pytest.raises(InvalidSnapshotError):
+            EmbeddingSnapshot(path)
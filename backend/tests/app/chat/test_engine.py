@@ -1,10 +1,31 @@
+import asyncio
+import threading
 from typing import List, Tuple, Optional
 from uuid import UUID, uuid4
 from datetime import datetime
+import pytest
+from llama_index import ServiceContext, StorageContext
+from llama_index.data_structs.data_structs import IndexDict
 from llama_index.llms import ChatMessage
+from llama_index.llms.mock import MockLLM
+from llama_index.memory import ChatMemoryBuffer
+from llama_index.node_parser.simple import SimpleNodeParser
+from llama_index.schema import TextNode
+from llama_index.storage.kvstore.simple_kvstore import SimpleKVStore
+from llama_index.text_splitter import TokenTextSplitter
+from llama_index.token_counter.mock_embed_model import MockEmbedding
+from llama_index.vector_stores import SimpleVectorStore
 from app.schema import Message
 from app.models.db import MessageStatusEnum, MessageRoleEnum
-from app.chat.engine import get_chat_history
+from app.chat import engine
+from app.chat.engine import (
+    CancellableOpenAIAgent,
+    DocumentsNotIndexedError,
+    build_doc_id_to_index_map,
+    get_chat_history,
+)
+from app.chat.index_cache import DocumentIndexCache
+from app.chat.pg_kvstore import PGIndexStore
 
 
 class MockMessage(Message):
@@ -214,3 +235,152 @@ class TestGetChatHistory:
             [("Hello", "Hi"), ("How are you?", None)]
         )
         assert get_chat_history(messages) == expected_result
+
+
+class StalledLLM:
+    """
+    Stands in for the OpenAI LLM, with a response stream that never produces a token.
+    """
+
+    async def astream_chat(self, **kwargs):
+        async def gen():
+            await asyncio.Event().wait()
+            yield
+
+        return gen()
+
+
+class TestCancellableOpenAIAgent:
+    def test_cancel_response_streams(self):
+        async def run():
+            agent = CancellableOpenAIAgent(
+                tools=[],
+                llm=StalledLLM(),
+                memory=ChatMemoryBuffer.from_defaults(),
+                prefix_messages=[],
+            )
+            turn = asyncio.create_task(agent.astream_chat("What was the revenue?"))
+            await asyncio.sleep(0.01)
+            response_tasks = list(agent.response_tasks)
+            assert len(response_tasks) == 1
+
+            turn.cancel()
+            agent.cancel_response_streams()
+            await asyncio.gather(turn, *response_tasks, return_exceptions=True)
+            assert turn.cancelled()
+            assert response_tasks[0].cancelled()
+            assert not agent.response_tasks
+
+        asyncio.run(run())
+
+
+class ThreadRecordingKVStore(SimpleKVStore):
+    """
+    Stands in for the PGKVStore, recording the threads it is used from.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.thread_ids = set()
+
+    def put(self, key, val, collection="data"):
+        self.thread_ids.add(threading.get_ident())
+        super().put(key, val, collection=collection)
+
+    def get(self, key, collection="data"):
+        self.thread_ids.add(threading.get_ident())
+        return super().get(key, collection=collection)
+
+
+class TestBuildDocIdToIndexMap:
+    def test_index_store_is_not_used_on_the_event_loop(self, monkeypatch):
+        kvstore = ThreadRecordingKVStore()
+        PGIndexStore(kvstore).add_index_struct(IndexDict(index_id="a.pdf"))
+        kvstore.thread_ids.clear()
+        vector_store = SimpleVectorStore()
+        storage_context = StorageContext.from_defaults(
+            index_store=PGIndexStore(kvstore), vector_store=vector_store
+        )
+
+        async def get_vector_store():
+            return vector_store
+
+        monkeypatch.setattr(engine, "get_vector_store_singleton", get_vector_store)
+        monkeypatch.setattr(
+            engine, "get_or_create_storage_context", lambda _: storage_context
+        )
+        index_cache = DocumentIndexCache(max_bytes=1024, size_fn=lambda _: 1)
+        monkeypatch.setattr(engine, "get_document_index_cache", lambda: index_cache)
+        service_context = ServiceContext.from_defaults(
+            llm=MockLLM(),
+            embed_model=MockEmbedding(embed_dim=8),
+            node_parser=SimpleNodeParser.from_defaults(
+                text_splitter=TokenTextSplitter()
+            ),
+        )
+
+        async def build(doc_ids):
+            return await build_doc_id_to_index_map(service_context, doc_ids)
+
+        doc_id_to_index = asyncio.run(build(["a.pdf"]))
+        assert doc_id_to_index["a.pdf"].index_id == "a.pdf"
+        assert index_cache.get_index("a.pdf") is doc_id_to_index["a.pdf"]
+        assert kvstore.thread_ids
+        assert threading.get_ident() not in kvstore.thread_ids
+
+        with pytest.raises(DocumentsNotIndexedError) as e:
+            asyncio.run(build(["b.pdf"]))
+        assert e.value.doc_ids == ["b.pdf"]
+
+
+class DedupingVectorStore(SimpleVectorStore):
+    stores_text = True
+    flat_metadata = False
+
+    def delete_document_chunks(self, doc_id):
+        pass
+
+    def add(self, embedding_results):
+        texts = set()
+        new_results = []
+        for result in embedding_results:
+            if result.node.text not in texts:
+                texts.add(result.node.text)
+                new_results.append(result)
+        super().add(new_results)
+        return [result.id for result in new_results]
+
+
+class TestAddDocumentIndex:
+    def test_duplicate_chunks_are_not_snapshotted(self, monkeypatch):
+        vector_store = DedupingVectorStore()
+        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        service_context = ServiceContext.from_defaults(
+            llm=MockLLM(),
+            embed_model=MockEmbedding(embed_dim=8),
+            node_parser=SimpleNodeParser.from_defaults(
+                text_splitter=TokenTextSplitter()
+            ),
+        )
+        snapshots = {}
+        monkeypatch.setattr(
+            engine, "get_or_create_storage_context", lambda _: storage_context
+        )
+        monkeypatch.setattr(
+            engine, "get_tool_service_context", lambda _: service_context
+        )
+        monkeypatch.setattr(engine, "persist_storage_context", lambda _: None)
+        monkeypatch.setattr(
+            engine,
+            "write_document_snapshot",
+            lambda doc_id, nodes, flat_metadata: snapshots.update({doc_id: nodes}),
+        )
+        nodes = [
+            TextNode(id_=node_id, text=text, embedding=[0.0] * 8)
+            for node_id, text in [("1", "Risk factors"), ("2", "Risk factors")]
+        ]
+
+        index = engine.add_document_index("a.pdf", [], nodes, vector_store)
+
+        assert index.index_id == "a.pdf"
+        assert [node.node_id for node in snapshots["a.pdf"]] == ["1"]
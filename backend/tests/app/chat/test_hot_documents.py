@@ -0,0 +1,92 @@
+import numpy as np
+from app.chat.hot_documents import HotDocument, HotDocumentCache
+
+
+def make_document(num_chunks: int, dimensions: int = 8) -> HotDocument:
+    embeddings = np.random.default_rng(0).normal(size=(num_chunks, dimensions))
+    return HotDocument(
+        node_ids=[f"node-{i}" for i in range(num_chunks)],
+        texts=[f"chunk {i}" for i in range(num_chunks)],
+        metadatas=[{"page_label": str(i)} for i in range(num_chunks)],
+        embeddings=embeddings,
+    )
+
+
+class TestHotDocuments:
+    def test_search_matches_exact_cosine_similarity(self):
+        document = make_document(50)
+        query = np.random.default_rng(1).normal(size=8)
+
+        rows = document.search(query.tolist(), 5)
+
+        expected = document.matrix @ (query / np.linalg.norm(query))
+        expected_order = np.argsort(-expected)[:5]
+        assert [row.node_id for row in rows] == [
+            f"node-{i}" for i in expected_order
+        ]
+        assert np.allclose([row.similarity for row in rows], expected[expected_order])
+        assert len(document.search(query.tolist(), 100)) == 50
+
+    def test_admission_by_frequency_within_budget(self):
+        document = make_document(10)
+        cache = HotDocumentCache(
+            memory_budget_bytes=int(document.nbytes * 1.5), min_accesses=2
+        )
+
+        assert cache.get("a.pdf") is None
+        assert not cache.start_loading("a.pdf")
+        assert cache.get("a.pdf") is None
+        assert cache.start_loading("a.pdf")
+        assert not cache.start_loading("a.pdf")
+        assert cache.admit("a.pdf", document)
+        assert cache.get("a.pdf") is document
+
+        # b.pdf has been queried less often than a.pdf, so it can't evict it
+        cache.get("b.pdf")
+        cache.get("b.pdf")
+        assert cache.start_loading("b.pdf")
+        assert not cache.admit("b.pdf", make_document(10))
+        for _ in range(3):
+            cache.get("b.pdf")
+        assert cache.start_loading("b.pdf")
+        assert cache.admit("b.pdf", make_document(10))
+        assert cache.get("a.pdf") is None
+        assert cache.stats["entries"] == 1
+
+    def test_failed_readmission_keeps_cached_document(self):
+        document = make_document(10)
+        cache = HotDocumentCache(
+            memory_budget_bytes=int(document.nbytes * 2.5), min_accesses=1
+        )
+        for doc_id in ["a.pdf", "a.pdf", "b.pdf"]:
+            cache.get(doc_id)
+        assert cache.admit("b.pdf", make_document(10))
+        assert cache.admit("a.pdf", document)
+
+        # replacing a.pdf with a larger copy would need to evict the more
+        # frequently queried b.pdf
+        for _ in range(3):
+            cache.get("b.pdf")
+        assert not cache.admit("a.pdf", make_document(20))
+        assert cache.get("a.pdf") is document
+        assert cache.stats["bytes"] == 2 * document.nbytes
+
+        # its own bytes count as freed, so a same sized copy replaces it
+        replacement = make_document(10)
+        assert cache.admit("a.pdf", replacement)
+        assert cache.get("a.pdf") is replacement
+        assert cache.stats["bytes"] == 2 * document.nbytes
+
+    def test_load_started_before_invalidation_is_not_admitted(self):
+        cache = HotDocumentCache(memory_budget_bytes=1024 * 1024, min_accesses=1)
+        cache.get("a.pdf")
+        assert cache.start_loading("a.pdf")
+        # e.g. the document was re-ingested while its old chunks were being read
+        cache.invalidate("a.pdf")
+        assert not cache.admit("a.pdf", make_document(10))
+        assert cache.get("a.pdf") is None
+
+        assert cache.start_loading("a.pdf")
+        document = make_document(10)
+        assert cache.admit("a.pdf", document)
+        assert cache.get("a.pdf") is document
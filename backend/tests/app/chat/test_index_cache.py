@@ -0,0 +1,52 @@
+from app.chat.index_cache import DocumentIndexCache
+
+
+class FakeIndex:
+    def __init__(self, size_bytes: int):
+        self.size_bytes = size_bytes
+
+
+def build_cache(max_bytes: int) -> DocumentIndexCache:
+    return DocumentIndexCache(max_bytes=max_bytes, size_fn=lambda idx: idx.size_bytes)
+
+
+class TestDocumentIndexCache:
+    """
+    Test the DocumentIndexCache class.
+    """
+
+    def test_hit_and_miss_counters(self):
+        cache = build_cache(100)
+        index = FakeIndex(10)
+        assert cache.get_index("a.pdf") is None
+        cache.put_index("a.pdf", index)
+        assert cache.get_index("a.pdf") is index
+        assert cache.stats["hits"] == 1
+        assert cache.stats["misses"] == 1
+
+    def test_evicts_least_recently_used_over_budget(self):
+        cache = build_cache(100)
+        cache.put_index("a.pdf", FakeIndex(40))
+        cache.put_index("b.pdf", FakeIndex(40))
+        # touch a.pdf so that b.pdf is the least recently used
+        cache.get_index("a.pdf")
+        cache.put_index("c.pdf", FakeIndex(40))
+        assert "a.pdf" in cache
+        assert "b.pdf" not in cache
+        assert "c.pdf" in cache
+        assert cache.stats["size_bytes"] == 80
+
+    def test_entry_larger_than_budget_is_not_cached(self):
+        cache = build_cache(100)
+        cache.put_index("a.pdf", FakeIndex(200))
+        assert "a.pdf" not in cache
+
+    def test_query_engine_is_dropped_on_invalidate(self):
+        cache = build_cache(100)
+        query_engine = object()
+        cache.put_index("a.pdf", FakeIndex(10))
+        cache.set_query_engine("a.pdf", query_engine)
+        assert cache.get_query_engine("a.pdf") is query_engine
+        assert cache.invalidate("a.pdf")
+        assert cache.get_query_engine("a.pdf") is None
+        assert not cache.invalidate("a.pdf")
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from app.chat import ingestion
+from app.chat.ingestion import (
+    DocumentIngestionError,
+    IngestionStatusEnum,
+    IngestionWorker,
+)
+
+
+class TestIngestionWorker:
+    def test_forced_resubmission_waits_for_the_running_job(
+        self, monkeypatch, tmp_path
+    ):
+        document_path = tmp_path / "10-K.pdf"
+        document_path.write_bytes(b"%PDF")
+        writes = []
+        active_writes = [0, 0]  # current, max
+        lock = threading.Lock()
+
+        async def aiter_pdf_pages(file_path, executor, extra_info):
+            yield "page"
+
+        async def get_vector_store_singleton():
+            return None
+
+        def add_document_index(doc_id, documents, nodes, vector_store):
+            with lock:
+                writes.append(doc_id)
+                active_writes[0] += 1
+                active_writes[1] = max(active_writes)
+            time.sleep(0.05)
+            with lock:
+                active_writes[0] -= 1
+
+        monkeypatch.setattr(ingestion, "get_document_path", lambda _: document_path)
+        monkeypatch.setattr(ingestion, "aiter_pdf_pages", aiter_pdf_pages)
+        monkeypatch.setattr(ingestion, "embed_documents", lambda batch: [])
+        monkeypatch.setattr(
+            ingestion, "get_vector_store_singleton", get_vector_store_singleton
+        )
+        monkeypatch.setattr(ingestion, "add_document_index", add_document_index)
+
+        async def run():
+            worker = IngestionWorker(max_workers=1)
+            worker.start()
+            first_job = worker.submit("10-K.pdf")
+            await asyncio.sleep(0.02)
+            waiter = asyncio.create_task(worker.wait_until_ready(["10-K.pdf"]))
+            second_job = worker.submit("10-K.pdf", force=True)
+            is_ready = await waiter
+            await worker.close()
+            return worker, first_job, second_job, is_ready
+
+        worker, first_job, second_job, is_ready = asyncio.run(run())
+        assert is_ready
+        assert first_job.status == IngestionStatusEnum.READY
+        assert second_job.status == IngestionStatusEnum.READY
+        assert writes == ["10-K.pdf", "10-K.pdf"]
+        # the second write only started after the first one was done
+        assert active_writes[1] == 1
+        # only the most recent job is kept, and only for status queries
+        assert not worker._jobs
+        assert worker.get_job("10-K.pdf") is second_job
+
+    def test_failed_job_is_reported_instead_of_timing_out(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(
+            ingestion, "get_document_path", lambda doc_id: tmp_path / doc_id
+        )
+
+        async def run():
+            worker = IngestionWorker(max_workers=1)
+            worker.start()
+            try:
+                await worker.wait_until_ready(["missing.pdf"], timeout=5)
+            finally:
+                await worker.close()
+
+        with pytest.raises(DocumentIngestionError) as e:
+            asyncio.run(run())
+        assert e.value.doc_id_to_error == {
+            "missing.pdf": "Could not read document missing.pdf"
+        }
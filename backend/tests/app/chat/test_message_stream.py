@@ -0,0 +1,170 @@
+import asyncio
+import json
+from uuid import uuid4
+
+from app.chat.message_stream import (
+    MessageDeltaEncoder,
+    StreamDeliveryMetrics,
+    StreamFlushPolicy,
+    create_latest_state_stream,
+)
+from app.models.db import (
+    Message,
+    MessageRoleEnum,
+    MessageStatusEnum,
+    MessageSubProcess,
+    MessageSubProcessSourceEnum,
+    MessageSubProcessStatusEnum,
+)
+
+
+def make_message() -> Message:
+    return Message(
+        id=str(uuid4()),
+        conversation_id=str(uuid4()),
+        content="",
+        role=MessageRoleEnum.assistant,
+        status=MessageStatusEnum.PENDING,
+        sub_processes=[],
+    )
+
+
+def make_sub_process(message: Message, status) -> MessageSubProcess:
+    return MessageSubProcess(
+        message_id=message.id,
+        source=MessageSubProcessSourceEnum.SUB_QUESTION,
+        metadata_map=None,
+        status=status,
+    )
+
+
+class TestMessageDeltaEncoder:
+    def test_sends_appended_content_and_changed_sub_processes(self):
+        encoder = MessageDeltaEncoder(snapshot_interval=50)
+        message = make_message()
+        assert encoder.encode(message)["event"] == "snapshot"
+
+        message.content = "Revenue"
+        message.sub_processes = [
+            make_sub_process(message, MessageSubProcessStatusEnum.PENDING)
+        ]
+        event = encoder.encode(message)
+        assert event["event"] == "delta"
+        delta = json.loads(event["data"])
+        assert delta["content_offset"] == 0
+        assert delta["content_append"] == "Revenue"
+        assert [d["index"] for d in delta["sub_processes"]] == [0]
+
+        message.content = "Revenue grew"
+        message.sub_processes = [
+            message.sub_processes[0],
+            make_sub_process(message, MessageSubProcessStatusEnum.PENDING),
+        ]
+        delta = json.loads(encoder.encode(message)["data"])
+        assert delta["content_offset"] == len("Revenue")
+        assert delta["content_append"] == " grew"
+        assert [d["index"] for d in delta["sub_processes"]] == [1]
+
+        message.sub_processes = [
+            make_sub_process(message, MessageSubProcessStatusEnum.FINISHED),
+            message.sub_processes[1],
+        ]
+        delta = json.loads(encoder.encode(message)["data"])
+        assert delta["content_append"] == ""
+        assert [d["index"] for d in delta["sub_processes"]] == [0]
+        assert delta["sub_processes"][0]["sub_process"]["status"] == "FINISHED"
+
+    def test_sends_snapshots(self):
+        encoder = MessageDeltaEncoder(snapshot_interval=2)
+        message = make_message()
+        events = []
+        for content in ["a", "ab", "abc", "abcd", "x"]:
+            message.content = content
+            events.append(encoder.encode(message)["event"])
+        # periodically, and when the content was rewritten
+        assert events == ["snapshot", "delta", "delta", "snapshot", "snapshot"]
+        assert json.loads(encoder.encode(message)["data"])["content_append"] == ""
+
+
+class TestStreamFlushPolicy:
+    def test_coalesces_tokens_within_the_interval(self):
+        now = [0.0]
+        policy = StreamFlushPolicy(
+            interval_seconds=0.05, max_tokens=3, clock=lambda: now[0]
+        )
+        assert policy.seconds_until_flush() is None
+        # the first update is sent right away
+        policy.add(is_token=True)
+        assert policy.should_flush()
+        policy.flushed()
+
+        now[0] = 0.01
+        policy.add(is_token=True)
+        assert not policy.should_flush()
+        assert abs(policy.seconds_until_flush() - 0.04) < 1e-9
+        now[0] = 0.06
+        assert policy.should_flush()
+        policy.flushed()
+
+        for _ in range(2):
+            policy.add(is_token=True)
+            assert not policy.should_flush()
+        policy.add(is_token=True)
+        assert policy.should_flush()
+        policy.flushed()
+
+        policy.add(urgent=True)
+        assert policy.should_flush()
+
+
+class TestLatestStateStream:
+    def test_keeps_only_the_newest_replaceable_item(self):
+        async def run():
+            send_chan, recv_chan = create_latest_state_stream(
+                is_replaceable=lambda item: isinstance(item, str)
+            )
+            async with send_chan:
+                # a client that doesn't read doesn't hold up the sender
+                for i in range(1000):
+                    await send_chan.send(f"content {i}")
+                await send_chan.send(1)
+                await send_chan.send("content 1000")
+                await send_chan.send(2)
+            return [item async for item in recv_chan], recv_chan.stats
+
+        items, stats = asyncio.run(run())
+        assert items == [1, 2, "content 1000"]
+        assert stats == {"sent": 1003, "delivered": 3, "dropped": 1000}
+
+    def test_receiver_waits_for_items(self):
+        async def run():
+            send_chan, recv_chan = create_latest_state_stream(
+                is_replaceable=lambda item: isinstance(item, str)
+            )
+
+            async def produce():
+                async with send_chan:
+                    for i in range(3):
+                        await asyncio.sleep(0.01)
+                        await send_chan.send(f"content {i}")
+
+            task = asyncio.create_task(produce())
+            items = [item async for item in recv_chan]
+            await task
+            return items
+
+        assert asyncio.run(run()) == ["content 0", "content 1", "content 2"]
+
+
+class TestStreamDeliveryMetrics:
+    def test_accumulates_across_streams(self):
+        metrics = StreamDeliveryMetrics()
+        metrics.record({"sent": 10, "delivered": 4, "dropped": 6})
+        metrics.record({"sent": 3, "delivered": 3, "dropped": 0})
+
+        assert metrics.stats == {
+            "streams": 2,
+            "sent": 13,
+            "delivered": 7,
+            "dropped": 6,
+        }
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pypdf
+from app.chat.pdf_reader import build_page_ranges, iter_pdf_pages, read_pdf_pages
+from llama_index.readers.file.docs_reader import PDFReader
+
+
+def write_blank_pdf(file_path: Path, num_pages: int) -> Path:
+    writer = pypdf.PdfWriter()
+    for _ in range(num_pages):
+        writer.add_blank_page(width=100, height=100)
+    writer.write(str(file_path))
+    return file_path
+
+
+class TestPdfReader:
+    """
+    Test the parallel page-level PDF reader.
+    """
+
+    def test_build_page_ranges(self):
+        assert build_page_ranges(10, 4) == [(0, 4), (4, 8), (8, 10)]
+        assert build_page_ranges(0, 4) == []
+
+    def test_matches_pdf_reader(self, tmp_path):
+        file_path = write_blank_pdf(tmp_path / "doc.pdf", 11)
+        extra_info = {"db_document_id": "doc.pdf"}
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            documents = read_pdf_pages(
+                file_path, executor, extra_info=extra_info, pages_per_task=4
+            )
+        expected = PDFReader().load_data(file_path, extra_info=extra_info)
+        assert [doc.metadata for doc in documents] == [
+            doc.metadata for doc in expected
+        ]
+        assert [doc.text for doc in documents] == [doc.text for doc in expected]
+
+    def test_iter_pdf_pages_is_in_page_order(self, tmp_path):
+        file_path = write_blank_pdf(tmp_path / "doc.pdf", 9)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            page_labels = [
+                doc.metadata["page_label"]
+                for doc in iter_pdf_pages(file_path, executor, pages_per_task=2)
+            ]
+        assert page_labels == [str(page) for page in range(1, 10)]
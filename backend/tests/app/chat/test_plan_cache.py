@@ -0,0 +1,34 @@
+import asyncio
+
+from app.chat.plan_cache import SubQuestionPlanCache, get_plan_key
+from llama_index.question_gen.types import SubQuestion
+
+
+class FakePlanStore:
+    def __init__(self):
+        self.plans = {}
+
+    async def aget(self, key):
+        return self.plans.get(key)
+
+    async def aput(self, key, sub_question_dicts):
+        self.plans[key] = sub_question_dicts
+
+
+class TestSubQuestionPlanCache:
+    def test_plan_key_depends_on_normalized_query_and_tools(self):
+        key = get_plan_key("What was the revenue?", '{"AAPL": "10-K"}')
+        assert key == get_plan_key("what was the  revenue", '{"AAPL": "10-K"}')
+        assert key != get_plan_key("What was the revenue?", '{"MSFT": "10-K"}')
+
+    def test_plans_are_shared_through_store(self):
+        store = FakePlanStore()
+        key = get_plan_key("What was the revenue?", "{}")
+        sub_questions = [SubQuestion(sub_question="Revenue in 2022?", tool_name="AAPL")]
+
+        worker_cache = SubQuestionPlanCache(max_size=10, store=store)
+        asyncio.run(worker_cache.aput(key, sub_questions))
+        other_worker_cache = SubQuestionPlanCache(max_size=10, store=store)
+
+        assert asyncio.run(other_worker_cache.aget(key)) == sub_questions
+        assert other_worker_cache.get(key) == sub_questions
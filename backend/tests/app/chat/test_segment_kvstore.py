@@ -0,0 +1,38 @@
+import os
+
+from app.chat.segment_kvstore import AppendOnlyKVStore, get_segment_path
+from llama_index.storage.kvstore.simple_kvstore import SimpleKVStore
+
+
+class TestAppendOnlyKVStore:
+    def test_reload_replays_segment_on_snapshot(self, tmp_path):
+        persist_path = str(tmp_path / "docstore.json")
+        SimpleKVStore({"data": {"a": {"x": 1}}}).persist(persist_path)
+        kvstore = AppendOnlyKVStore.from_persist_path(persist_path)
+
+        kvstore.put("b", {"x": 2})
+        kvstore.put("a", {"x": 3})
+        kvstore.flush(persist_path)
+        kvstore.delete("b")
+        kvstore.flush(persist_path)
+
+        reloaded = AppendOnlyKVStore.from_persist_path(persist_path)
+        assert reloaded.to_dict() == {"data": {"a": {"x": 3}}}
+        # the snapshot itself was never rewritten
+        assert SimpleKVStore.from_persist_path(persist_path).get("a") == {"x": 1}
+
+    def test_compact_rewrites_snapshot_and_drops_segment(self, tmp_path):
+        persist_path = str(tmp_path / "index_store.json")
+        kvstore = AppendOnlyKVStore()
+        kvstore.put("a", {"x": 1})
+        kvstore.flush(persist_path)
+        with open(get_segment_path(persist_path), "a") as f:
+            f.write('{"op": "put", "c": "da')  # cut off by a crash
+
+        kvstore = AppendOnlyKVStore.from_persist_path(persist_path)
+        kvstore.compact(persist_path)
+
+        assert not os.path.exists(get_segment_path(persist_path))
+        assert SimpleKVStore.from_persist_path(persist_path).to_dict() == {
+            "data": {"a": {"x": 1}}
+        }
@@ -0,0 +1,229 @@
+import asyncio
+
+from app.chat.constants import DB_DOC_ID_KEY
+from app.chat.pg_vector import (
+    CustomPGVectorStore,
+    VectorQueryBatcher,
+    get_data_model,
+)
+from app.chat.vector_index import (
+    VectorIndexMethod,
+    build_create_content_hash_index_sql,
+    build_create_document_partition_sql,
+    build_create_vector_index_sql,
+    build_create_vector_table_sql,
+    get_content_hash,
+)
+from app.core.config import VectorStorePartitioning, settings
+from llama_index.schema import TextNode
+from llama_index.vector_stores.types import (
+    ExactMatchFilter,
+    MetadataFilters,
+    NodeWithEmbedding,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import declarative_base
+
+
+class TestVectorIndex:
+    def test_build_create_vector_index_sql(self):
+        assert build_create_vector_index_sql(
+            "data_pg_vector_store", VectorIndexMethod.HNSW, concurrently=True
+        ) == (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+            "ix_data_pg_vector_store_embedding_hnsw ON data_pg_vector_store "
+            "USING hnsw (embedding vector_cosine_ops) "
+            "WITH (m = 16, ef_construction = 64)"
+        )
+        assert build_create_vector_index_sql(
+            "data_pg_vector_store", VectorIndexMethod.IVFFLAT, lists=50
+        ).endswith("USING ivfflat (embedding vector_cosine_ops) WITH (lists = 50)")
+        assert build_create_vector_index_sql(
+            "data_pg_vector_store", VectorIndexMethod.HNSW_HALFVEC
+        ).endswith(
+            "ix_data_pg_vector_store_embedding_hnsw_halfvec ON data_pg_vector_store "
+            "USING hnsw ((embedding::halfvec(1536)) halfvec_cosine_ops) "
+            "WITH (m = 16, ef_construction = 64)"
+        )
+
+    def test_search_settings(self):
+        search_settings = CustomPGVectorStore._build_search_settings(
+            hnsw_ef_search=80, ivfflat_probes=None
+        )
+        assert [str(s) for s in search_settings] == ["SET LOCAL hnsw.ef_search = 80"]
+
+    def test_document_filter_uses_db_document_id_column(self):
+        vector_store = CustomPGVectorStore.__new__(CustomPGVectorStore)
+        vector_store.table_class = get_data_model(declarative_base(), "test_store")
+        filters = MetadataFilters(
+            filters=[
+                ExactMatchFilter(key=DB_DOC_ID_KEY, value="doc.pdf"),
+                ExactMatchFilter(key="page_label", value="3"),
+            ]
+        )
+
+        sql = str(vector_store._build_query([0.0] * 1536, 3, filters))
+
+        assert "data_test_store.db_document_id = :db_document_id_1" in sql
+        assert "metadata_->>'page_label' = :value_page_label" in sql
+        assert f"metadata_->>'{DB_DOC_ID_KEY}'" not in sql
+
+    def test_compact_search_reranks_candidates(self, monkeypatch):
+        monkeypatch.setattr(settings, "VECTOR_COMPACT_SEARCH_ENABLED", True)
+        monkeypatch.setattr(settings, "VECTOR_COMPACT_SEARCH_RERANK_FACTOR", 4)
+        vector_store = CustomPGVectorStore.__new__(CustomPGVectorStore)
+        vector_store.table_class = get_data_model(declarative_base(), "test_store")
+        filters = MetadataFilters(
+            filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value="doc.pdf")]
+        )
+
+        compiled = vector_store._build_query([0.0] * 1536, 3, filters).compile()
+
+        sql = str(compiled)
+        first_stage = sql[sql.index("IN (SELECT") :]
+        assert "ORDER BY (embedding::halfvec(1536)) <=>" in first_stage
+        assert "data_test_store.db_document_id = :db_document_id_1" in first_stage
+        assert sql.endswith(
+            "ORDER BY data_test_store.embedding <=> :embedding_1\n LIMIT :param_2"
+        )
+        assert compiled.params["param_1"] == 12
+        assert compiled.params["param_2"] == 3
+
+    def test_build_partitioned_vector_table_sql(self):
+        statements = build_create_vector_table_sql(
+            "data_pg_vector_store", VectorStorePartitioning.HASH, hash_partitions=4
+        )
+        assert "PARTITION BY HASH (db_document_id)" in statements[0]
+        assert "PRIMARY KEY (id, db_document_id)" in statements[0]
+        assert statements[-1].endswith("FOR VALUES WITH (MODULUS 4, REMAINDER 3)")
+        # older migrations create the table before its content_hash column exists
+        assert not any("content_hash)" in statement for statement in statements)
+        assert build_create_content_hash_index_sql("data_pg_vector_store") == (
+            "CREATE UNIQUE INDEX IF NOT EXISTS "
+            "ux_data_pg_vector_store_db_document_id_content_hash "
+            "ON data_pg_vector_store (db_document_id, content_hash)"
+        )
+
+        partition_sql = build_create_document_partition_sql(
+            "data_pg_vector_store", "O'Reilly 10-K.pdf"
+        )
+        assert partition_sql[-1].endswith("FOR VALUES IN ('O''Reilly 10-K.pdf')")
+
+    def test_add_returns_only_inserted_chunks(self):
+        statements = []
+
+        class Session:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def begin(self):
+                return self
+
+            def execute(self, statement):
+                statements.append(statement)
+                # the second chunk is a copy of the first one
+                return ScalarResult(["1"])
+
+        class ScalarResult(list):
+            def scalars(self):
+                return iter(self)
+
+        vector_store = CustomPGVectorStore.__new__(CustomPGVectorStore)
+        vector_store.table_class = get_data_model(declarative_base(), "test_store")
+        vector_store.flat_metadata = False
+        vector_store._session = Session
+        results = [
+            NodeWithEmbedding(
+                node=TextNode(
+                    id_=node_id,
+                    text="Risk factors",
+                    metadata={DB_DOC_ID_KEY: "a.pdf", "page_label": "1"},
+                ),
+                embedding=[0.0] * 1536,
+            )
+            for node_id in ["1", "2"]
+        ]
+
+        assert vector_store.add(results) == ["1"]
+        (statement,) = statements
+        assert str(statement.compile(dialect=postgresql.dialect())).endswith(
+            "ON CONFLICT (db_document_id, content_hash) DO NOTHING "
+            "RETURNING data_test_store.node_id"
+        )
+
+    def test_batcher_runs_concurrent_searches_together(self):
+        batches = []
+
+        async def run_batch(pairs, top_k, **search_kwargs):
+            batches.append((list(pairs), top_k, search_kwargs))
+            return [[doc_id] * top_k for _, doc_id in pairs]
+
+        batcher = VectorQueryBatcher(run_batch, max_batch_size=8, max_wait_seconds=0.01)
+
+        async def search_all():
+            return await asyncio.gather(
+                *(
+                    batcher.submit([0.1], doc_id, 2, hnsw_ef_search=40)
+                    for doc_id in ["a.pdf", "b.pdf", "c.pdf"]
+                )
+            )
+
+        results = asyncio.run(search_all())
+
+        assert results == [["a.pdf"] * 2, ["b.pdf"] * 2, ["c.pdf"] * 2]
+        assert len(batches) == 1
+        assert [doc_id for _, doc_id in batches[0][0]] == ["a.pdf", "b.pdf", "c.pdf"]
+        assert batches[0][2] == {"hnsw_ef_search": 40}
+
+    def test_batcher_does_not_delay_lone_search(self):
+        async def run_batch(pairs, top_k, **search_kwargs):
+            return [[doc_id] * top_k for _, doc_id in pairs]
+
+        batcher = VectorQueryBatcher(run_batch, max_batch_size=8, max_wait_seconds=60)
+
+        async def search():
+            return await asyncio.wait_for(batcher.submit([0.1], "a.pdf", 1), 1)
+
+        assert asyncio.run(search()) == ["a.pdf"]
+
+    def test_batcher_cancels_searches_of_cancelled_batch(self):
+        async def run_batch(pairs, top_k, **search_kwargs):
+            await asyncio.Event().wait()
+
+        batcher = VectorQueryBatcher(run_batch, max_batch_size=8, max_wait_seconds=60)
+
+        async def search():
+            search_task = asyncio.ensure_future(batcher.submit([0.1], "a.pdf", 1))
+            await asyncio.sleep(0.01)
+            (batch_task,) = batcher._tasks
+            batch_task.cancel()
+            await asyncio.wait([search_task], timeout=1)
+            return search_task
+
+        search_task = asyncio.run(search())
+        assert search_task.cancelled()
+        assert not batcher._running
+        assert not batcher._tasks
+
+    def test_content_hash_identifies_chunk_within_document(self):
+        vector_store = CustomPGVectorStore.__new__(CustomPGVectorStore)
+        vector_store.table_class = get_data_model(declarative_base(), "test_store")
+        vector_store.flat_metadata = False
+
+        def to_row(doc_id, page_label, text):
+            node = TextNode(
+                text=text, metadata={DB_DOC_ID_KEY: doc_id, "page_label": page_label}
+            )
+            return vector_store._node_to_table_row(
+                NodeWithEmbedding(node=node, embedding=[0.0] * 1536)
+            )
+
+        row = to_row("a.pdf", "1", "Risk factors")
+        assert row.db_document_id == "a.pdf"
+        assert row.content_hash == get_content_hash("a.pdf", "1", "Risk factors")
+        assert to_row("a.pdf", "1", "Risk factors").content_hash == row.content_hash
+        assert to_row("b.pdf", "1", "Risk factors").content_hash != row.content_hash
+        assert to_row("a.pdf", "2", "Risk factors").content_hash != row.content_hash
@@ -4,6 +4,7 @@ export enum MESSAGE_STATUS {
   PENDING = "PENDING",
   SUCCESS = "SUCCESS",
   ERROR = "ERROR",
+  CANCELLED = "CANCELLED",
 }
 
 export enum ROLE {